@@ -0,0 +1,287 @@
+# Benchmark of nginxdirect operations on synthetic DirectAdmin users trees.
+#
+# usage: benchmark.py [-h] [--hostnames HOSTNAMES [HOSTNAMES ...]]
+# [--domains-per-user N] [--pointers-per-domain N] [--subdomains-per-domain N]
+# [--ssl-ratio RATIO] [--sharded] [-o OUTPUT] [--compare PREVIOUS_OUTPUT]
+#
+# Every operation runs in a forked process, so the reported peak RSS belongs to that operation.
+# Results are saved as JSON to compare releases:
+#
+#   python2.7 benchmark.py --hostnames 1000 10000 100000 -o bench_1.0.json
+#   python2.7 benchmark.py --hostnames 1000 10000 100000 -o bench_1.1.json --compare bench_1.0.json
+#
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from nginxlib import NginxMap
+from nginxvhostctl import NginxVhostsConfigManager
+
+
+def generate_da_users_tree(users_dir, users_count, domains_per_user=5, pointers_per_domain=1,
+                           subdomains_per_domain=2, ssl_ratio=0.3):
+    """
+    Generates DirectAdmin users config tree
+    :param users_dir: DirectAdmin users config root to create
+    :param ssl_ratio: share of domains with SSL certificate keys in the domain config
+    :return: number of host names the tree produces in the maps
+    """
+    ssl_every = int(round(1 / ssl_ratio)) if ssl_ratio > 0 else 0
+    hostnames = 0
+    domain_number = 0
+
+    for user_number in range(users_count):
+        user_name = 'user{}'.format(user_number)
+        domains_dir = os.path.join(users_dir, user_name, 'domains')
+        os.makedirs(domains_dir)
+
+        with open(os.path.join(users_dir, user_name, 'user.conf'), 'w') as user_conf:
+            user_conf.write('username={}\nusertype=user\n'.format(user_name))
+
+        domain_names = ['{}-{}.example.com'.format(user_name, number) for number in range(domains_per_user)]
+        with open(os.path.join(users_dir, user_name, 'domains.list'), 'w') as domains_list:
+            domains_list.write(''.join(domain_name + '\n' for domain_name in domain_names))
+
+        for domain_name in domain_names:
+            domain_file = os.path.join(domains_dir, domain_name)
+
+            with open(domain_file + '.conf', 'w') as domain_conf:
+                domain_conf.write('domain={}\nusername={}\nip=127.0.0.1\nphp=ON\n'.format(domain_name, user_name))
+                if ssl_every and domain_number % ssl_every == 0:
+                    domain_conf.write('ssl=ON\nSSLCertificateFile={0}.cert\nSSLCertificateKeyFile={0}.key\n'.format(
+                            domain_file))
+
+            with open(domain_file + '.pointers', 'w') as pointers:
+                for number in range(pointers_per_domain):
+                    pointers.write('alias{}-{}=alias\n'.format(number, domain_name))
+
+            with open(domain_file + '.subdomains', 'w') as subdomains:
+                for number in range(subdomains_per_domain):
+                    subdomains.write('sub{}\n'.format(number))
+
+            with open(domain_file + '.ip_list', 'w') as ip_list:
+                ip_list.write('127.0.0.1\n')
+
+            domain_number += 1
+            hostnames += 1 + pointers_per_domain + subdomains_per_domain
+
+    return hostnames
+
+
+def _written_bytes():
+    try:
+        with open('/proc/self/io', 'r') as proc_io:
+            for line in proc_io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return None
+
+
+def _measure(operation):
+    """
+    Runs operation in a forked process
+    :return: dict with wall_time, peak_rss_kb and bytes_written
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        result = {}
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+            setup = operation()
+            start_bytes = _written_bytes()
+            start_time = time.time()
+            setup()
+            result['wall_time'] = time.time() - start_time
+
+            end_bytes = _written_bytes()
+            result['bytes_written'] = end_bytes - start_bytes if start_bytes is not None else None
+            result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except Exception as e:
+            result['error'] = str(e)
+
+        os.write(write_fd, json.dumps(result).encode('utf-8'))
+        os._exit(0)
+
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def run_scale(hostnames, domains_per_user, pointers_per_domain, subdomains_per_domain, ssl_ratio, sharded=False):
+    hosts_per_user = domains_per_user * (1 + pointers_per_domain + subdomains_per_domain)
+    users_count = max(1, hostnames // hosts_per_user)
+
+    work_dir = tempfile.mkdtemp(prefix='nginxdirect-bench-')
+    try:
+        users_dir = os.path.join(work_dir, 'users')
+        out_dir = os.path.join(work_dir, 'hosting')
+        os.makedirs(users_dir)
+        os.makedirs(out_dir)
+
+        start_time = time.time()
+        generated_hostnames = generate_da_users_tree(users_dir, users_count, domains_per_user, pointers_per_domain,
+                                                     subdomains_per_domain, ssl_ratio)
+        generate_time = time.time() - start_time
+
+        map_file = os.path.join(out_dir, NginxVhostsConfigManager.MAP_SUBDOMAINS_NAME)
+        shards_dir = os.path.join(out_dir, NginxVhostsConfigManager.MAP_SHARDS_DIR_NAME,
+                                  NginxVhostsConfigManager.MAP_SUBDOMAINS_SHARDS_NAME)
+        saved_map_file = os.path.join(work_dir, 'map_save.conf')
+        saved_shards_dir = os.path.join(work_dir, 'map_save.d')
+        user_name = 'user{}'.format(users_count // 2)
+
+        def manager():
+            return NginxVhostsConfigManager(out_dir, users_dir, sharded)
+
+        # each operation returns the measured callable, code before it is setup
+        def rebuild_all():
+            return manager().rebuild_all
+
+        def manager_load():
+            return manager
+
+        # sharded map files hold only the header, the items are in the shard files
+        def map_load():
+            if sharded:
+                return lambda: NginxMap('http_host', 'subdomain').load_shards(shards_dir)
+            return lambda: NginxMap('http_host', 'subdomain').load(map_file)
+
+        def map_save():
+            if sharded:
+                map_object = NginxMap('http_host', 'subdomain')
+                map_object.load_shards(shards_dir)
+                map_object.mark_shards_dirty()
+                os.makedirs(saved_shards_dir)
+                return lambda: map_object.save_shards(saved_map_file, saved_shards_dir,
+                                                      os.path.join(saved_shards_dir, '*.conf'))
+
+            map_object = NginxMap.from_file('http_host', 'subdomain', map_file)
+            return lambda: map_object.save(saved_map_file)
+
+        def rebuild_user():
+            conf_manager = manager()
+
+            def run():
+                conf_manager.delete_user(user_name, save=False)
+                conf_manager.rebuild_user(user_name)
+
+            return run
+
+        def clean_unresolved_domains():
+            # every 100th domain is left without its user, as after a failed delete
+            conf_manager = manager()
+            for domain_key in sorted(conf_manager.map_domains.items)[::100]:
+                conf_manager.map_users.del_item(domain_key)
+            return conf_manager.clean_unresolved_domains
+
+        def delete_user():
+            conf_manager = manager()
+            return lambda: conf_manager.delete_user(user_name)
+
+        operations = [('rebuild_all', rebuild_all), ('manager_load', manager_load), ('map_load', map_load),
+                      ('map_save', map_save), ('rebuild_user', rebuild_user),
+                      ('clean_unresolved_domains', clean_unresolved_domains), ('delete_user', delete_user)]
+
+        results = {}
+        for operation_name, operation in operations:
+            results[operation_name] = _measure(operation)
+            print("  {:<26} {:>10.4f}s {:>10} KB RSS {:>12} bytes written".format(
+                    operation_name, results[operation_name].get('wall_time', float('nan')),
+                    results[operation_name].get('peak_rss_kb'), results[operation_name].get('bytes_written')))
+
+        return {
+            'hostnames': generated_hostnames,
+            'users': users_count,
+            'domains_per_user': domains_per_user,
+            'pointers_per_domain': pointers_per_domain,
+            'subdomains_per_domain': subdomains_per_domain,
+            'ssl_ratio': ssl_ratio,
+            'sharded': sharded,
+            'generate_time': generate_time,
+            'results': results,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(previous, current):
+    """
+    Prints wall time ratio current/previous of every operation for the matching scales
+    """
+    previous_scales = dict((scale['hostnames'], scale) for scale in previous['scales'])
+
+    for scale in current['scales']:
+        previous_scale = previous_scales.get(scale['hostnames'])
+        if not previous_scale:
+            continue
+
+        print("{} hostnames vs {}:".format(scale['hostnames'], previous.get('created')))
+        for operation_name, result in sorted(scale['results'].items()):
+            previous_result = previous_scale['results'].get(operation_name, {})
+            if result.get('wall_time') and previous_result.get('wall_time'):
+                print("  {:<26} x{:.2f}".format(operation_name, result['wall_time'] / previous_result['wall_time']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nginxdirect benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hostnames", type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Number of host names in the maps for every benchmark run")
+    parser.add_argument("--domains-per-user", dest="domains_per_user", type=int, default=5)
+    parser.add_argument("--pointers-per-domain", dest="pointers_per_domain", type=int, default=1)
+    parser.add_argument("--subdomains-per-domain", dest="subdomains_per_domain", type=int, default=2)
+    parser.add_argument("--ssl-ratio", dest="ssl_ratio", type=float, default=0.3,
+                        help="Share of domains with SSL")
+    parser.add_argument("--sharded", action='store_true', help="Use sharded map files")
+    parser.add_argument("-o", "--output", help="JSON file to save results to")
+    parser.add_argument("--compare", help="JSON file with previous results")
+
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scales': [],
+    }
+
+    for hostnames in args.hostnames:
+        print("{} hostnames:".format(hostnames))
+        report['scales'].append(run_scale(hostnames, args.domains_per_user, args.pointers_per_domain,
+                                          args.subdomains_per_domain, args.ssl_ratio, args.sharded))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as previous_file:
+            compare(json.load(previous_file), report)
+
+
+if __name__ == "__main__":
+    main()
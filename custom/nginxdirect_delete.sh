@@ -5,24 +5,11 @@ if [ -z $1 ]; then
     exit 1
 fi
 
-python2.7 /usr/local/nginxdirect/nginxvhostctl.py -o /etc/nginx/hosting --delete $1 >>/var/log/nginxdirect.log 2>&1
+# hook events coming within a second are applied in one batch with one configtest and reload
+python2.7 /usr/local/nginxdirect/nginxvhostctl.py -o /etc/nginx/hosting --delete $1 \
+    --coalesce-window 1 --reload-services httpd,nginx >>/var/log/nginxdirect.log 2>&1
 if [ $? -gt 0 ]; then
     exit 1
 fi
 
-/etc/init.d/httpd configtest >/dev/null 2>&1
-if [ $? -gt 0 ]; then
-    exit 1;
-else
-    /etc/init.d/httpd reload >/dev/null 2>&1
-fi
-
-/etc/init.d/nginx configtest >/dev/null 2>&1
-if [ $? -gt 0 ]; then
-    exit 1;
-else
-    /etc/init.d/nginx reload >/dev/null 2>&1
-fi
-
 exit 0
-
@@ -0,0 +1,369 @@
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import socket
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+DAEMON_COMMANDS = ('rebuild', 'delete', 'rebuild-all', 'rebuild-changed')
+
+_inotify_event = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """
+    Watches DirectAdmin users tree with inotify: users dir, every user dir and its domains dir
+    """
+
+    def __init__(self, source_da_dir):
+        assert source_da_dir, "DirectAdmin users config dir must be specified"
+
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc is not found")
+
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+
+        self.source_da_dir = source_da_dir
+        self._watches = {}
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._add_watch(source_da_dir)
+        for user_name in os.listdir(source_da_dir):
+            self._watch_user(user_name)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add_watch(self, path):
+        watch = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if watch < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, "inotify_add_watch failed: {}".format(path))
+
+        self._watches[watch] = path
+
+    def _watch_user(self, user_name):
+        user_dir = os.path.join(self.source_da_dir, user_name)
+        if os.path.isdir(user_dir):
+            self._add_watch(user_dir)
+            self._add_watch(os.path.join(user_dir, 'domains'))
+
+    def read_changed_users(self):
+        """
+        Reads pending events
+        :return: set of changed user names or None if events were lost and all users must be checked
+        """
+        changed_users = set()
+
+        while True:
+            try:
+                events = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+
+            offset = 0
+            while offset + _inotify_event.size <= len(events):
+                watch, mask, cookie, name_length = _inotify_event.unpack_from(events, offset)
+                name = events[offset + _inotify_event.size:offset + _inotify_event.size + name_length].rstrip('\0')
+                offset += _inotify_event.size + name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    changed_users = None
+                    continue
+
+                path = self._watches.get(watch)
+                if mask & IN_IGNORED:
+                    self._watches.pop(watch, None)
+                    continue
+
+                if path is None or changed_users is None:
+                    continue
+
+                if path == self.source_da_dir:
+                    user_name = name
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_user(user_name)
+                else:
+                    relative_path = os.path.relpath(path, self.source_da_dir)
+                    user_name = relative_path.split(os.sep)[0]
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name == 'domains':
+                        self._add_watch(os.path.join(path, 'domains'))
+
+                changed_users.add(user_name)
+
+        return changed_users
+
+
+class NginxDirectDaemon(object):
+    """
+    Keeps maps in memory, applies DirectAdmin users tree changes and serves commands over a Unix socket
+    """
+
+    def __init__(self, conf_manager, socket_path, poll_interval=5.0, use_inotify=True, settle_time=0.2,
+                 lock_timeout=60, reload_orchestrator=None, reload_service_names=None):
+        """
+        :param reload_orchestrator: ReloadOrchestrator reloading services after every change or None
+        :param reload_service_names: services allowed to reload, all services of the orchestrator if None
+        """
+        assert conf_manager, "Config manager must be specified"
+        assert socket_path, "Socket path must be specified"
+
+        self.conf_manager = conf_manager
+        self.socket_path = socket_path
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.lock_timeout = lock_timeout
+        self.reload_orchestrator = reload_orchestrator
+        self.reload_service_names = reload_service_names
+        self.watcher = None
+        self.running = False
+        self._needs_reload = False
+        # artifacts saved by failed commands and changes, reloaded with the next succeeded one
+        self._pending_artifacts = set()
+
+        if use_inotify:
+            try:
+                self.watcher = InotifyWatcher(conf_manager.source_da_dir)
+            except OSError as e:
+                print("inotify is not available, polling every {} seconds: {}".format(poll_interval, e))
+
+        self._server = None
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(16)
+
+        return server
+
+    def handle_command(self, command_line):
+        """
+        Runs command received from the client
+        :param command_line: "rebuild USER", "delete USER", "rebuild-all" or "rebuild-changed"
+        :return: response line: "ok CHANGED_FILES_COUNT" or "error MESSAGE"
+        """
+        command_args = command_line.split()
+        if not command_args or command_args[0] not in DAEMON_COMMANDS:
+            return "error unknown command"
+
+        command = command_args[0]
+        user_names = command_args[1:]
+        if command in ('rebuild', 'delete') and not user_names:
+            return "error user name must be specified"
+
+        conf_manager = self.conf_manager
+        try:
+            with conf_manager.get_lock(conf_manager.working_dir, self.lock_timeout):
+                conf_manager.reload_if_changed(self._needs_reload)
+                self._needs_reload = False
+                conf_manager.changed_files = []
+                conf_manager.changed_artifacts = set()
+
+                if command == 'rebuild-all':
+                    conf_manager.rebuild_all()
+                elif command == 'rebuild-changed':
+                    conf_manager.rebuild_changed()
+                elif command == 'delete':
+                    for user_name in user_names:
+                        conf_manager.delete_user(user_name)
+                else:
+                    for user_name in user_names:
+                        conf_manager.delete_user(user_name, save=False)
+                        conf_manager.rebuild_user(user_name)
+
+                self._compact_journal_before_reload()
+        except Exception as e:
+            # the next command starts from the files on disk
+            self._needs_reload = True
+            self._pending_artifacts |= conf_manager.get_changed_artifacts()
+            return "error {}".format(str(e).replace('\n', ' '))
+
+        try:
+            self._reload_services()
+        except Exception as e:
+            return "error {}".format(str(e).replace('\n', ' '))
+
+        return "ok {}".format(len(conf_manager.changed_files))
+
+    def _compact_journal_before_reload(self):
+        # services read the map files, not the journal, must be called under the manager lock
+        if self.reload_orchestrator is not None and self.conf_manager.journal and \
+                (self.conf_manager.changed_files or self._pending_artifacts):
+            self.conf_manager.compact_journal()
+
+    def _reload_services(self):
+        """
+        Reloads services using configs changed by the last command or DirectAdmin changes and by the failed
+        ones before
+        """
+        changed_artifacts = self._pending_artifacts | self.conf_manager.get_changed_artifacts()
+        if self.reload_orchestrator is None or not changed_artifacts:
+            return
+
+        reloaded_services = self.reload_orchestrator.reload(changed_artifacts, self.reload_service_names)
+        self._pending_artifacts = set()
+        if reloaded_services:
+            print("Reloaded: {}".format(', '.join(reloaded_services)))
+
+    def _serve_client(self, client):
+        client.settimeout(10)
+        try:
+            request = ''
+            while not request.endswith('\n'):
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                request += chunk
+
+            response = self.handle_command(request.strip())
+            client.sendall(response + '\n')
+        except socket.error as e:
+            print("Client error: {}".format(e))
+        finally:
+            client.close()
+
+    def _apply_changes(self, changed_users):
+        conf_manager = self.conf_manager
+        try:
+            with conf_manager.get_lock(conf_manager.working_dir, self.lock_timeout):
+                conf_manager.reload_if_changed(self._needs_reload)
+                self._needs_reload = False
+                conf_manager.changed_files = []
+                conf_manager.changed_artifacts = set()
+                conf_manager.rebuild_changed(changed_users)
+                self._compact_journal_before_reload()
+        except Exception as e:
+            self._needs_reload = True
+            self._pending_artifacts |= conf_manager.get_changed_artifacts()
+            print("Failed to apply DirectAdmin changes: {}".format(e))
+            return
+
+        try:
+            self._reload_services()
+        except Exception as e:
+            print("Failed to reload services: {}".format(e))
+
+    def stop(self, *args):
+        self.running = False
+
+    def serve_forever(self):
+        self._server = self._listen()
+        self.running = True
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        print("Serving on {}".format(self.socket_path))
+
+        # users changed since the last apply, None - check all users
+        pending_users = set()
+        apply_at = None if self.watcher else time.time()
+
+        try:
+            while self.running:
+                readers = [self._server]
+                if self.watcher:
+                    readers.append(self.watcher)
+
+                timeout = None if apply_at is None else max(0.0, apply_at - time.time())
+                try:
+                    readable, _, _ = select.select(readers, [], [], timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self._server in readable:
+                    client, _ = self._server.accept()
+                    self._serve_client(client)
+
+                if self.watcher and self.watcher in readable:
+                    changed_users = self.watcher.read_changed_users()
+                    if changed_users is None or pending_users is None:
+                        pending_users = None
+                    else:
+                        pending_users |= changed_users
+                    # wait until DirectAdmin finishes writing user files
+                    apply_at = time.time() + self.settle_time
+
+                if apply_at is not None and time.time() >= apply_at:
+                    if pending_users is None or not self.watcher:
+                        self._apply_changes(None)
+                    elif pending_users:
+                        self._apply_changes(pending_users)
+
+                    pending_users = set()
+                    apply_at = None if self.watcher else time.time() + self.poll_interval
+        finally:
+            self._server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            if self.watcher:
+                self.watcher.close()
+
+
+def send_command(socket_path, command_line, timeout=600):
+    """
+    Sends command to the running daemon
+    :return: number of changed files
+    """
+    assert socket_path, "Socket path must be specified"
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall(command_line + '\n')
+
+        response = ''
+        while not response.endswith('\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    finally:
+        client.close()
+
+    status, _, message = response.strip().partition(' ')
+    if status != 'ok':
+        raise Exception("Daemon error: {}".format(message or 'no response'))
+
+    return int(message)
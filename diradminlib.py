@@ -1,6 +1,27 @@
+import errno
 import os
 import fcntl
 
+from metricslib import metrics
+
+
+DOMAIN_SOURCE_EXTENSIONS = ('conf', 'pointers', 'subdomains', 'ip_list')
+
+
+def get_user_source_files(user_dir):
+    """
+    Returns files DirectAdminUserConfig reads
+    """
+    return [os.path.join(user_dir, 'domains.list')]
+
+
+def get_domain_source_files(user_dir, domain_name):
+    """
+    Returns files DirectAdminUserDomain reads, in DOMAIN_SOURCE_EXTENSIONS order
+    """
+    return [os.path.join(user_dir, 'domains', "%s.%s" % (domain_name, extension))
+            for extension in DOMAIN_SOURCE_EXTENSIONS]
+
 
 def uniq_list(list_obj):
     ptr_map = {}
@@ -10,9 +31,28 @@ def uniq_list(list_obj):
     return sorted(ptr_map.keys())
 
 
+def read_config_lines(file_name):
+    """
+    Reads stripped non-empty lines of DirectAdmin config file under a shared lock
+    :return: list of lines, empty if the file does not exist
+    """
+    try:
+        config_file = open(file_name, 'r')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+    metrics.add('da_files_read')
+    with config_file:
+        fcntl.flock(config_file, fcntl.LOCK_SH)
+
+        return [line.strip() for line in config_file if line.strip()]
+
+
 class DirectAdminUserDomain(object):
     """
-    Configuration of DirectAdmin domain
+    Configuration of DirectAdmin domain, every file is read on the first access
     """
 
     def __init__(self, user_config, domain_name):
@@ -21,81 +61,68 @@ class DirectAdminUserDomain(object):
 
         self.user_config = user_config
         self.domain_name = domain_name
-        self.config = {}
-        self.pointers = []
-        self.subdomains = []
-        self.ips = []
-
-        self._load_subdomains()
-        self._load_pointers()
-        self._load_ips()
-        self._load_config()
+        self.config = None
+        self.pointers = None
+        self.subdomains = None
+        self.ips = None
 
-    def _load_config(self):
-        domain_config_file = os.path.join(self.user_config.user_dir, 'domains', "%s.conf" % self.domain_name)
-        if os.path.exists(domain_config_file):
-            with open(domain_config_file, 'r') as fd_domain_config_file:
-                fcntl.flock(fd_domain_config_file, fcntl.LOCK_EX)
+    def _get_domain_file(self, extension):
+        return os.path.join(self.user_config.user_dir, 'domains', "%s.%s" % (self.domain_name, extension))
 
-                for domain_config in fd_domain_config_file:
-                    domain_config = domain_config.strip()
-                    conf_key, conf_value = domain_config.split('=')
+    def _load_config(self, keys=None):
+        config = {}
+        for domain_config in read_config_lines(self._get_domain_file('conf')):
+            conf_key, _, conf_value = domain_config.partition('=')
+            if keys is None or conf_key in keys:
+                config[conf_key] = conf_value
 
-                    self.config[conf_key] = conf_value
+        return config
 
     def _load_pointers(self):
-        pointers_file = os.path.join(self.user_config.user_dir, 'domains', "%s.pointers" % self.domain_name)
-        if os.path.exists(pointers_file):
-            new_pointers = []
-
-            with open(pointers_file, 'r') as fd_pointers_file:
-                fcntl.flock(fd_pointers_file, fcntl.LOCK_EX)
-
-                for domain_pointer_info in fd_pointers_file:
-                    domain_pointer_info = domain_pointer_info.strip()
-                    domain_pointer, point_type = domain_pointer_info.split('=')
-                    new_pointers.append(domain_pointer)
-
-            self.pointers = uniq_list(self.pointers + new_pointers)
+        # pointer lines are "pointer=alias" or "pointer=pointer"
+        return uniq_list(domain_pointer_info.partition('=')[0]
+                         for domain_pointer_info in read_config_lines(self._get_domain_file('pointers')))
 
     def _load_subdomains(self):
-        subdomains_file = os.path.join(self.user_config.user_dir, 'domains', "%s.subdomains" % self.domain_name)
-        if os.path.exists(subdomains_file):
-            new_subdomains = []
-
-            with open(subdomains_file, 'r') as fd_subdomains_file:
-                fcntl.flock(fd_subdomains_file, fcntl.LOCK_EX)
-
-                for subdomain in fd_subdomains_file:
-                    subdomain = subdomain.strip()
-                    new_subdomains.append(subdomain)
-
-            self.subdomains = uniq_list(self.subdomains + new_subdomains)
+        return uniq_list(read_config_lines(self._get_domain_file('subdomains')))
 
     def _load_ips(self):
-        ips_file = os.path.join(self.user_config.user_dir, 'domains', "%s.ip_list" % self.domain_name)
-        if os.path.exists(ips_file):
-            new_ips = []
-
-            with open(ips_file, 'r') as fd_ips_file:
-                fcntl.flock(fd_ips_file, fcntl.LOCK_EX)
-
-                for newip in fd_ips_file:
-                    newip = newip.strip()
-                    new_ips.append(newip)
-
-            self.ips = uniq_list(self.ips + new_ips)
+        return uniq_list(read_config_lines(self._get_domain_file('ip_list')))
 
     def get_pointers(self):
+        if self.pointers is None:
+            self.pointers = self._load_pointers()
+
         return self.pointers
 
     def get_subdomains(self):
+        if self.subdomains is None:
+            self.subdomains = self._load_subdomains()
+
         return self.subdomains
 
     def get_ips(self):
+        if self.ips is None:
+            self.ips = self._load_ips()
+
         return self.ips
 
-    def get_config(self):
+    def get_config(self, keys=None):
+        """
+        Returns domain config
+        :param keys: return only these keys; the filtered config is read from the file on every call
+        :return: dict of config values
+        """
+        if self.config is not None:
+            if keys is None:
+                return self.config
+            return dict((conf_key, self.config[conf_key]) for conf_key in keys if conf_key in self.config)
+
+        if keys is not None:
+            return self._load_config(keys)
+
+        self.config = self._load_config()
+
         return self.config
 
 
@@ -110,20 +137,23 @@ class DirectAdminUserConfig(object):
 
         self.user_dir = user_dir
         self.domains = {}
+        self.domain_names = None
         self.user_name = os.path.basename(user_dir)
 
-        self._load()
-
     def _load(self):
-        domains_list = os.path.join(self.user_dir, 'domains.list')
-        if os.path.exists(domains_list):
+        self.domain_names = uniq_list(read_config_lines(os.path.join(self.user_dir, 'domains.list')))
+
+    def get_domain_names(self):
+        if self.domain_names is None:
+            self._load()
+
+        return self.domain_names
 
-            with open(domains_list, 'r') as fd_domains_list:
-                fcntl.flock(fd_domains_list, fcntl.LOCK_EX)
+    def get_domain(self, domain_name):
+        if domain_name not in self.domains:
+            self.domains[domain_name] = DirectAdminUserDomain(self, domain_name)
 
-                for domain in fd_domains_list:
-                    domain = domain.strip()
-                    self.domains[domain] = DirectAdminUserDomain(self, domain)
+        return self.domains[domain_name]
 
     def get_domains(self):
-        return self.domains.values()
+        return [self.get_domain(domain_name) for domain_name in self.get_domain_names()]
@@ -0,0 +1,185 @@
+import errno
+import os
+import shutil
+
+from metricslib import metrics
+
+GENERATIONS_DIR_NAME = 'generations'
+CURRENT_LINK_NAME = 'current'
+# name of the generation a generation was linked from, it is rolled back to
+PARENT_NAME = '.parent'
+
+
+def link_tree(source_dir, target_dir, names):
+    """
+    Hard links files of the source dir to the target dir, directories are created, temporary files are skipped
+    :param names: files and directories of the source dir to link, missing ones are skipped
+    :return: number of linked files
+    """
+    linked_files = 0
+    for name in names:
+        source_path = os.path.join(source_dir, name)
+        if os.path.isfile(source_path):
+            os.link(source_path, os.path.join(target_dir, name))
+            linked_files += 1
+            continue
+
+        for dir_path, dir_names, file_names in os.walk(source_path):
+            target_path = os.path.join(target_dir, os.path.relpath(dir_path, source_dir))
+            os.mkdir(target_path)
+
+            for file_name in file_names:
+                if not file_name.endswith('.tmp'):
+                    os.link(os.path.join(dir_path, file_name), os.path.join(target_path, file_name))
+                    linked_files += 1
+
+    metrics.add('generation_files_linked', linked_files)
+
+    return linked_files
+
+
+class GenerationStore(object):
+    """
+    Generations of the generated configs: root_dir/generations/NNNNNNNN directories and root_dir/current
+    symlink to the published one. A generation is built from hard links of the current one, files are
+    replaced by rename, so published generations never change. Every generation records its parent, the
+    generation published when it was created.
+    """
+
+    def __init__(self, root_dir, keep=3):
+        """
+        :param root_dir: directory with the generations and the current symlink
+        :param keep: number of generations kept for rollback, including the current one
+        """
+        assert root_dir, "Root dir must be specified"
+        assert keep > 0, "At least one generation must be kept"
+
+        self.root_dir = root_dir
+        self.keep = keep
+        self.generations_dir = os.path.join(root_dir, GENERATIONS_DIR_NAME)
+        self.current_link = os.path.join(root_dir, CURRENT_LINK_NAME)
+
+    def get_current(self):
+        """
+        Returns name of the published generation or None
+        """
+        try:
+            return os.path.basename(os.readlink(self.current_link))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EINVAL):
+                raise
+            return None
+
+    def get_generations(self):
+        """
+        Returns sorted names of all generations
+        """
+        try:
+            return sorted(name for name in os.listdir(self.generations_dir) if name.isdigit())
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def get_parent(self, generation):
+        """
+        Returns name of the generation the generation was created from or None, generations created without
+        the parent recorded fall back to the previous one
+        """
+        try:
+            with open(os.path.join(self.generations_dir, generation, PARENT_NAME), 'r') as parent_file:
+                return parent_file.read().strip() or None
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        previous = [name for name in self.get_generations() if name < generation]
+
+        return previous[-1] if previous else None
+
+    def create(self, names, seed_dir=None):
+        """
+        Creates the next generation from hard links of the current one
+        :param names: files and directories of a generation
+        :param seed_dir: directory to link the files from if no generation was published yet
+        :return: path of the new generation
+        """
+        generations = self.get_generations()
+        generation_dir = os.path.join(self.generations_dir,
+                                      '%08d' % (int(generations[-1]) + 1 if generations else 1))
+        if not os.path.isdir(self.generations_dir):
+            os.makedirs(self.generations_dir, 0o711)
+        os.mkdir(generation_dir, 0o711)
+
+        current = self.get_current()
+        source_dir = os.path.join(self.generations_dir, current) if current else seed_dir
+        try:
+            with open(os.path.join(generation_dir, PARENT_NAME), 'w') as parent_file:
+                parent_file.write(current or '')
+
+            if source_dir:
+                link_tree(source_dir, generation_dir, names)
+        except:
+            shutil.rmtree(generation_dir, ignore_errors=True)
+            raise
+
+        return generation_dir
+
+    def publish(self, generation_dir):
+        """
+        Makes the generation current with a single rename of the symlink and removes old generations
+        """
+        assert generation_dir, "Generation must be specified"
+
+        self._switch(os.path.basename(generation_dir))
+        self.prune()
+
+    def discard(self, generation_dir):
+        """
+        Removes a generation that was not published
+        """
+        assert generation_dir, "Generation must be specified"
+
+        shutil.rmtree(generation_dir, ignore_errors=True)
+
+    def rollback(self):
+        """
+        Makes the parent of the current generation current, generations rolled back from are skipped
+        :return: name of the current generation
+        """
+        current = self.get_current()
+        if current is None:
+            raise Exception("No published generation to roll back")
+
+        parent = self.get_parent(current)
+        if parent is None or parent not in self.get_generations():
+            raise Exception("No generation before {} to roll back to".format(current))
+
+        self._switch(parent)
+
+        return parent
+
+    def prune(self):
+        """
+        Removes generations over the kept number, the current one and its closest ancestors are kept
+        """
+        generations = self.get_generations()
+
+        kept = set()
+        generation = self.get_current()
+        while generation is not None and generation in generations and len(kept) < self.keep:
+            kept.add(generation)
+            generation = self.get_parent(generation)
+
+        for generation in generations:
+            if generation not in kept:
+                shutil.rmtree(os.path.join(self.generations_dir, generation), ignore_errors=True)
+
+    def _switch(self, generation):
+        tmp_link = '%s.%d.tmp' % (self.current_link, os.getpid())
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+
+        # relative target keeps the tree valid when copied to other hosts
+        os.symlink(os.path.join(GENERATIONS_DIR_NAME, generation), tmp_link)
+        os.rename(tmp_link, self.current_link)
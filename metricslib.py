@@ -0,0 +1,120 @@
+import functools
+import json
+import time
+
+
+class RunMetrics(object):
+    """
+    Phase timings and counters of a single run
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+
+    def reset(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+
+    def add(self, counter_name, value=1):
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+
+    def add_time(self, phase_name, seconds):
+        """
+        Adds time spent in the phase, nested phases are counted in their parent phases too
+        """
+        phase = self.phases.get(phase_name)
+        if phase is None:
+            phase = self.phases[phase_name] = {'seconds': 0.0, 'calls': 0}
+
+        phase['seconds'] += seconds
+        phase['calls'] += 1
+
+    def phase(self, phase_name):
+        return _Phase(self, phase_name)
+
+    def to_dict(self, **labels):
+        """
+        :param labels: extra values of the run, e.g. action
+        """
+        run = dict(labels)
+        run.update({
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 6),
+            'phases': dict((phase_name, {'seconds': round(phase['seconds'], 6), 'calls': phase['calls']})
+                           for phase_name, phase in self.phases.items()),
+            'counters': self.counters,
+        })
+
+        return run
+
+    def to_json(self, **labels):
+        """
+        Returns the run as a single JSON line
+        """
+        return json.dumps(self.to_dict(**labels), sort_keys=True)
+
+    def to_prometheus(self, prefix='nginxdirect', **labels):
+        """
+        Returns the run in Prometheus text format for node_exporter textfile collector
+        """
+        label_pairs = ['%s="%s"' % (label, str(value).replace('"', '\\"')) for label, value in sorted(labels.items())]
+
+        def sample(name, value, extra_label=None):
+            pairs = label_pairs + ([extra_label] if extra_label else [])
+            return '%s_%s%s %s\n' % (prefix, name, '{%s}' % ','.join(pairs) if pairs else '', repr(value))
+
+        lines = ['# TYPE %s_last_run_timestamp_seconds gauge\n' % prefix,
+                 sample('last_run_timestamp_seconds', self.started),
+                 '# TYPE %s_last_run_seconds gauge\n' % prefix,
+                 sample('last_run_seconds', time.time() - self.started),
+                 '# TYPE %s_phase_seconds gauge\n' % prefix]
+
+        for phase_name, phase in sorted(self.phases.items()):
+            lines.append(sample('phase_seconds', phase['seconds'], 'phase="%s"' % phase_name))
+
+        lines.append('# TYPE %s_phase_calls gauge\n' % prefix)
+        for phase_name, phase in sorted(self.phases.items()):
+            lines.append(sample('phase_calls', phase['calls'], 'phase="%s"' % phase_name))
+
+        for counter_name, value in sorted(self.counters.items()):
+            lines.append('# TYPE %s_%s gauge\n' % (prefix, counter_name))
+            lines.append(sample(counter_name, value))
+
+        return ''.join(lines)
+
+
+class _Phase(object):
+    def __init__(self, run_metrics, phase_name):
+        self.run_metrics = run_metrics
+        self.phase_name = phase_name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.run_metrics.add_time(self.phase_name, time.time() - self.started)
+        return False
+
+
+# metrics of the current process run
+metrics = RunMetrics()
+
+
+def timed(phase_name):
+    """
+    Decorator adding the function run time to the phase of the process metrics
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.phase(phase_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,8 +1,454 @@
 import errno
 import fcntl
+import hashlib
 import os
 import re
-from time import sleep
+import time
+
+from metricslib import metrics
+from metricslib import timed
+
+
+_map_header_re = re.compile(r'\s*map\s+\$([^\s{]+)\s+\$([^\s{]+)')
+
+UNASSIGNED_SHARD = '_unassigned'
+
+LOCK_RETRY_MIN_DELAY = 0.001
+LOCK_RETRY_MAX_DELAY = 0.05
+
+MAP_HASH_DEFAULT_MAX_SIZE = 2048
+MAP_HASH_DEFAULT_BUCKET_SIZE = 64
+MAP_HASH_MAX_BUCKET_SIZE = 32768
+_POINTER_SIZE = 8
+
+
+def parent_domain_keys(map_key):
+    """
+    Returns all parent domain keys of the map key: .a.b.com -> .b.com, .com
+    :param map_key: map key (host name)
+    """
+    dot_pos = map_key.find('.', 1)
+    while dot_pos != -1:
+        yield map_key[dot_pos:]
+        dot_pos = map_key.find('.', dot_pos + 1)
+
+
+def lock_file(lock_fd, timeout, operation=fcntl.LOCK_EX):
+    """
+    Locks the file with flock, retrying with exponential backoff so the waiter wakes soon after release
+    :param lock_fd: open file
+    :param timeout: seconds to wait for the lock
+    :param operation: fcntl.LOCK_EX or fcntl.LOCK_SH
+    :return: seconds waited
+    """
+    started = time.time()
+    delay = LOCK_RETRY_MIN_DELAY
+
+    while True:
+        try:
+            fcntl.flock(lock_fd, operation | fcntl.LOCK_NB)
+            break
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        waited = time.time() - started
+        if waited >= timeout:
+            raise IOError(errno.EAGAIN, "Can't acquire lock in %s seconds" % timeout)
+
+        time.sleep(min(delay, timeout - waited))
+        delay = min(delay * 2, LOCK_RETRY_MAX_DELAY)
+
+    waited = time.time() - started
+    metrics.add('lock_wait_seconds', waited)
+
+    return waited
+
+
+class FileLock(object):
+    """
+    Exclusive lock of a lock file held for a load-modify-save cycle
+    """
+
+    def __init__(self, file_name, timeout=60):
+        assert file_name, "Lock file must be specified"
+
+        self.file_name = file_name
+        self.timeout = timeout
+        self.wait_seconds = None
+        self._lock_file = None
+
+    def acquire(self):
+        """
+        :return: seconds waited for the lock
+        """
+        assert self._lock_file is None, "Lock is already acquired"
+
+        lock_fd = open(self.file_name, 'a')
+        try:
+            self.wait_seconds = lock_file(lock_fd, self.timeout)
+        except:
+            lock_fd.close()
+            raise
+
+        self._lock_file = lock_fd
+
+        return self.wait_seconds
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+        return False
+
+
+class NginxTemplate(object):
+    """
+    Config template compiled into literal parts and {placeholder} positions, rendered with a single join
+    """
+    RENDER_CACHE_SIZE = 4096
+
+    def __init__(self, template, placeholders):
+        assert placeholders, "Template placeholders must be specified"
+
+        self.placeholders = tuple(placeholders)
+        self.template_digest = hashlib.sha1(template).hexdigest()
+        self._render_cache = {}
+
+        # even parts are literals, odd parts are placeholder names
+        placeholder_pattern = r'\{(%s)\}' % '|'.join(re.escape(placeholder) for placeholder in self.placeholders)
+        self._parts = re.split(placeholder_pattern, template)
+        self._placeholder_positions = range(1, len(self._parts), 2)
+
+    def digest(self, values):
+        """
+        Returns hash of the template and substitution values identifying rendered contents
+        :param values: dict of placeholder values
+        """
+        return hashlib.sha1('\0'.join((self.template_digest,) + tuple(values[placeholder]
+                                                                      for placeholder in self.placeholders))).hexdigest()
+
+    def render(self, values):
+        """
+        Renders template, the result is cached by substitution values
+        :param values: dict of placeholder values
+        :return: rendered contents
+        """
+        cache_key = tuple(values[placeholder] for placeholder in self.placeholders)
+        if cache_key in self._render_cache:
+            return self._render_cache[cache_key]
+
+        parts = list(self._parts)
+        for position in self._placeholder_positions:
+            parts[position] = values[parts[position]]
+
+        if len(self._render_cache) >= self.RENDER_CACHE_SIZE:
+            self._render_cache.clear()
+        self._render_cache[cache_key] = contents = ''.join(parts)
+
+        return contents
+
+    @staticmethod
+    def from_file(file_name, placeholders):
+        assert file_name, "File must be specified"
+
+        with open(file_name, 'r') as template_file:
+            return NginxTemplate(template_file.read(), placeholders)
+
+
+def load_map_sections(file_name, map_sections):
+    """
+    Loads several map sections from one file in a single pass
+    :param file_name: map file
+    :param map_sections: NginxMap objects to load, matched by map key and variable
+    :return: list of NginxMap objects whose sections were found in the file
+    """
+    assert file_name, "File must be specified"
+
+    sections_by_header = dict(((map_section.map_key, map_section.map_variable), map_section)
+                              for map_section in map_sections)
+
+    with open(file_name, 'r') as map_file:
+        fcntl.flock(map_file, fcntl.LOCK_SH)
+        map_contents = map_file.read()
+
+    metrics.add('files_read')
+    metrics.add('bytes_read', len(map_contents))
+    map_lines = map_contents.splitlines()
+
+    loaded_sections = []
+    section = None
+    section_items = None
+    for line in map_lines:
+        fields = line.split(None, 1)
+        if not fields:
+            continue
+
+        if fields[0] == 'map':
+            section = None
+            match_object = _map_header_re.match(line)
+            if match_object:
+                section = sections_by_header.get(match_object.groups())
+                if section is not None:
+                    # indexes are rebuilt on the next lookup
+                    section._keys_by_value = None
+                    section._keys_by_parent = None
+                    section._keys_by_shard = None
+                    section_items = section.items
+                    loaded_sections.append(section)
+        elif fields[0] == '}':
+            section = None
+        elif section is not None and len(fields) == 2 and line[0].isspace():
+            map_variable = fields[1].rstrip()
+            if not map_variable.endswith(';'):
+                continue
+
+            map_variable = map_variable[:-1].rstrip()
+            if fields[0] == 'default':
+                section.default_value = map_variable
+            elif fields[0] != 'include':
+                section_items[fields[0]] = map_variable
+
+    return loaded_sections
+
+
+def replace_file_contents(file_name, contents):
+    """
+    Atomically replaces file contents: writes a temporary file and renames it over the target.
+    Nothing is written if the file already has the same contents.
+    :return: True if the file was written
+    """
+    assert file_name, "File must be specified"
+
+    try:
+        if os.path.getsize(file_name) == len(contents):
+            with open(file_name, 'r') as current_file:
+                metrics.add('files_read')
+                metrics.add('bytes_read', len(contents))
+                if current_file.read() == contents:
+                    return False
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    tmp_file_name = '%s.%d.tmp' % (file_name, os.getpid())
+    try:
+        with open(tmp_file_name, 'w') as tmp_file:
+            tmp_file.write(contents)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+        os.rename(tmp_file_name, file_name)
+    except:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+    metrics.add('files_written')
+    metrics.add('bytes_written', len(contents))
+
+    return True
+
+
+def append_map_journal(file_name, records):
+    """
+    Appends map item changes to the journal and syncs it to disk
+    :param records: list of (map variable, map key, value or None for removed items, shard, previous shard)
+    """
+    assert file_name, "File must be specified"
+
+    contents = ''.join('%s\t%s\t%s\t%s\t%s\n' % (map_variable, map_key, '' if value is None else value,
+                                                   shard, previous_shard)
+                       for map_variable, map_key, value, shard, previous_shard in records)
+
+    with open(file_name, 'a') as journal_file:
+        journal_file.write(contents)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+    metrics.add('journal_records_written', len(records))
+    metrics.add('bytes_written', len(contents))
+
+
+def read_map_journal(file_name):
+    """
+    Reads map item changes written by append_map_journal(), a record cut by a crash is skipped
+    :return: list of (map variable, map key, value or None for removed items, shard, previous shard)
+    """
+    assert file_name, "File must be specified"
+
+    with open(file_name, 'r') as journal_file:
+        contents = journal_file.read()
+
+    metrics.add('files_read')
+    metrics.add('bytes_read', len(contents))
+
+    records = []
+    for line in contents.split('\n')[:-1]:
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+
+        map_variable, map_key, value, shard, previous_shard = fields
+        records.append((map_variable, map_key, value or None, shard, previous_shard))
+
+    return records
+
+
+def _hash_element_size(key_length):
+    # NGX_HASH_ELT_SIZE: value pointer, key length and the key aligned to the pointer size
+    return _POINTER_SIZE + ((key_length + 2 + _POINTER_SIZE - 1) & ~(_POINTER_SIZE - 1))
+
+
+def _hash_key(name):
+    # ngx_hash_key_lc() of 64-bit nginx
+    key = 0
+    for char in name.lower():
+        key = (key * 31 + ord(char)) & 0xffffffffffffffff
+    return key
+
+
+def get_map_hashes(section):
+    """
+    Returns the hashes nginx builds for the map section: the exact hash and a hash of every level of the
+    wildcard names. Every level of .example.com and *.example.com keys hashes the labels from the right,
+    www.example.* keys from the left, as ngx_hash_wildcard_init() does.
+    :param section: NginxMap object
+    :return: list of hashes, a hash is a list of (key hash, element size)
+    """
+    exact_names = []
+    head_names = []
+    tail_names = []
+    for map_key in section.items:
+        if section.is_hostnames and len(map_key) > 1 and map_key[0] == '.':
+            head_names.append(tuple(reversed(map_key[1:].split('.'))))
+        elif section.is_hostnames and len(map_key) > 2 and map_key.startswith('*.'):
+            head_names.append(tuple(reversed(map_key[2:].split('.'))))
+        elif section.is_hostnames and len(map_key) > 2 and map_key.endswith('.*'):
+            tail_names.append(tuple(map_key[:-2].split('.')))
+        else:
+            exact_names.append(map_key)
+
+    hashes = []
+    if exact_names:
+        hashes.append([(_hash_key(name), _hash_element_size(len(name))) for name in exact_names])
+
+    levels = [names for names in (head_names, tail_names) if names]
+    while levels:
+        next_labels = {}
+        for labels in levels.pop():
+            names = next_labels.setdefault(labels[0], [])
+            if len(labels) > 1:
+                names.append(labels[1:])
+
+        hashes.append([(_hash_key(label), _hash_element_size(len(label))) for label in next_labels])
+        levels.extend(names for names in next_labels.values() if names)
+
+    return hashes
+
+
+def _get_hash_search_start(names_count, max_size, bucket_size):
+    # ngx_hash_init() starts from the size filling buckets with elements of 2 pointers
+    start = names_count // ((bucket_size - _POINTER_SIZE) // (2 * _POINTER_SIZE)) or 1
+    if max_size > 10000 and names_count and max_size // names_count < 100:
+        start = max_size - 1000
+
+    return start
+
+
+def _is_hash_size_fit(hash_elements, size, bucket_size):
+    # no bucket overflows, every bucket ends with a null pointer
+    bucket_lengths = {}
+    for key_hash, element_size in hash_elements:
+        bucket = key_hash % size
+        bucket_lengths[bucket] = bucket_lengths.get(bucket, 0) + element_size
+        if bucket_lengths[bucket] > bucket_size - _POINTER_SIZE:
+            return False
+
+    return True
+
+
+def find_hash_size(hash_elements, max_size, bucket_size):
+    """
+    Replays the search of ngx_hash_init() for the number of hash buckets
+    :param hash_elements: hash returned by get_map_hashes()
+    :return: number of buckets nginx builds the hash with or None if nginx fails to build it
+    """
+    if any(element_size + _POINTER_SIZE > bucket_size for key_hash, element_size in hash_elements):
+        return None
+
+    for size in xrange(_get_hash_search_start(len(hash_elements), max_size, bucket_size), max_size + 1):
+        if _is_hash_size_fit(hash_elements, size, bucket_size):
+            return size
+
+    return None
+
+
+def compute_map_hash_sizes(map_sections):
+    """
+    Computes map_hash_max_size and map_hash_bucket_size nginx builds every hash of the map sections with.
+    The smallest bucket size fitting the longest key is doubled until a max size up to twice the names of
+    the biggest hash fits every hash, nginx then finds a size not over the max size.
+    :param map_sections: NginxMap objects
+    :return: (map_hash_max_size, map_hash_bucket_size)
+    """
+    hashes = [hash_elements for section in map_sections for hash_elements in get_map_hashes(section)]
+    if not hashes:
+        return MAP_HASH_DEFAULT_MAX_SIZE, MAP_HASH_DEFAULT_BUCKET_SIZE
+
+    max_element_size = max(element_size for hash_elements in hashes for key_hash, element_size in hash_elements)
+    max_hash_length = max(sum(element_size for key_hash, element_size in hash_elements)
+                          for hash_elements in hashes)
+    max_names = max(len(hash_elements) for hash_elements in hashes)
+
+    bucket_size = MAP_HASH_DEFAULT_BUCKET_SIZE
+    while bucket_size < max_element_size + _POINTER_SIZE:
+        bucket_size *= 2
+
+    # nginx rejects bucket sizes over 64k without a cache line
+    while bucket_size <= MAP_HASH_MAX_BUCKET_SIZE:
+        # buckets filled by half on average
+        max_size = max(MAP_HASH_DEFAULT_MAX_SIZE, max_hash_length * 2 // (bucket_size - _POINTER_SIZE) + 1)
+        while max_size <= max(MAP_HASH_DEFAULT_MAX_SIZE, max_names * 2):
+            if all(_get_hash_search_start(len(hash_elements), max_size, bucket_size) <= max_size and
+                   _is_hash_size_fit(hash_elements, max_size, bucket_size) for hash_elements in hashes):
+                return max_size, bucket_size
+            max_size *= 2
+
+        bucket_size *= 2
+
+    raise Exception("Can't find map hash sizes for {} names".format(max_names))
+
+
+def _load_map_items(map_lines, items):
+    """
+    Reads map item lines of a shard file
+    :param map_lines: lines of the shard file
+    :param items: dict to add items to
+    """
+    for line in map_lines:
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            continue
+
+        map_variable = fields[1].rstrip()
+        if map_variable.endswith(';'):
+            items[fields[0]] = map_variable[:-1].rstrip()
+
+
+def _discard_indexed(index, index_key, map_key):
+    keys = index.get(index_key)
+    if keys is not None:
+        keys.discard(map_key)
+        if not keys:
+            del index[index_key]
 
 
 class NginxMap(object):
@@ -12,24 +458,53 @@ class NginxMap(object):
 
         self.items = {}
         self.is_hostnames = True
+        self.default_value = '""'
+        self._keys_by_value = None
+        self._keys_by_parent = None
+        self.item_shards = {}
+        self._keys_by_shard = None
+        self._dirty_shards = set()
+        self._journal_origins = None
         self.map_item_format = '\t%-45s\t%s;\n'
-        self.section_key_pattern = r'\s+([^\s]+)\s+([^;]+)'
         self.map_key = map_key[1:] if map_key.startswith('$') else map_key
         self.map_variable = map_variable[1:] if map_variable.startswith('$') else map_variable
 
     def find_keys_by_value(self, value):
-        for map_key in list(self.items):
-            if self.items[map_key] == value:
-                yield map_key
-
-    def add_item(self, map_key, map_variable):
+        if self._keys_by_value is None:
+            self._build_indexes()
+
+        for map_key in list(self._keys_by_value.get(value, ())):
+            yield map_key
+
+    def find_keys_by_parent(self, parent_key):
+        """
+        Returns keys located below the parent domain, e.g. .sub.domain.com for .domain.com
+        :param parent_key: parent domain key, must start with a dot
+        """
+        assert parent_key, "Parent key must be specified"
+
+        if self._keys_by_parent is None:
+            self._build_indexes()
+
+        for map_key in list(self._keys_by_parent.get(parent_key, ())):
+            yield map_key
+
+    def add_item(self, map_key, map_variable, shard=UNASSIGNED_SHARD):
+        """
+        Adds map item
+        :param shard: name of the shard file the item is saved to in the sharded layout, e.g. user name
+        """
         assert map_key, "Map section key must be specified"
         assert map_variable, "Map section variable must be specified"
 
+        self._journal_item(map_key)
         if map_key in self.items:
             self.del_item(map_key)
 
         self.items[map_key] = map_variable
+        self._index_item(map_key, map_variable)
+        self._set_item_shard(map_key, shard)
+        metrics.add('map_items_added')
 
     def has_item(self, map_key):
         assert map_key, "Map section key must be specified"
@@ -42,8 +517,12 @@ class NginxMap(object):
         if map_key not in self.items:
             raise Exception("Key %s does not exists" % map_key)
 
+        self._journal_item(map_key)
         if map_key in self.items:
+            self._unindex_item(map_key, self.items[map_key])
             del self.items[map_key]
+            self._set_item_shard(map_key, None)
+            metrics.add('map_items_removed')
 
     def update_item(self, map_key, new_map_variable):
         assert map_key, "Map section key must be specified"
@@ -51,69 +530,247 @@ class NginxMap(object):
         if map_key not in self.items:
             raise Exception("Key %s does not exists" % map_key)
 
+        self._journal_item(map_key)
         if map_key in self.items:
+            self._unindex_item(map_key, self.items[map_key])
             self.items[map_key] = new_map_variable
+            self._index_item(map_key, new_map_variable)
+            self._dirty_shards.add(self.item_shards.get(map_key, UNASSIGNED_SHARD))
 
+    @timed('map_load')
     def load(self, file_name):
         assert file_name, "File must be specified"
         assert os.path.exists(file_name), "Map file does not exists"
 
-        section_header_pattern = r'map\s+\$%s\s+\$%s' % (self.map_key, self.map_variable)
-
-        loading = False
-        with open(file_name, 'r') as map_file:
-            fcntl.flock(map_file, fcntl.LOCK_EX)
-            for line in map_file:
-                if loading:
-                    if re.match(r'\s*map\s+', line):
-                        break
-                    match_object = re.match(self.section_key_pattern, line)
-                    if match_object:
-                        self.items[match_object.group(1)] = match_object.group(2)
-                elif re.match(section_header_pattern, line):
-                    loading = True
+        return bool(load_map_sections(file_name, [self]))  # return False if there is no such section
+
+    def render(self, include_pattern=None):
+        """
+        Returns map section contents
+        :param include_pattern: include shard files matching the pattern instead of listing the items
+        """
+        map_lines = ['map $%s $%s {\n' % (self.map_key, self.map_variable)]
+
+        if self.is_hostnames:
+            map_lines.append('\thostnames;\n')
+
+        map_lines.append(self.map_item_format % ('default', self.items.get('default', self.default_value)))
+
+        if include_pattern is not None:
+            map_lines.append('\tinclude %s;\n' % include_pattern)
+        else:
+            for item_key in sorted(self.items):
+                if item_key == 'default':
                     continue
+                map_lines.append(self.map_item_format % (item_key, self.items[item_key]))
+
+        map_lines.append('}\n\n')
+
+        return ''.join(map_lines)
 
-        return loading  # return False if there is no such section
+    def render_shard(self, shard):
+        """
+        Returns item lines of the shard
+        """
+        if self._keys_by_shard is None:
+            self._build_shard_index()
 
+        return ''.join(self.map_item_format % (item_key, self.items[item_key])
+                       for item_key in sorted(self._keys_by_shard.get(shard, ())))
+
+    @timed('map_save')
     def save(self, file_name):
+        """
+        Saves map section to the file unless the file already has the same contents
+        :return: True if the file was written
+        """
         assert file_name, "File must be specified"
 
-        with open(file_name, 'w') as map_file:
+        with open(file_name, 'a') as map_file:
             self._lock(map_file, 30)
 
-            map_file.write('map $%s $%s {\n' % (self.map_key, self.map_variable))
-
-            if self.is_hostnames:
-                map_file.write('\thostnames;\n')
-
-            if 'default' in self.items:
-                map_file.write(self.map_item_format % ('default', self.items['default']))
-                del self.items['default']
-            else:
-                map_file.write(self.map_item_format % ('default', '""'))
+            self._dirty_shards.clear()
+            return replace_file_contents(file_name, self.render())
+
+    @timed('map_save')
+    def save_shards(self, file_name, shards_dir, include_pattern):
+        """
+        Saves map section header including shard files and the shards changed since the last save
+        :param file_name: map section header file
+        :param shards_dir: directory with a file per shard
+        :param include_pattern: shard files pattern as nginx resolves it, e.g. hosting/maps/users/*.conf
+        :return: list of written or removed files
+        """
+        assert file_name, "File must be specified"
+        assert shards_dir, "Shards dir must be specified"
+        assert include_pattern, "Include pattern must be specified"
 
-            for item_key in sorted(self.items):
-                map_file.write(self.map_item_format % (item_key, self.items[item_key]))
+        changed_files = []
+        with open(file_name, 'a') as map_file:
+            self._lock(map_file, 30)
 
-            map_file.write('}\n\n')
+            if replace_file_contents(file_name, self.render(include_pattern)):
+                changed_files.append(file_name)
+
+            if self._keys_by_shard is None:
+                self._build_shard_index()
+
+            for shard in sorted(self._dirty_shards):
+                shard_file_name = os.path.join(shards_dir, '%s.conf' % shard)
+                if shard in self._keys_by_shard:
+                    if replace_file_contents(shard_file_name, self.render_shard(shard)):
+                        changed_files.append(shard_file_name)
+                elif os.path.exists(shard_file_name):
+                    os.remove(shard_file_name)
+                    changed_files.append(shard_file_name)
+
+            self._dirty_shards.clear()
+
+        return changed_files
+
+    @timed('map_load')
+    def load_shards(self, shards_dir):
+        """
+        Loads items from shard files saved by save_shards()
+        :param shards_dir: directory with a file per shard
+        """
+        assert shards_dir, "Shards dir must be specified"
+
+        for shard_file_name in os.listdir(shards_dir):
+            if not shard_file_name.endswith('.conf'):
+                continue
+
+            shard = shard_file_name[:-len('.conf')]
+            shard_items = {}
+            with open(os.path.join(shards_dir, shard_file_name), 'r') as shard_file:
+                fcntl.flock(shard_file, fcntl.LOCK_SH)
+                shard_contents = shard_file.read()
+
+            metrics.add('files_read')
+            metrics.add('bytes_read', len(shard_contents))
+            _load_map_items(shard_contents.splitlines(), shard_items)
+
+            self.items.update(shard_items)
+            self.item_shards.update(dict.fromkeys(shard_items, shard))
+
+        self._keys_by_value = None
+        self._keys_by_parent = None
+        self._keys_by_shard = None
+
+    def get_dirty_shards(self):
+        """
+        Returns shards changed since the last save
+        """
+        return sorted(self._dirty_shards)
+
+    def mark_shards_dirty(self, shards=None):
+        """
+        Makes the next save_shards() write the shards, e.g. after the map was loaded from a map file
+        :param shards: shards to write, all shards if None
+        """
+        if shards is None:
+            shards = (self.item_shards.get(map_key, UNASSIGNED_SHARD) for map_key in self.items)
+
+        self._dirty_shards.update(shards)
+
+    def start_journal(self):
+        """
+        Starts recording item changes returned by pop_journal()
+        """
+        self._journal_origins = {}
+
+    def pop_journal(self):
+        """
+        Returns net item changes since start_journal() or the last pop_journal(), items changed back are skipped
+        :return: list of (map key, value or None for removed items, shard, previous shard)
+        """
+        assert self._journal_origins is not None, "Journal must be started"
+
+        records = []
+        for map_key, (origin_value, origin_shard) in sorted(self._journal_origins.items()):
+            value = self.items.get(map_key)
+            shard = self.item_shards.get(map_key, UNASSIGNED_SHARD)
+            # items loaded from a plain map file have no shard, which is not a change of the item
+            if value == origin_value and (value is None or shard == origin_shard or
+                                          origin_shard == UNASSIGNED_SHARD):
+                continue
+
+            records.append((map_key, value, shard, origin_shard))
+
+        self._journal_origins = {}
+
+        return records
+
+    def replay_journal(self, records):
+        """
+        Applies item changes returned by pop_journal(), items removed already are skipped
+        """
+        for map_key, value, shard, origin_shard in records:
+            if value is not None:
+                self.add_item(map_key, value, shard)
+            elif map_key in self.items:
+                self.del_item(map_key)
+
+    def _journal_item(self, map_key):
+        # the item state before the first change is compared with the state on pop_journal()
+        if self._journal_origins is not None and map_key not in self._journal_origins:
+            self._journal_origins[map_key] = (self.items.get(map_key),
+                                              self.item_shards.get(map_key, UNASSIGNED_SHARD))
+
+    def _build_indexes(self):
+        self._keys_by_value = {}
+        self._keys_by_parent = {}
+
+        for map_key, map_variable in self.items.items():
+            self._index_item(map_key, map_variable)
+
+    def _build_shard_index(self):
+        self._keys_by_shard = {}
+
+        for map_key in self.items:
+            self._keys_by_shard.setdefault(self.item_shards.get(map_key, UNASSIGNED_SHARD), set()).add(map_key)
+
+    def _set_item_shard(self, map_key, shard):
+        """
+        Moves the item to the shard, None removes the item from its shard
+        """
+        current_shard = self.item_shards.pop(map_key, UNASSIGNED_SHARD)
+        self._dirty_shards.add(current_shard)
+        if self._keys_by_shard is not None:
+            _discard_indexed(self._keys_by_shard, current_shard, map_key)
+
+        if shard is None:
+            return
+
+        if shard != UNASSIGNED_SHARD:
+            self.item_shards[map_key] = shard
+        self._dirty_shards.add(shard)
+        if self._keys_by_shard is not None:
+            self._keys_by_shard.setdefault(shard, set()).add(map_key)
+
+    def _index_item(self, map_key, map_variable):
+        # indexes are built on the first lookup only
+        if self._keys_by_value is None:
+            return
+
+        self._keys_by_value.setdefault(map_variable, set()).add(map_key)
+        for parent_key in parent_domain_keys(map_key):
+            self._keys_by_parent.setdefault(parent_key, set()).add(map_key)
+
+    def _unindex_item(self, map_key, map_variable):
+        if self._keys_by_value is None:
+            return
+
+        _discard_indexed(self._keys_by_value, map_variable, map_key)
+        for parent_key in parent_domain_keys(map_key):
+            _discard_indexed(self._keys_by_parent, parent_key, map_key)
 
     def _lock(self, fd, timeout=10):
         assert fd
 
-        retries = timeout
-        while retries >= 0:
-            try:
-                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return True
-            except IOError as e:
-                if e.errno != errno.EAGAIN or e.errno != errno.EACCES:
-                    retries -= 1
-                    sleep(1)
-                else:
-                    raise e
-
-        raise IOError("Can't acquire lock.")
+        lock_file(fd, timeout)
+
+        return True
 
     @staticmethod
     def from_file(map_key, map_variable, file_name):
@@ -23,7 +23,16 @@
 # for Nginx to parametrize virtual hosts. It supports SSL.
 #
 # usage: nginxvhostctl.py [-h] -o OUT_CONFIG_DIR [-s DA_USERS_CONFIG_DIR]
-# [--rebuild-all | -r REBUILD_USER | -d DELETE_USER]
+# [--rebuild-all | --rebuild-changed | -r REBUILD_USER [REBUILD_USER ...] |
+# -d DELETE_USER [DELETE_USER ...] | --batch BATCH_FILE | --daemon | --rollback] [-j JOBS]
+# [--unchanged-exit-code UNCHANGED_EXIT_CODE] [--socket SOCKET_PATH] [--connect]
+# [--poll-interval POLL_INTERVAL] [--no-inotify]
+# [--coalesce-window COALESCE_WINDOW] [--reload-services RELOAD_SERVICES]
+# [--reload-config RELOAD_CONFIG] [--min-reload-interval MIN_RELOAD_INTERVAL] [--sharded]
+# [--layout {separate,combined}] [--group-ssl] [--journal]
+# [--journal-max-size JOURNAL_MAX_SIZE] [--compact-journal] [--generations GENERATIONS]
+# [--include-dir INCLUDE_DIR] [--publish PUBLISH_TARGET]
+# [--dry-run] [--diff] [--gc-https] [--lock-timeout LOCK_TIMEOUT] [--metrics-json METRICS_JSON] [--metrics-prom METRICS_PROM]
 #
 # Nginx virtualhosts updater
 #
@@ -37,25 +46,158 @@
 #                         /usr/local/directadmin/data/users)
 #   --rebuild-all         Rebuild vhosts using DirectAdmin user configs for all
 #                         users (default: False)
-#   -r REBUILD_USER, --rebuild REBUILD_USER
+#   --rebuild-changed     Rebuild vhosts for users and domains whose DirectAdmin
+#                         configs changed since the last run (default: False)
+#   -r REBUILD_USER [REBUILD_USER ...], --rebuild REBUILD_USER [REBUILD_USER ...]
 #                         Rebuild vhosts using DirectAdmin user configs for the
-#                         specific user (default: None)
-#   -d DELETE_USER, --delete DELETE_USER
-#                         Rebuild vhosts using DirectAdmin user configs for the
-#                         specific user (default: None)
+#                         specific users (default: None)
+#   -d DELETE_USER [DELETE_USER ...], --delete DELETE_USER [DELETE_USER ...]
+#                         Delete vhosts of the specific users (default: None)
+#   --batch BATCH_FILE    Apply "rebuild USER" and "delete USER" lines of the
+#                         file, - for stdin, in one session (default: None)
+#   -j JOBS, --jobs JOBS  Number of worker processes reading DirectAdmin user
+#                         configs on --rebuild-all (default: 1)
+#   --unchanged-exit-code UNCHANGED_EXIT_CODE
+#                         Exit code to return when no Nginx config file was
+#                         changed (default: 0)
+#   --daemon              Keep maps in memory, apply DirectAdmin users config
+#                         changes and serve commands on the daemon socket
+#                         (default: False)
+#   --rollback            Publish the generation the current one was built
+#                         from (default: False)
+#   --socket SOCKET_PATH  Daemon Unix socket (default: /var/run/nginxdirect.sock)
+#   --connect             Send the command to the running daemon instead of
+#                         running it (default: False)
+#   --poll-interval POLL_INTERVAL
+#                         Daemon DirectAdmin users config check interval when
+#                         inotify is not used (default: 5.0)
+#   --no-inotify          Poll DirectAdmin users config instead of using inotify
+#                         in the daemon (default: True)
+#   --coalesce-window COALESCE_WINDOW
+#                         Queue --rebuild/--delete and apply queued users in one
+#                         batch after waiting this many seconds for more hook
+#                         events (default: None)
+#   --reload-services RELOAD_SERVICES
+#                         Comma separated services to configtest and reload if
+#                         the configs they use changed (default: )
+#   --reload-config RELOAD_CONFIG
+#                         JSON file with configtest and reload commands and
+#                         artifacts of the services (default: None)
+#   --min-reload-interval MIN_RELOAD_INTERVAL
+#                         Seconds between reloads of the same service (default:
+#                         2.0)
+#   --sharded             Save map items to a file per user under
+#                         OUT_CONFIG_DIR/maps, included by the map files
+#                         (default: False)
+#   --layout {separate,combined}
+#                         Save $user, $domain and $subdomain maps or a single
+#                         $vhost map with "user|domain|subdomain" values
+#                         (default: separate)
+#   --group-ssl           Write one https vhost per SSL certificate and key
+#                         with the domains and pointers using them (default:
+#                         False)
+#   --journal             Append map changes to OUT_CONFIG_DIR/.nginxdirect.journal
+#                         instead of saving the map files until they are
+#                         compacted (default: False)
+#   --journal-max-size JOURNAL_MAX_SIZE
+#                         Journal size in bytes the map files are saved at
+#                         (default: 1048576)
+#   --compact-journal     Save the map files with the journal changes, done
+#                         before --reload-services too (default: False)
+#   --generations GENERATIONS
+#                         Build every change in a new OUT_CONFIG_DIR/generations
+#                         dir published by OUT_CONFIG_DIR/current symlink and
+#                         keep this many of them, 0 writes in place (default: 0)
+#   --include-dir INCLUDE_DIR
+#                         Path nginx includes the published files by, relative
+#                         to its prefix, the map files of --sharded include the
+#                         user files by it, hosting or hosting/current with
+#                         --generations if not set (default: None)
+#   --publish PUBLISH_TARGET
+#                         Push changed maps and https vhosts to a local dir or
+#                         run a command template with {root}, {files} and
+#                         {removed}, may be repeated (default: None)
+#   --dry-run             Report map keys and https vhosts the action changes
+#                         without writing them (default: False)
+#   --diff                Dry run listing every changed map key (default: False)
+#   --gc-https            Remove https vhost configs of domains missing from the
+#                         maps (default: False)
+#   --lock-timeout LOCK_TIMEOUT
+#                         Seconds to wait until another run releases the out dir
+#                         (default: 60.0)
+#   --metrics-json METRICS_JSON
+#                         File to append phase timings and counters of the run
+#                         to as a JSON line, - for stdout (default: None)
+#   --metrics-prom METRICS_PROM
+#                         Prometheus textfile to write phase timings and
+#                         counters of the run to (default: None)
 #
 from __future__ import print_function
 
 import argparse
 import errno
 import exceptions
-import fcntl
+import hashlib
+import json
+import marshal
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 import traceback
 
+from daemonlib import NginxDirectDaemon
+from daemonlib import send_command
 from diradminlib import DirectAdminUserConfig
+from generationlib import CURRENT_LINK_NAME
+from generationlib import GenerationStore
+from nginxlib import FileLock
 from nginxlib import NginxMap
+from nginxlib import NginxTemplate
+from nginxlib import append_map_journal
+from nginxlib import compute_map_hash_sizes
+from nginxlib import parent_domain_keys
+from nginxlib import read_map_journal
+from nginxlib import replace_file_contents
+from metricslib import metrics
+from metricslib import timed
+from publishlib import Publisher
+from publishlib import parse_target
+from queuelib import RebuildQueue
+from reloadlib import ARTIFACT_HTTPS_VHOSTS
+from reloadlib import ARTIFACT_MAPS
+from reloadlib import ReloadOrchestrator
+from reloadlib import default_services
+from reloadlib import load_services_config
+from statelib import SourceStateCache
+from statelib import domain_source_state
+from statelib import file_state
+from statelib import user_source_state
+
+
+SSL_VHOST_PLACEHOLDERS = ('sslkey', 'sslcrt', 'user', 'domain')
+SSL_GROUP_VHOST_PLACEHOLDERS = ('sslkey', 'sslcrt', 'server_names')
+SSL_CONFIG_KEYS = ('SSLCertificateFile', 'SSLCertificateKeyFile')
+# https vhosts of certificate groups, domain names can't start with an underscore
+SSL_GROUP_PREFIX = '_ssl_'
+
+# map keys the hash sizes are kept for, relative to the keys they were computed for
+HASH_TUNING_KEYS_GROWTH = 1.1
+_hash_tuning_header = re.compile(r'^# Generated by nginxvhostctl\.py for (\d+) map keys up to (\d+) chars\n')
+
+LAYOUT_SEPARATE = 'separate'
+LAYOUT_COMBINED = 'combined'
+
+# path nginx includes the out dir by, relative to the nginx prefix
+INCLUDE_DIR = 'hosting'
+
+
+def ssl_group_file_name(sslcrt, sslkey):
+    """
+    Returns https vhost file name of the domains sharing the certificate and key
+    """
+    return "{}{}.conf".format(SSL_GROUP_PREFIX, hashlib.sha1('{}\0{}'.format(sslcrt, sslkey)).hexdigest()[:16])
 
 
 def safe_create_path(path, mode=0o711):
@@ -78,65 +220,785 @@ class NginxVhostsConfigManager(object):
     MAP_USERS_NAME = 'map_users.conf'
     MAP_DOMAINS_NAME = 'map_domains.conf'
     MAP_SUBDOMAINS_NAME = 'map_subdomains.conf'
-
-    def __init__(self, working_dir, source_da_dir):
+    MAP_VHOSTS_NAME = 'map_vhosts.conf'
+    SOURCE_STATE_NAME = '.nginxdirect.state'
+    # state file per user of the sharded layout
+    SOURCE_STATE_SHARDS_NAME = '.nginxdirect.state.d'
+    QUEUE_DIR_NAME = '.queue'
+    SNAPSHOT_NAME = '.nginxdirect.snapshot'
+    RELOAD_STATE_NAME = '.nginxdirect.reload'
+    SSL_GROUPS_NAME = '.nginxdirect.ssl_groups'
+    JOURNAL_NAME = '.nginxdirect.journal'
+    JOURNAL_MAX_SIZE = 1024 * 1024
+    # journal records of the state files, map variables have no dots
+    JOURNAL_SOURCE_STATE = '.source_state'
+    JOURNAL_SSL_DOMAIN = '.ssl_domain'
+    LOCK_NAME = '.nginxdirect.lock'
+    SNAPSHOT_VERSION = 5
+    GENERATIONS_KEEP = 3
+    # included before map_*.conf, nginx builds map hashes at the end of every map block
+    HASH_TUNING_NAME = '_hash_tuning.conf'
+    MAP_SHARDS_DIR_NAME = 'maps'
+    MAP_USERS_SHARDS_NAME = 'users'
+    MAP_DOMAINS_SHARDS_NAME = 'domains'
+    MAP_SUBDOMAINS_SHARDS_NAME = 'subdomains'
+    # files and dirs of a generation
+    OUTPUT_NAMES = (MAP_USERS_NAME, MAP_DOMAINS_NAME, MAP_SUBDOMAINS_NAME, MAP_VHOSTS_NAME, HASH_TUNING_NAME,
+                    MAP_SHARDS_DIR_NAME, 'https', SOURCE_STATE_NAME, SOURCE_STATE_SHARDS_NAME, SSL_GROUPS_NAME)
+    # files and dirs used by nginx front-ends
+    PUBLISH_NAMES = (MAP_USERS_NAME, MAP_DOMAINS_NAME, MAP_SUBDOMAINS_NAME, MAP_VHOSTS_NAME, HASH_TUNING_NAME,
+                     MAP_SHARDS_DIR_NAME, 'https')
+    PUBLISH_STATE_DIR_NAME = '.publish'
+
+    def __init__(self, working_dir, source_da_dir, sharded=False, dry_run=False, layout=LAYOUT_SEPARATE,
+                 group_ssl=False, journal=False, journal_max_size=JOURNAL_MAX_SIZE, generations=0,
+                 include_dir=None):
+        """
+        :param working_dir: directory with generated Nginx config files
+        :param source_da_dir: DirectAdmin users config root
+        :param sharded: save map items to a file per user included by the map files
+        :param dry_run: keep changes in memory instead of saving, get_dry_run_diff() returns them
+        :param layout: LAYOUT_SEPARATE saves $user, $domain and $subdomain maps,
+                       LAYOUT_COMBINED saves a single $vhost map with "user|domain|subdomain" values
+        :param group_ssl: write one https vhost per certificate and key pair with the domains and pointers using it
+        :param journal: append map item changes to the journal instead of saving the map files,
+                        compact_journal() saves them
+        :param journal_max_size: journal size in bytes the maps are saved at
+        :param generations: number of generations kept under working_dir/generations, each save publishes
+                            a new one by switching working_dir/current symlink, 0 writes the files in place
+        :param include_dir: path nginx includes the published files by, the map files include the shards by it,
+                            INCLUDE_DIR or INCLUDE_DIR/current with generations by default
+        """
         if not os.path.exists(working_dir):
             raise Exception("Map files dir must exist: {}".format(working_dir))
 
         if not os.path.exists(source_da_dir):
             raise Exception("DirectAdmin user config dir must exist: {}".format(source_da_dir))
 
+        if layout not in (LAYOUT_SEPARATE, LAYOUT_COMBINED):
+            raise Exception("Unknown map layout: {}".format(layout))
+
+        if layout == LAYOUT_COMBINED and sharded:
+            raise Exception("Combined map layout can't be sharded")
+
+        # the group template reads $user and $domain maps
+        if layout == LAYOUT_COMBINED and group_ssl:
+            raise Exception("Grouped SSL vhosts can't be used with combined map layout")
+
         self.working_dir = working_dir
+        self.generations = generations
+        # the same in every generation and on the front-ends the files are published to
+        if include_dir is None:
+            include_dir = os.path.join(INCLUDE_DIR, CURRENT_LINK_NAME) if generations else INCLUDE_DIR
+        self.include_dir = include_dir
+        self.generation_store = GenerationStore(working_dir, generations) if generations else None
+        # generated files are read from and written to the published generation
+        self.output_dir = self._get_published_dir()
         self.tpl_ssl_vhost_file_name = os.path.join(os.path.dirname(__file__), 'vhost_ssl.conf.tpl')
         if not os.path.exists(self.tpl_ssl_vhost_file_name):
             raise Exception(
                     "Place Nginx vhost template in the correct location: {}".format(self.tpl_ssl_vhost_file_name))
 
+        self.ssl_vhost_template = NginxTemplate.from_file(self.tpl_ssl_vhost_file_name, SSL_VHOST_PLACEHOLDERS)
+
+        self.ssl_group_template = None
+        if group_ssl:
+            tpl_ssl_group_file_name = os.path.join(os.path.dirname(__file__), 'vhost_ssl_group.conf.tpl')
+            if not os.path.exists(tpl_ssl_group_file_name):
+                raise Exception(
+                        "Place Nginx vhost template in the correct location: {}".format(tpl_ssl_group_file_name))
+
+            self.ssl_group_template = NginxTemplate.from_file(tpl_ssl_group_file_name, SSL_GROUP_VHOST_PLACEHOLDERS)
+
         self.source_da_dir = source_da_dir
+        self.sharded = sharded
+        self.dry_run = dry_run
+        self.layout = layout
+        self.group_ssl = group_ssl
+        self.journal = journal
+        self.journal_max_size = journal_max_size
+        self._dry_run_items = None
+        self._dry_run_vhosts = None
+        self.map_users = NginxMap('http_host', 'user')
+        self.map_domains = NginxMap('http_host', 'domain')
+        self.map_subdomains = NginxMap('http_host', 'subdomain')
+        self.source_state = SourceStateCache()
+        self.changed_files = []
+        # artifacts changed without changed files, e.g. by rollback
+        self.changed_artifacts = set()
+        self._https_vhosts = {}
+        self._https_vhost_digests = {}
+        # domain name to [certificate, key, server names] of the https vhost groups
+        self._ssl_domains = {}
+        self._ssl_domains_changed = False
+        self._files_state = None
+        self._reload_state = None
+
+        self._load()
+
+    @staticmethod
+    def get_lock(working_dir, timeout=60):
+        """
+        Returns lock serializing load-modify-save cycles of managers on the same working dir
+        :param timeout: seconds to wait for the lock
+        :return: FileLock, not acquired yet
+        """
+        return FileLock(os.path.join(working_dir, NginxVhostsConfigManager.LOCK_NAME), timeout)
+
+    def _get_map_files(self):
+        """
+        Returns list of (map, map file, shards dir)
+        """
+        shards_dir = os.path.join(self.output_dir, self.MAP_SHARDS_DIR_NAME)
+
+        return [(self.map_users, os.path.join(self.output_dir, self.MAP_USERS_NAME),
+                 os.path.join(shards_dir, self.MAP_USERS_SHARDS_NAME)),
+                (self.map_domains, os.path.join(self.output_dir, self.MAP_DOMAINS_NAME),
+                 os.path.join(shards_dir, self.MAP_DOMAINS_SHARDS_NAME)),
+                (self.map_subdomains, os.path.join(self.output_dir, self.MAP_SUBDOMAINS_NAME),
+                 os.path.join(shards_dir, self.MAP_SUBDOMAINS_SHARDS_NAME))]
+
+    def _get_files_state(self):
+        """
+        Returns state of the files the maps are loaded from, the snapshot is valid while it is the same
+        """
+        file_names = []
+        for map_object, map_file_name, shards_dir in self._get_map_files():
+            # shard files are replaced by rename, which changes the dir
+            file_names.extend((map_file_name, shards_dir))
+
+        file_names.append(os.path.join(self.output_dir, self.MAP_VHOSTS_NAME))
+        file_names.append(os.path.join(self.output_dir, self.SOURCE_STATE_NAME))
+        file_names.append(os.path.join(self.output_dir, self.SOURCE_STATE_SHARDS_NAME))
+        file_names.append(os.path.join(self.output_dir, self.SSL_GROUPS_NAME))
+
+        return [file_state(file_name) for file_name in file_names]
+
+    def _get_reload_state(self, files_state):
+        """
+        Returns files state with the journal and the published generation, which other runs change
+        without changing the map files
+        """
+        reload_state = files_state + [file_state(os.path.join(self.working_dir, self.JOURNAL_NAME))]
+        if self.generations:
+            reload_state.append(self.generation_store.get_current())
+
+        return reload_state
+
+    def reload_if_changed(self, force=False):
+        """
+        Reloads maps if map files were changed by another process after they were loaded or saved
+        :param force: reload maps even if map files were not changed
+        :return: True if maps were reloaded
+        """
+        if not force and self._reload_state == self._get_reload_state(self._get_files_state()):
+            return False
+
         self.map_users = NginxMap('http_host', 'user')
         self.map_domains = NginxMap('http_host', 'domain')
         self.map_subdomains = NginxMap('http_host', 'subdomain')
+        self.source_state = SourceStateCache()
+        self._https_vhosts = {}
+        self._https_vhost_digests = {}
+        self._ssl_domains = {}
+        self._ssl_domains_changed = False
 
         self._load()
 
+        return True
+
+    def _load_snapshot(self, files_state):
+        """
+        Loads maps from the binary snapshot if it was taken from the current map files
+        :return: True if the snapshot is valid
+        """
+        snapshot_file_name = os.path.join(self.working_dir, self.SNAPSHOT_NAME)
+        try:
+            with open(snapshot_file_name, 'rb') as snapshot_file:
+                snapshot = marshal.load(snapshot_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.SNAPSHOT_VERSION or \
+                snapshot.get('files_state') != files_state or snapshot.get('sharded') != self.sharded or \
+                snapshot.get('layout') != self.layout or snapshot.get('group_ssl') != self.group_ssl:
+            return False
+
+        for map_object, (items, default_value, item_shards) in zip(self._get_maps(), snapshot['maps']):
+            map_object.items = items
+            map_object.default_value = default_value
+            map_object.item_shards = item_shards
+
+        self._https_vhost_digests = snapshot['https_vhost_digests']
+        self._ssl_domains = snapshot['ssl_domains']
+
+        self.source_state.unpack(snapshot['source_state'])
+
+        return True
+
+    def _save_snapshot(self):
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'files_state': self._files_state,
+            'sharded': self.sharded,
+            'layout': self.layout,
+            'group_ssl': self.group_ssl,
+            'maps': [(map_object.items, map_object.default_value, map_object.item_shards)
+                     for map_object in self._get_maps()],
+            'source_state': self.source_state.pack(),
+            'https_vhost_digests': self._https_vhost_digests,
+            'ssl_domains': self._ssl_domains,
+        }
+
+        replace_file_contents(os.path.join(self.working_dir, self.SNAPSHOT_NAME), marshal.dumps(snapshot))
+
+    def _remove_snapshot(self):
+        try:
+            os.remove(os.path.join(self.working_dir, self.SNAPSHOT_NAME))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _get_maps(self):
+        return [self.map_users, self.map_domains, self.map_subdomains]
+
+    @timed('load')
     def _load(self):
-        if os.path.exists(os.path.join(self.working_dir, self.MAP_USERS_NAME)):
-            self.map_users.load(os.path.join(self.working_dir, self.MAP_USERS_NAME))
+        # map files state is taken before reading, so changes made meanwhile invalidate the snapshot
+        files_state = self._get_files_state()
+        reload_state = self._get_reload_state(files_state)
+        if not self._load_snapshot(files_state):
+            for map_object, map_file_name, shards_dir in self._get_map_files():
+                if os.path.exists(map_file_name):
+                    map_object.load(map_file_name)
+
+                if os.path.isdir(shards_dir):
+                    map_object.load_shards(shards_dir)
+                elif self.sharded:
+                    # items of the plain map file are moved to shard files on save
+                    map_object.mark_shards_dirty()
+
+            map_vhosts_file_name = os.path.join(self.output_dir, self.MAP_VHOSTS_NAME)
+            if os.path.exists(map_vhosts_file_name):
+                self._load_vhosts_map(map_vhosts_file_name)
+
+            self._load_source_state()
+
+            if os.path.exists(os.path.join(self.output_dir, self.SSL_GROUPS_NAME)):
+                self._load_ssl_domains(os.path.join(self.output_dir, self.SSL_GROUPS_NAME))
+
+            # sharded saves change the shards of a user only, they would be followed by a snapshot of all
+            # maps on every load
+            if any(files_state) and not self.dry_run and (self.journal or not self.sharded):
+                self._save_snapshot()
+
+        # changes not compacted yet or left by a crash before the maps were saved, replaying them again
+        # gives the same maps
+        journal_file_name = os.path.join(self.working_dir, self.JOURNAL_NAME)
+        if os.path.exists(journal_file_name):
+            self._replay_journal(journal_file_name)
+
+        self._files_state = files_state
+        self._reload_state = reload_state
+
+        if self.journal:
+            for map_object in self._get_maps():
+                map_object.start_journal()
+            self.source_state.start_journal()
+
+        if self.dry_run:
+            # dry run changes are reported against the loaded maps
+            self._dry_run_items = [dict(map_object.items) for map_object in self._get_maps()]
+            self._dry_run_vhosts = {}
+
+    @timed('save')
+    def _save(self, compact=False):
+        """
+        :param compact: save the maps and remove the journal in the journal mode
+        """
+        if self.dry_run:
+            # https vhosts are compared with the files on disk by get_dry_run_diff()
+            self._dry_run_vhosts.update(self._https_vhosts)
+            self._https_vhosts = {}
+            return
+
+        journal_file_name = os.path.join(self.working_dir, self.JOURNAL_NAME)
+        if self.journal:
+            # the journal ends with the saved state, so a crash before it is removed replays to the same maps
+            records = [(map_object.map_variable,) + record
+                       for map_object in self._get_maps() for record in map_object.pop_journal()]
+
+            # state files are saved with the maps, their changes are journaled until then
+            records.extend((self.JOURNAL_SOURCE_STATE, user_name, user, '', '')
+                           for user_name, user in self.source_state.pop_journal())
+            if self.group_ssl:
+                records.extend(self._get_ssl_domain_records())
+
+            if records:
+                append_map_journal(journal_file_name, records)
+
+            compact = compact or os.path.exists(journal_file_name) and \
+                os.path.getsize(journal_file_name) >= self.journal_max_size
+
+        save_maps = not self.journal or compact
+        if save_maps or self._https_vhosts:
+            self._save_output(save_maps, journal_file_name)
+
+        # the journal is removed once the maps it was folded into are published
+        if save_maps and os.path.exists(journal_file_name):
+            os.remove(journal_file_name)
+
+        # the snapshot is taken by full loads and rebuild_all() only, saved changes make it stale,
+        # the journal is replayed on top of it
+        files_state = self._get_files_state()
+        if files_state != self._files_state:
+            self._files_state = files_state
+            self._remove_snapshot()
+        self._reload_state = self._get_reload_state(files_state)
+
+    def _save_output(self, save_maps, journal_file_name):
+        """
+        Saves the maps and https vhosts into a new generation published if any of them changed, the state files
+        go with them or to the published generation
+        :param save_maps: save the maps and the state files, False saves https vhosts only
+        """
+        generation_dir = self._start_generation()
+        changed_files_count = len(self.changed_files)
+        try:
+            if save_maps:
+                self._save_maps(journal_file_name)
+
+            self._save_https_vhosts()
+
+            if generation_dir is not None and len(self.changed_files) == changed_files_count:
+                # nginx doesn't read the state files, they don't need a generation of their own
+                self._finish_generation(generation_dir, False)
+                generation_dir = None
+
+            if save_maps:
+                self._save_state_files()
+        except:
+            self._finish_generation(generation_dir, False)
+            raise
+
+        self._finish_generation(generation_dir, True)
+
+    def _save_state_files(self):
+        """
+        Saves the source state and the certificate groups state changed since the last save
+        """
+        if self.source_state.is_changed:
+            self._save_source_state()
+
+        ssl_groups_file_name = os.path.join(self.output_dir, self.SSL_GROUPS_NAME)
+        if self.group_ssl and self._ssl_domains_changed:
+            replace_file_contents(ssl_groups_file_name, json.dumps(self._ssl_domains, sort_keys=True))
+            self._ssl_domains_changed = False
+        elif not self.group_ssl and os.path.exists(ssl_groups_file_name):
+            os.remove(ssl_groups_file_name)
+
+    def _save_https_vhosts(self):
+        """
+        Writes and removes https vhosts changed since the last save
+        """
+        if self._https_vhosts:
+            safe_create_path(os.path.join(self.output_dir, 'https'))
+
+        if self.group_ssl:
+            self._save_ssl_groups()
+        elif self._ssl_domains:
+            self._remove_ssl_groups()
+
+        for domain_name, vhost_values in sorted(self._https_vhosts.items()):
+            https_vhost_file = self._get_https_vhost_config(domain_name)
+            if vhost_values is None:
+                self._https_vhost_digests.pop(domain_name, None)
+                if os.path.exists(https_vhost_file):
+                    os.remove(https_vhost_file)
+                    self.changed_files.append(https_vhost_file)
+                continue
+
+            if self.group_ssl:
+                # the domain is served by the https vhost of its certificate group
+                if os.path.exists(https_vhost_file):
+                    os.remove(https_vhost_file)
+                    self.changed_files.append(https_vhost_file)
+                self._https_vhost_digests.pop(domain_name, None)
+                continue
 
-        if os.path.exists(os.path.join(self.working_dir, self.MAP_DOMAINS_NAME)):
-            self.map_domains.load(os.path.join(self.working_dir, self.MAP_DOMAINS_NAME))
+            # vhost rendered from the same template and values is neither rendered nor compared again,
+            # the file state tells files written since the digest was taken, e.g. after the snapshot
+            vhost_digest = self.ssl_vhost_template.digest(vhost_values)
+            last_digest = self._https_vhost_digests.get(domain_name)
+            if last_digest is not None and last_digest[0] == vhost_digest and \
+                    last_digest[1] == file_state(https_vhost_file):
+                continue
 
-        if os.path.exists(os.path.join(self.working_dir, self.MAP_SUBDOMAINS_NAME)):
-            self.map_subdomains.load(os.path.join(self.working_dir, self.MAP_SUBDOMAINS_NAME))
+            if replace_file_contents(https_vhost_file, self.ssl_vhost_template.render(vhost_values)):
+                self.changed_files.append(https_vhost_file)
+            self._https_vhost_digests[domain_name] = [vhost_digest, file_state(https_vhost_file)]
 
-    def _save(self):
-        # save all maps
-        self.map_users.save(os.path.join(self.working_dir, self.MAP_USERS_NAME))
-        self.map_domains.save(os.path.join(self.working_dir, self.MAP_DOMAINS_NAME))
-        self.map_subdomains.save(os.path.join(self.working_dir, self.MAP_SUBDOMAINS_NAME))
+        self._https_vhosts = {}
+
+    def _start_generation(self):
+        """
+        Points the output dir to a new generation linked from the published one
+        :return: path of the new generation or None without generations
+        """
+        if not self.generations:
+            return None
+
+        # files written in place before generations were enabled seed the first generation
+        self.output_dir = self.generation_store.create(self.OUTPUT_NAMES, self.working_dir)
+
+        return self.output_dir
+
+    def _finish_generation(self, generation_dir, publish):
+        """
+        Publishes or discards the generation created by _start_generation()
+        """
+        if generation_dir is None:
+            return
+
+        if publish:
+            self.generation_store.publish(generation_dir)
+        else:
+            self.generation_store.discard(generation_dir)
+
+        self.output_dir = self._get_published_dir()
+
+    def rollback_generation(self):
+        """
+        Publishes the generation the current one was built from and reloads the maps from it, the journal of the
+        rolled back maps is dropped
+        :return: name of the published generation
+        """
+        if not self.generations:
+            raise Exception("Rollback requires generations")
+
+        generation = self.generation_store.rollback()
+
+        journal_file_name = os.path.join(self.working_dir, self.JOURNAL_NAME)
+        if os.path.exists(journal_file_name):
+            os.remove(journal_file_name)
+
+        # the snapshot may have the changes of the dropped journal
+        self._remove_snapshot()
+
+        self.output_dir = self._get_published_dir()
+        self.changed_files.append(self.generation_store.current_link)
+        self.changed_artifacts.update((ARTIFACT_MAPS, ARTIFACT_HTTPS_VHOSTS))
+        self.reload_if_changed()
+
+        return generation
+
+    def _get_published_dir(self):
+        if self.generations and self.generation_store.get_current():
+            return self.generation_store.current_link
+
+        return self.working_dir
+
+    def _save_maps(self, journal_file_name):
+        """
+        Saves the maps, files of the other layout are removed
+        """
+        changed_files_count = len(self.changed_files)
+
+        if self.sharded and os.path.exists(journal_file_name):
+            # shards changed by other runs are known from the journal only
+            maps = dict((map_object.map_variable, map_object) for map_object in self._get_maps())
+            for map_variable, map_key, value, shard, previous_shard in read_map_journal(journal_file_name):
+                if map_variable in maps:
+                    maps[map_variable].mark_shards_dirty((shard, previous_shard))
+
+        map_vhosts_file_name = os.path.join(self.output_dir, self.MAP_VHOSTS_NAME)
+        if self.layout == LAYOUT_COMBINED:
+            map_vhosts = self._build_vhosts_map()
+            if map_vhosts.save(map_vhosts_file_name):
+                self.changed_files.append(map_vhosts_file_name)
+
+            for map_object, map_file_name, shards_dir in self._get_map_files():
+                if os.path.exists(map_file_name):
+                    os.remove(map_file_name)
+                    self.changed_files.append(map_file_name)
+
+            saved_maps = [map_vhosts]
+        else:
+            for map_object, map_file_name, shards_dir in self._get_map_files():
+                if self.sharded:
+                    safe_create_path(shards_dir)
+                    include_pattern = os.path.join(self.include_dir, os.path.relpath(shards_dir, self.output_dir),
+                                                   '*.conf')
+                    self.changed_files.extend(map_object.save_shards(map_file_name, shards_dir, include_pattern))
+                else:
+                    if map_object.save(map_file_name):
+                        self.changed_files.append(map_file_name)
+
+                    # items of the sharded layout are in the plain map file now
+                    if os.path.isdir(shards_dir):
+                        shutil.rmtree(shards_dir)
+
+            if os.path.exists(map_vhosts_file_name):
+                os.remove(map_vhosts_file_name)
+                self.changed_files.append(map_vhosts_file_name)
+
+            saved_maps = self._get_maps()
+
+        hash_tuning_file_name = os.path.join(self.output_dir, self.HASH_TUNING_NAME)
+        if len(self.changed_files) > changed_files_count or not os.path.exists(hash_tuning_file_name):
+            previous_contents = None
+            if os.path.exists(hash_tuning_file_name):
+                with open(hash_tuning_file_name, 'r') as hash_tuning_file:
+                    previous_contents = hash_tuning_file.read()
+
+            if replace_file_contents(hash_tuning_file_name, render_hash_tuning(saved_maps, previous_contents)):
+                self.changed_files.append(hash_tuning_file_name)
+
+    def _replay_journal(self, file_name):
+        records = read_map_journal(file_name)
+
+        for map_object in self._get_maps():
+            map_object.replay_journal([record[1:] for record in records if record[0] == map_object.map_variable])
+
+        # replayed state changes are not in the state files until the journal is compacted
+        state_records = [record[1:3] for record in records if record[0] == self.JOURNAL_SOURCE_STATE]
+        if state_records:
+            self.source_state.replay_journal(state_records)
+            self.source_state.mark_changed(user_name for user_name, user in state_records)
+
+        for map_variable, domain_name, ssl_domain, shard, previous_shard in records:
+            if map_variable != self.JOURNAL_SSL_DOMAIN:
+                continue
+
+            if ssl_domain is None:
+                self._ssl_domains.pop(domain_name, None)
+            else:
+                self._ssl_domains[domain_name] = json.loads(ssl_domain)
+            self._ssl_domains_changed = True
+
+        metrics.add('journal_records_replayed', len(records))
+
+    def compact_journal(self):
+        """
+        Saves the maps with the changes appended to the journal and removes the journal
+        """
+        self._save(compact=True)
+
+    def _load_source_state(self):
+        state_file_name = os.path.join(self.output_dir, self.SOURCE_STATE_NAME)
+        state_dir = os.path.join(self.output_dir, self.SOURCE_STATE_SHARDS_NAME)
+
+        if os.path.exists(state_file_name):
+            self.source_state.load(state_file_name)
+
+        if os.path.isdir(state_dir):
+            self.source_state.load_shards(state_dir)
+
+        # users of the other layout are moved on save
+        if self.sharded and os.path.exists(state_file_name) or not self.sharded and os.path.isdir(state_dir):
+            self.source_state.mark_changed(self.source_state.users)
+
+    def _save_source_state(self):
+        """
+        Saves the source state to a file per user in the sharded layout, files of the other layout are removed
+        """
+        state_file_name = os.path.join(self.output_dir, self.SOURCE_STATE_NAME)
+        state_dir = os.path.join(self.output_dir, self.SOURCE_STATE_SHARDS_NAME)
+
+        if not self.sharded:
+            self.source_state.save(state_file_name)
+            if os.path.isdir(state_dir):
+                shutil.rmtree(state_dir)
+            return
+
+        safe_create_path(state_dir, 0o700)
+        self.source_state.save_shards(state_dir)
+        if os.path.exists(state_file_name):
+            os.remove(state_file_name)
+
+    def _load_ssl_domains(self, file_name):
+        with open(file_name, 'r') as ssl_groups_file:
+            try:
+                self._ssl_domains = json.load(ssl_groups_file)
+            except ValueError:
+                # broken groups are rebuilt by --rebuild-all
+                self._ssl_domains = {}
+
+    @staticmethod
+    def _apply_ssl_domain_changes(ssl_domains, https_vhosts):
+        """
+        Moves domains of the https vhost changes between certificate groups
+        :param ssl_domains: domain name to [certificate, key, server names], updated in place
+        :param https_vhosts: domain name to https vhost values or None for removed vhosts
+        :return: set of (certificate, key) of the groups whose domains changed
+        """
+        changed_groups = set()
+        for domain_name, vhost_values in https_vhosts.items():
+            ssl_domain = ssl_domains.pop(domain_name, None)
+            if ssl_domain is not None:
+                changed_groups.add((ssl_domain[0], ssl_domain[1]))
+
+            if vhost_values is not None:
+                ssl_domains[domain_name] = [vhost_values['sslcrt'], vhost_values['sslkey'],
+                                            vhost_values['server_names']]
+                changed_groups.add((vhost_values['sslcrt'], vhost_values['sslkey']))
+
+        return changed_groups
+
+    @staticmethod
+    def _get_ssl_groups(ssl_domains, groups):
+        """
+        Returns dict of (certificate, key) to group vhost template values, groups without domains are missing
+        :param groups: set of (certificate, key) to return
+        """
+        group_names = {}
+        for sslcrt, sslkey, server_names in ssl_domains.values():
+            if (sslcrt, sslkey) in groups:
+                group_names.setdefault((sslcrt, sslkey), []).append(server_names)
+
+        return dict(((sslcrt, sslkey), {'sslcrt': sslcrt, 'sslkey': sslkey, 'server_names': ' '.join(sorted(names))})
+                    for (sslcrt, sslkey), names in group_names.items())
+
+    def _save_ssl_groups(self):
+        """
+        Writes https vhosts of the certificate groups changed since the last save. Groups with the same
+        domains and certificate files state as the last time are not rendered.
+        """
+        changed_groups = self._apply_ssl_domain_changes(self._ssl_domains, self._https_vhosts)
+        if changed_groups:
+            self._ssl_domains_changed = True
+
+        cert_states = {}
+        for group, group_values in sorted(self._get_ssl_groups(self._ssl_domains, changed_groups).items()):
+            https_vhost_file = os.path.join(self.output_dir, 'https', ssl_group_file_name(*group))
+            changed_groups.discard(group)
+
+            for cert_file_name in group:
+                if cert_file_name not in cert_states:
+                    cert_states[cert_file_name] = file_state(cert_file_name)
+            group_state = [cert_states[cert_file_name] for cert_file_name in group]
+
+            if None in group_state:
+                # nginx refuses to start with a missing certificate
+                print("Missing SSL certificate or key, skipping https vhost of {}".format(
+                        group_values['server_names']))
+                self._remove_https_vhost_file(https_vhost_file)
+                continue
+
+            vhost_digest = [self.ssl_group_template.digest(group_values), group_state]
+            last_digest = self._https_vhost_digests.get(os.path.basename(https_vhost_file))
+            if last_digest is not None and last_digest[:2] == vhost_digest and \
+                    last_digest[2] == file_state(https_vhost_file):
+                continue
+
+            # renewed certificates are loaded by the reload even if the vhost is the same
+            if replace_file_contents(https_vhost_file, self.ssl_group_template.render(group_values)) or \
+                    last_digest is not None and last_digest[1] != group_state:
+                self.changed_files.append(https_vhost_file)
+            self._https_vhost_digests[os.path.basename(https_vhost_file)] = vhost_digest + [
+                    file_state(https_vhost_file)]
+
+        # groups left without domains
+        for group in changed_groups:
+            self._remove_https_vhost_file(os.path.join(self.output_dir, 'https', ssl_group_file_name(*group)))
+
+    def _get_ssl_domain_records(self):
+        """
+        Returns journal records of the certificate groups changes the https vhosts saved next make
+        """
+        records = []
+        for domain_name, vhost_values in sorted(self._https_vhosts.items()):
+            ssl_domain = None
+            if vhost_values is not None:
+                ssl_domain = [vhost_values['sslcrt'], vhost_values['sslkey'], vhost_values['server_names']]
+
+            if self._ssl_domains.get(domain_name) != ssl_domain:
+                records.append((self.JOURNAL_SSL_DOMAIN, domain_name,
+                                None if ssl_domain is None else json.dumps(ssl_domain), '', ''))
+
+        return records
+
+    def _remove_ssl_groups(self):
+        """
+        Removes https vhosts of the certificate groups, domains get https vhosts of their own again
+        """
+        for group in set((sslcrt, sslkey) for sslcrt, sslkey, server_names in self._ssl_domains.values()):
+            self._remove_https_vhost_file(os.path.join(self.output_dir, 'https', ssl_group_file_name(*group)))
+
+        self._ssl_domains = {}
+        self._ssl_domains_changed = False
+
+    def _remove_https_vhost_file(self, https_vhost_file):
+        self._https_vhost_digests.pop(os.path.basename(https_vhost_file), None)
+        if os.path.exists(https_vhost_file):
+            os.remove(https_vhost_file)
+            self.changed_files.append(https_vhost_file)
+
+    def _build_vhosts_map(self):
+        """
+        Returns $vhost map combining $user, $domain and $subdomain maps: one lookup per request.
+        Subdomain keys take user and domain of the closest parent domain key.
+        """
+        users = self.map_users.items
+        domains = self.map_domains.items
+
+        map_vhosts = NginxMap('http_host', 'vhost')
+        map_vhosts.items = dict((domain_key, '"{}|{}|"'.format(user[1:-1], domains.get(domain_key, '""')[1:-1]))
+                                for domain_key, user in users.items())
+
+        for subdomain_key, subdomain in self.map_subdomains.items.items():
+            if subdomain_key in map_vhosts.items:
+                continue
+
+            parent_key = next((parent_key for parent_key in parent_domain_keys(subdomain_key)
+                               if parent_key in users), None)
+            if parent_key is None:
+                continue
+
+            map_vhosts.items[subdomain_key] = '"{}|{}|{}"'.format(users[parent_key][1:-1],
+                                                                   domains.get(parent_key, '""')[1:-1],
+                                                                   subdomain[1:-1])
+
+        return map_vhosts
+
+    def _load_vhosts_map(self, file_name):
+        """
+        Loads $vhost map saved by the combined layout into $user, $domain and $subdomain maps
+        """
+        map_vhosts = NginxMap.from_file('http_host', 'vhost', file_name)
+
+        for map_key, vhost in map_vhosts.items.items():
+            user_name, domain_name, subdomain = (vhost[1:-1].split('|') + ['', ''])[:3]
+
+            if subdomain:
+                self.map_subdomains.items[map_key] = '"{}"'.format(subdomain)
+            else:
+                self.map_users.items[map_key] = '"{}"'.format(user_name)
+                self.map_domains.items[map_key] = '"{}"'.format(domain_name)
 
     def _add_domain(self, domain_name, user_name):
         assert domain_name, "Domain name must be specified"
         assert user_name, "User name must be specified"
 
         domain_key = "." + domain_name
-        self.map_users.add_item(domain_key, '"{}"'.format(user_name))
-        self.map_domains.add_item(domain_key, '"{}"'.format(domain_name))
+        self.map_users.add_item(domain_key, '"{}"'.format(user_name), user_name)
+        self.map_domains.add_item(domain_key, '"{}"'.format(domain_name), user_name)
 
     def _add_domain_alias(self, domain_name, domain_alias, user_name):
         assert domain_name, "Domain name must be specified"
         assert domain_alias, "Domain alias must be specified"
         assert user_name, "User name must be specified"
 
-        self.map_users.add_item("." + domain_alias, '"{}"'.format(user_name))
-        self.map_domains.add_item("." + domain_alias, '"{}"'.format(domain_name))
+        self.map_users.add_item("." + domain_alias, '"{}"'.format(user_name), user_name)
+        self.map_domains.add_item("." + domain_alias, '"{}"'.format(domain_name), user_name)
 
-    def _add_subdomain(self, domain_name, subdomain):
+    def _add_subdomain(self, domain_name, subdomain, user_name):
         assert domain_name, "Domain name must be specified"
         assert subdomain, "Subdomain must be specified"
+        assert user_name, "User name must be specified"
 
-        self.map_subdomains.add_item(".{sub}.{domain}".format(sub=subdomain,
-                                                              domain=domain_name), '"{}"'.format(subdomain))
+        self.map_subdomains.add_item(".{sub}.{domain}".format(sub=subdomain, domain=domain_name),
+                                     '"{}"'.format(subdomain), user_name)
 
     def _get_https_vhost_config(self, domain_name):
         """
@@ -146,36 +1008,273 @@ class NginxVhostsConfigManager(object):
         """
         assert domain_name, "Domain name must be specified"
 
-        ssl_vhosts_drop_dir = os.path.join(self.working_dir, 'https')
+        return os.path.join(self.output_dir, 'https', "{domain}.conf".format(domain=domain_name))
 
-        safe_create_path(ssl_vhosts_drop_dir)
+    def get_changed_artifacts(self):
+        """
+        Returns set of ARTIFACT_* written or removed by the manager
+        """
+        # files of generations are under the generation dirs
+        return self.changed_artifacts | set(ARTIFACT_HTTPS_VHOSTS
+                                            if os.path.basename(os.path.dirname(changed_file)) == 'https'
+                                            else ARTIFACT_MAPS for changed_file in self.changed_files)
+
+    def get_dry_run_diff(self):
+        """
+        Compares maps and https vhosts changed in the dry run with the loaded maps and the files on disk
+        :return: dict with 'maps': list of (map file, added keys, removed keys, changed keys, bytes to write)
+                 and 'vhosts': list of (https vhost file, 'create', 'update' or 'delete', bytes to write)
+        """
+        assert self.dry_run, "Config manager must be created with dry_run"
+
+        maps_diff = []
+        for (map_object, map_file_name, shards_dir), loaded_items in zip(self._get_map_files(),
+                                                                         self._dry_run_items):
+            items = map_object.items
+            added_keys = sorted(map_key for map_key in items if map_key not in loaded_items)
+            removed_keys = sorted(map_key for map_key in loaded_items if map_key not in items)
+            changed_keys = sorted(map_key for map_key in items
+                                  if map_key in loaded_items and loaded_items[map_key] != items[map_key])
+
+            if not (added_keys or removed_keys or changed_keys):
+                continue
+
+            if self.sharded:
+                map_bytes = sum(len(map_object.render_shard(shard)) for shard in map_object.get_dirty_shards())
+            else:
+                map_bytes = len(map_object.render())
+
+            maps_diff.append((map_file_name, added_keys, removed_keys, changed_keys, map_bytes))
+
+        # https vhost file to contents, None for removed vhosts
+        vhosts_contents = {}
+        for domain_name, vhost_values in self._dry_run_vhosts.items():
+            if vhost_values is None or self.group_ssl:
+                vhosts_contents[self._get_https_vhost_config(domain_name)] = None
+            else:
+                vhosts_contents[self._get_https_vhost_config(domain_name)] = self.ssl_vhost_template.render(vhost_values)
+
+        if self.group_ssl:
+            ssl_domains = dict(self._ssl_domains)
+            changed_groups = self._apply_ssl_domain_changes(ssl_domains, self._dry_run_vhosts)
+            ssl_groups = self._get_ssl_groups(ssl_domains, changed_groups)
+            for group in changed_groups:
+                https_vhost_file = os.path.join(self.output_dir, 'https', ssl_group_file_name(*group))
+                vhosts_contents[https_vhost_file] = self.ssl_group_template.render(ssl_groups[group]) \
+                    if group in ssl_groups else None
+
+        vhosts_diff = []
+        for https_vhost_file, contents in sorted(vhosts_contents.items()):
+            vhost_exists = os.path.exists(https_vhost_file)
+
+            if contents is None:
+                if vhost_exists:
+                    vhosts_diff.append((https_vhost_file, 'delete', 0))
+                continue
+
+            if not vhost_exists:
+                vhosts_diff.append((https_vhost_file, 'create', len(contents)))
+            else:
+                with open(https_vhost_file, 'r') as current_file:
+                    if current_file.read() != contents:
+                        vhosts_diff.append((https_vhost_file, 'update', len(contents)))
+
+        return {'maps': maps_diff, 'vhosts': vhosts_diff}
+
+    def _list_https_vhosts(self):
+        """
+        Returns set of domain names having https vhost config files
+        """
+        try:
+            file_names = os.listdir(os.path.join(self.output_dir, 'https'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return set()
 
-        return os.path.join(ssl_vhosts_drop_dir, "{domain}.conf".format(domain=domain_name))
+        return set(file_name[:-len('.conf')] for file_name in file_names if file_name.endswith('.conf'))
 
-    def clean_unresolved_domains(self):
+    @timed('clean_unresolved_domains')
+    def clean_unresolved_domains(self, save=True):
         """
-        Remove domains that is don't appears in map_users
-        :return:
+        Remove domains that is don't appears in map_users with their subdomains and https vhosts
+        :param save: save maps if domains were removed
+        :return: number of removed domains
         """
-        for domain_name in list(self.map_domains.items):
-            if domain_name not in self.map_users.items:
-                self.map_domains.del_item(domain_name)
+        unresolved_keys = [domain_key for domain_key in self.map_domains.items
+                           if domain_key not in self.map_users.items]
+        if not unresolved_keys:
+            return 0
 
-                for subdomain_domain_name in list(self.map_subdomains.items):
-                    if subdomain_domain_name.endswith(domain_name):
-                        self.map_subdomains.del_item(subdomain_domain_name)
+        https_vhosts = self._list_https_vhosts()
+        for domain_key in unresolved_keys:
+            self.map_domains.del_item(domain_key)
 
-                # remove https configs for all domains
-                https_vhost_file = self._get_https_vhost_config(domain_name[1:])
-                if os.path.exists(https_vhost_file):
-                    os.remove(https_vhost_file)
+            for subdomain_key in self.map_subdomains.find_keys_by_parent(domain_key):
+                self.map_subdomains.del_item(subdomain_key)
 
-        self._save()
+            # remove https configs for all domains
+            if domain_key[1:] in https_vhosts or domain_key[1:] in self._ssl_domains:
+                self._delete_https_vhost(domain_key[1:])
+
+        if save:
+            self._save()
+
+        return len(unresolved_keys)
+
+    @timed('gc_https_vhosts')
+    def gc_https_vhosts(self):
+        """
+        Removes https vhost configs of domains missing from map_domains, of domains and certificate groups
+        not used by the current --group-ssl mode and temporary files left by crashes
+        :return: list of removed files
+        """
+        https_dir = os.path.join(self.output_dir, 'https')
+        try:
+            file_names = os.listdir(https_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        group_file_names = set(ssl_group_file_name(sslcrt, sslkey)
+                               for sslcrt, sslkey in set((ssl_domain[0], ssl_domain[1])
+                                                         for ssl_domain in self._ssl_domains.values()))
+
+        orphaned_file_names = []
+        for file_name in file_names:
+            if file_name.startswith(SSL_GROUP_PREFIX) and file_name.endswith('.conf'):
+                if file_name in group_file_names:
+                    continue
+                self._https_vhost_digests.pop(file_name, None)
+            elif file_name.endswith('.conf'):
+                domain_name = file_name[:-len('.conf')]
+                # domains of certificate groups are served by the group vhosts
+                if "." + domain_name in self.map_domains.items and domain_name not in self._ssl_domains or \
+                        domain_name in self._https_vhosts:
+                    continue
+                self._https_vhost_digests.pop(domain_name, None)
+            elif not file_name.endswith('.tmp'):
+                continue
+
+            orphaned_file_names.append(file_name)
+
+        if not orphaned_file_names:
+            return []
+
+        generation_dir = None if self.dry_run else self._start_generation()
+        https_dir = os.path.join(self.output_dir, 'https')
+        removed_files = []
+        removed_bytes = 0
+        try:
+            for file_name in orphaned_file_names:
+                https_vhost_file = os.path.join(https_dir, file_name)
+                try:
+                    removed_bytes += os.path.getsize(https_vhost_file)
+                    if not self.dry_run:
+                        os.remove(https_vhost_file)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+
+                removed_files.append(https_vhost_file)
+        except:
+            self._finish_generation(generation_dir, False)
+            raise
+
+        self._finish_generation(generation_dir, bool(removed_files))
+
+        if removed_files and self.dry_run:
+            print("Would remove {} orphaned https vhost files, {} bytes".format(len(removed_files), removed_bytes))
+        elif removed_files:
+            print("Removed {} orphaned https vhost files, {} bytes".format(len(removed_files), removed_bytes))
+            self.changed_files.extend(removed_files)
+            metrics.add('https_vhosts_collected', len(removed_files))
+
+        return removed_files
+
+    def _write_https_vhost(self, domain_name, vhost_values):
+        # https vhosts are rendered and written on save
+        self._https_vhosts[domain_name] = vhost_values
+
+    def _delete_https_vhost(self, domain_name):
+        # https vhosts are removed on save
+        self._https_vhosts[domain_name] = None
+
+    def _apply_domain_vhost(self, user_name, domain_vhost):
+        """
+        Adds vhost read by read_domain_vhost() to the maps and writes https vhost config
+        :param user_name: name of DirectAdmin user
+        :param domain_vhost: vhost returned by read_domain_vhost()
+        """
+        domain_name, pointers, subdomains, https_vhost_values, domain_state = domain_vhost
+
+        self._add_domain(domain_name, user_name)
 
-    def delete_user(self, user_name):
+        for domain_pointer in pointers:
+            self._add_domain_alias(domain_name, domain_pointer, user_name)
+
+        for subdomain in subdomains:
+            self._add_subdomain(domain_name, subdomain, user_name)
+
+        if https_vhost_values is not None:
+            if self.group_ssl:
+                https_vhost_values = dict(https_vhost_values, server_names=' '.join([domain_name] + list(pointers)))
+            self._write_https_vhost(domain_name, https_vhost_values)
+
+    def _apply_user_vhosts(self, user_name, user_state, user_vhosts):
+        """
+        Adds vhosts read by read_user_vhosts() to the maps and writes https vhost configs
+        :param user_name: name of DirectAdmin user
+        :param user_state: DirectAdmin user files state returned by read_user_vhosts()
+        :param user_vhosts: list of vhosts returned by read_user_vhosts()
+        """
+        domain_states = {}
+        for domain_vhost in user_vhosts:
+            self._apply_domain_vhost(user_name, domain_vhost)
+            domain_states[domain_vhost[0]] = domain_vhost[4]
+
+        self.source_state.set_user(user_name, user_state, domain_states)
+
+    def _delete_domain_key(self, domain_key):
+        """
+        Delete domain or domain alias with its subdomains from maps and https vhosts
+        :param domain_key: domain key in map_users
+        """
+        # remove domains and aliases
+        for domain_domain_name in self.map_domains.find_keys_by_value('"{}"'.format(domain_key[1:])):
+            self.map_domains.del_item(domain_domain_name)
+
+        # remove subdomains
+        for subdomain_domain_name in self.map_subdomains.find_keys_by_parent(domain_key):
+            self.map_subdomains.del_item(subdomain_domain_name)
+
+        # remove user domain
+        if self.map_users.has_item(domain_key):
+            self.map_users.del_item(domain_key)
+
+        # remove https configs for all domains
+        self._delete_https_vhost(domain_key[1:])
+
+    def _delete_domain(self, domain_name):
+        """
+        Delete domain with its aliases and subdomains from maps and https vhosts
+        """
+        domain_key = "." + domain_name
+        alias_keys = [alias_key for alias_key in self.map_domains.find_keys_by_value('"{}"'.format(domain_name))
+                      if alias_key != domain_key]
+
+        self._delete_domain_key(domain_key)
+        for alias_key in alias_keys:
+            self._delete_domain_key(alias_key)
+
+    @timed('delete_user')
+    def delete_user(self, user_name, save=True):
         """
         Delete user configs from maps and https vhosts
         :param user_name:
+        :param save: save maps after the user is deleted
         :return:
         """
         assert user_name, "User name must be specified"
@@ -184,29 +1283,19 @@ class NginxVhostsConfigManager(object):
 
         # remove from maps
         for domain_name in self.map_users.find_keys_by_value('"{}"'.format(user_name)):
-            # remove domains and aliases
-            for domain_domain_name in self.map_domains.find_keys_by_value('"{}"'.format(domain_name[1:])):
-                self.map_domains.del_item(domain_domain_name)
-
-            # remove subdomains
-            for subdomain_domain_name in list(self.map_subdomains.items):
-                if subdomain_domain_name.endswith(domain_name):
-                    self.map_subdomains.del_item(subdomain_domain_name)
-
-            # remove user domain
-            self.map_users.del_item(domain_name)
+            self._delete_domain_key(domain_name)
 
-            # remove https configs for all domains
-            https_vhost_file = self._get_https_vhost_config(domain_name[1:])
-            if os.path.exists(https_vhost_file):
-                os.remove(https_vhost_file)
+        self.source_state.del_user(user_name)
 
-        self._save()
+        if save:
+            self._save()
 
-    def rebuild_user(self, user_name):
+    @timed('rebuild_user')
+    def rebuild_user(self, user_name, save=True):
         """
         Rebuild Nginx vhost configs for the specific user from DirectAdmin
         user_name: name of DirectAdmin user to update
+        save: save maps after the user is rebuilt
         """
         assert user_name, "User name must be specified"
 
@@ -216,48 +1305,225 @@ class NginxVhostsConfigManager(object):
             raise Exception("Missing DirectAdmin user dir: {}".format(user_dir))
 
         if os.path.isdir(user_dir):
-            da_user_config = DirectAdminUserConfig(user_dir)
+            user_state, user_vhosts = read_user_vhosts(user_dir)
+            self._apply_user_vhosts(user_name, user_state, user_vhosts)
 
-            for domain in da_user_config.get_domains():
-                self._add_domain(domain.domain_name, da_user_config.user_name)
+            if save:
+                self._save()
 
-                current_pointers = []
-                for domain_pointer in domain.get_pointers():
-                    self._add_domain_alias(domain.domain_name, domain_pointer, da_user_config.user_name)
-                    current_pointers.append(domain_pointer)
+    @timed('rebuild_all')
+    def rebuild_all(self, jobs=1):
+        """
+        Rebuild Nginx vhost configs for all users from DirectAdmin
+        jobs: number of worker processes reading DirectAdmin user configs
+        """
+        if not os.path.exists(self.source_da_dir):
+            raise Exception("DirectAdmin users config dir must exist: {}".format(self.source_da_dir))
 
-                for subdomain in domain.get_subdomains():
-                    self._add_subdomain(domain.domain_name, subdomain)
+        user_names = [user_name for user_name in os.listdir(self.source_da_dir)
+                      if os.path.isdir(os.path.join(self.source_da_dir, user_name))]
+
+        for user_name in user_names:
+            self.delete_user(user_name, save=False)
+
+        jobs_args = [os.path.join(self.source_da_dir, user_name) for user_name in user_names]
+
+        if jobs > 1 and len(user_names) > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                chunk_size = max(1, len(jobs_args) // (jobs * 4))
+                for user_name, user_state, user_vhosts in pool.imap(_read_user_vhosts_job, jobs_args, chunk_size):
+                    print("Rebuilding user: {}".format(user_name))
+                    self._apply_user_vhosts(user_name, user_state, user_vhosts)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for job_args in jobs_args:
+                user_name, user_state, user_vhosts = _read_user_vhosts_job(job_args)
+                print("Rebuilding user: {}".format(user_name))
+                self._apply_user_vhosts(user_name, user_state, user_vhosts)
 
-                config = domain.get_config()
-                if config.has_key('SSLCertificateFile') and config.has_key('SSLCertificateKeyFile'):
-                    cert_file = config['SSLCertificateFile']
-                    key_file = config['SSLCertificateKeyFile']
+        self._save()
 
-                    with open(self._get_https_vhost_config(domain.domain_name), 'w') as vhost_file:
-                        fcntl.flock(vhost_file, fcntl.LOCK_EX)
-                        with open(self.tpl_ssl_vhost_file_name, 'r') as tpl_vhost_file:
-                            for tpl_line in tpl_vhost_file:
-                                tpl_line = tpl_line.replace('{sslkey}', key_file)
-                                tpl_line = tpl_line.replace('{sslcrt}', cert_file)
-                                tpl_line = tpl_line.replace('{user}', user_name)
-                                tpl_line = tpl_line.replace('{domain}', domain.domain_name)
-                                vhost_file.write(tpl_line)
+        if not self.dry_run:
+            self._save_snapshot()
 
-            self._save()
-
-    def rebuild_all(self):
+    @timed('rebuild_changed')
+    def rebuild_changed(self, only_users=None):
         """
-        Rebuild Nginx vhost configs for all users from DirectAdmin
+        Rebuild Nginx vhost configs for users and domains whose DirectAdmin files changed since the last run
+        :param only_users: check these users only instead of all users
+        :return: number of rebuilt users and domains
         """
         if not os.path.exists(self.source_da_dir):
             raise Exception("DirectAdmin users config dir must exist: {}".format(self.source_da_dir))
 
-        for user_name in os.listdir(self.source_da_dir):
-            self.delete_user(user_name)
-            self.rebuild_user(user_name)
+        if only_users is None:
+            checked_users = set(os.listdir(self.source_da_dir)) | set(self.source_state.users)
+        else:
+            checked_users = set(only_users)
 
-        self._save()
+        user_names = set(user_name for user_name in checked_users
+                         if os.path.isdir(os.path.join(self.source_da_dir, user_name)))
+
+        rebuilt = 0
+        for user_name in checked_users - user_names:
+            if self.source_state.get_user_state(user_name) is not None:
+                self.delete_user(user_name, save=False)
+                rebuilt += 1
+
+        for user_name in sorted(user_names):
+            user_dir = os.path.join(self.source_da_dir, user_name)
+
+            if self.source_state.get_user_state(user_name) != user_source_state(user_dir):
+                self.delete_user(user_name, save=False)
+                self.rebuild_user(user_name, save=False)
+                rebuilt += 1
+                continue
+
+            da_user_config = DirectAdminUserConfig(user_dir)
+            for domain_name, domain_state in self.source_state.get_domain_states(user_name).items():
+                if domain_state != domain_source_state(user_dir, domain_name):
+                    print("Rebuilding domain: {}".format(domain_name))
+                    self._delete_domain(domain_name)
+
+                    domain_vhost = read_domain_vhost(da_user_config, domain_name)
+                    self._apply_domain_vhost(user_name, domain_vhost)
+                    self.source_state.set_domain(user_name, domain_name, domain_vhost[4])
+                    rebuilt += 1
+
+        if rebuilt:
+            self._save()
+
+        return rebuilt
+
+
+def render_hash_tuning(map_sections, previous_contents=None):
+    """
+    Renders map hash size directives fitting the maps. Replaying the nginx hash size search takes seconds
+    for 100k keys, so the previous sizes are kept until the maps get longer keys or more keys than
+    HASH_TUNING_KEYS_GROWTH times the keys they were computed for.
+    :param map_sections: NginxMap objects
+    :param previous_contents: contents rendered before or None
+    :return: config contents
+    """
+    keys_count = sum(len(section.items) for section in map_sections)
+    max_key_length = max([max(map(len, section.items)) for section in map_sections if section.items] or [0])
+
+    header_match = _hash_tuning_header.match(previous_contents or '')
+    if header_match is not None and keys_count <= int(header_match.group(1)) * HASH_TUNING_KEYS_GROWTH and \
+            max_key_length <= int(header_match.group(2)):
+        return previous_contents
+
+    max_size, bucket_size = compute_map_hash_sizes(map_sections)
+
+    return "# Generated by nginxvhostctl.py for {} map keys up to {} chars\n" \
+           "map_hash_max_size {};\nmap_hash_bucket_size {};\n".format(keys_count, max_key_length,
+                                                                        max_size, bucket_size)
+
+
+def read_domain_vhost(da_user_config, domain_name):
+    """
+    Reads DirectAdmin domain config
+    :param da_user_config: DirectAdminUserConfig of the domain owner
+    :param domain_name: domain name
+    :return: (domain name, pointers, subdomains, https vhost template values or None, domain files state)
+    """
+    # files state is taken before reading, so changes made meanwhile are picked up by the next run
+    domain_state = domain_source_state(da_user_config.user_dir, domain_name)
+    domain = da_user_config.get_domain(domain_name)
+
+    https_vhost_values = None
+
+    config = domain.get_config(SSL_CONFIG_KEYS)
+    if config.has_key('SSLCertificateFile') and config.has_key('SSLCertificateKeyFile'):
+        https_vhost_values = {
+            'sslkey': config['SSLCertificateKeyFile'],
+            'sslcrt': config['SSLCertificateFile'],
+            'user': da_user_config.user_name,
+            'domain': domain.domain_name,
+        }
+
+    return domain.domain_name, domain.get_pointers(), domain.get_subdomains(), https_vhost_values, domain_state
+
+
+def read_user_vhosts(user_dir):
+    """
+    Reads DirectAdmin user config of the user domains
+    :param user_dir: DirectAdmin user config dir
+    :return: (user files state, list of vhosts returned by read_domain_vhost())
+    """
+    user_state = user_source_state(user_dir)
+    da_user_config = DirectAdminUserConfig(user_dir)
+
+    user_vhosts = [read_domain_vhost(da_user_config, domain_name)
+                   for domain_name in da_user_config.get_domain_names()]
+
+    return user_state, user_vhosts
+
+
+def _read_user_vhosts_job(user_dir):
+    user_state, user_vhosts = read_user_vhosts(user_dir)
+
+    return os.path.basename(user_dir), user_state, user_vhosts
+
+
+def print_dry_run_diff(diff, show_keys=False):
+    """
+    Prints changes returned by NginxVhostsConfigManager.get_dry_run_diff()
+    :param show_keys: print every added, removed and changed map key
+    :return: number of changed map keys and https vhosts
+    """
+    changes = 0
+    total_bytes = 0
+
+    for map_file_name, added_keys, removed_keys, changed_keys, map_bytes in diff['maps']:
+        print("    {}: +{} -{} ~{}, {} bytes to write".format(map_file_name, len(added_keys), len(removed_keys),
+                                                              len(changed_keys), map_bytes))
+        if show_keys:
+            for sign, map_keys in (('+', added_keys), ('-', removed_keys), ('~', changed_keys)):
+                for map_key in map_keys:
+                    print("        {} {}".format(sign, map_key))
+
+        changes += len(added_keys) + len(removed_keys) + len(changed_keys)
+        total_bytes += map_bytes
+
+    for https_vhost_file, action, vhost_bytes in diff['vhosts']:
+        print("    {}: {}, {} bytes to write".format(https_vhost_file, action, vhost_bytes))
+        changes += 1
+        total_bytes += vhost_bytes
+
+    print("Dry run: {} map keys changed, {} https vhosts changed, {} bytes to write".format(
+            changes - len(diff['vhosts']), len(diff['vhosts']), total_bytes))
+
+    return changes
+
+
+def apply_operations(conf_manager, operations):
+    """
+    Applies queued user operations in one config manager session with a single clean pass and save
+    :param conf_manager: NginxVhostsConfigManager
+    :param operations: list of (operation, user name), operation is 'rebuild' or 'delete'
+    :return: True if all operations succeeded
+    """
+    succeeded = True
+    for operation, user_name in operations:
+        try:
+            conf_manager.delete_user(user_name, save=False)
+            if operation == 'rebuild':
+                conf_manager.rebuild_user(user_name, save=False)
+        except Exception as e:
+            print("Failed to {} user {}: {}".format(operation, user_name, e))
+            succeeded = False
+
+    conf_manager.clean_unresolved_domains(save=False)
+    conf_manager._save()
+
+    return succeeded
 
 
 def main():
@@ -273,13 +1539,245 @@ def main():
     mutual_group = parser.add_mutually_exclusive_group()
     mutual_group.add_argument('--rebuild-all', action='store_true',
                               help='Rebuild vhosts using DirectAdmin user configs for all users')
-    mutual_group.add_argument('-r', '--rebuild', dest="rebuild_user",
-                              help='Rebuild vhosts using DirectAdmin user configs for the specific user')
-    mutual_group.add_argument('-d', '--delete', dest="delete_user",
-                              help='Rebuild vhosts using DirectAdmin user configs for the specific user')
+    mutual_group.add_argument('--rebuild-changed', action='store_true',
+                              help='Rebuild vhosts for users and domains whose DirectAdmin configs changed '
+                                   'since the last run')
+    mutual_group.add_argument('-r', '--rebuild', dest="rebuild_users", nargs='+', metavar='REBUILD_USER',
+                              help='Rebuild vhosts using DirectAdmin user configs for the specific users')
+    mutual_group.add_argument('-d', '--delete', dest="delete_users", nargs='+', metavar='DELETE_USER',
+                              help='Delete vhosts of the specific users')
+    mutual_group.add_argument('--batch', dest="batch_file",
+                              help='Apply "rebuild USER" and "delete USER" lines of the file, - for stdin, '
+                                   'in one session')
+    mutual_group.add_argument('--daemon', action='store_true',
+                              help='Keep maps in memory, apply DirectAdmin users config changes and serve '
+                                   'commands on the daemon socket')
+    mutual_group.add_argument('--rollback', action='store_true',
+                              help='Publish the generation the current one was built from')
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of worker processes reading DirectAdmin user configs on --rebuild-all")
+    parser.add_argument("--unchanged-exit-code", dest="unchanged_exit_code", type=int, default=0,
+                        help="Exit code to return when no Nginx config file was changed")
+    parser.add_argument("--socket", dest="socket_path", default='/var/run/nginxdirect.sock',
+                        help="Daemon Unix socket")
+    parser.add_argument("--connect", action='store_true',
+                        help="Send the command to the running daemon instead of running it")
+    parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=5.0,
+                        help="Daemon DirectAdmin users config check interval when inotify is not used")
+    parser.add_argument("--no-inotify", dest="use_inotify", action='store_false',
+                        help="Poll DirectAdmin users config instead of using inotify in the daemon")
+    parser.add_argument("--coalesce-window", dest="coalesce_window", type=float,
+                        help="Queue --rebuild/--delete and apply queued users in one batch after waiting "
+                             "this many seconds for more hook events")
+    parser.add_argument("--reload-services", dest="reload_services", default='',
+                        help="Comma separated services to configtest and reload if the configs they use changed")
+    parser.add_argument("--reload-config", dest="reload_config",
+                        help="JSON file with configtest and reload commands and artifacts of the services")
+    parser.add_argument("--min-reload-interval", dest="min_reload_interval", type=float, default=2.0,
+                        help="Seconds between reloads of the same service")
+    parser.add_argument("--sharded", action='store_true',
+                        help="Save map items to a file per user under OUT_CONFIG_DIR/maps, included by the map files")
+    parser.add_argument("--layout", choices=(LAYOUT_SEPARATE, LAYOUT_COMBINED), default=LAYOUT_SEPARATE,
+                        help="Save $user, $domain and $subdomain maps or a single $vhost map with "
+                             "\"user|domain|subdomain\" values")
+    parser.add_argument("--group-ssl", dest="group_ssl", action='store_true',
+                        help="Write one https vhost per SSL certificate and key with the domains and pointers "
+                             "using them")
+    parser.add_argument("--journal", action='store_true',
+                        help="Append map changes to OUT_CONFIG_DIR/.nginxdirect.journal instead of saving the map "
+                             "files until they are compacted")
+    parser.add_argument("--journal-max-size", dest="journal_max_size", type=int,
+                        default=NginxVhostsConfigManager.JOURNAL_MAX_SIZE,
+                        help="Journal size in bytes the map files are saved at")
+    parser.add_argument("--compact-journal", dest="compact_journal", action='store_true',
+                        help="Save the map files with the journal changes, done before --reload-services too")
+    parser.add_argument("--generations", type=int, default=0,
+                        help="Build every change in a new OUT_CONFIG_DIR/generations dir published by "
+                             "OUT_CONFIG_DIR/current symlink and keep this many of them, 0 writes in place")
+    parser.add_argument("--include-dir", dest="include_dir",
+                        help="Path nginx includes the published files by, relative to its prefix, the map files "
+                             "of --sharded include the user files by it, hosting or hosting/current with "
+                             "--generations if not set")
+    parser.add_argument("--publish", dest="publish_targets", action='append', metavar='PUBLISH_TARGET',
+                        help="Push changed maps and https vhosts to a local dir or run a command template with "
+                             "{root}, {files} and {removed}, may be repeated")
+    parser.add_argument("--dry-run", dest="dry_run", action='store_true',
+                        help="Report map keys and https vhosts the action changes without writing them")
+    parser.add_argument("--diff", action='store_true',
+                        help="Dry run listing every changed map key")
+    parser.add_argument("--gc-https", dest="gc_https", action='store_true',
+                        help="Remove https vhost configs of domains missing from the maps")
+    parser.add_argument("--lock-timeout", dest="lock_timeout", type=float, default=60.0,
+                        help="Seconds to wait until another run releases the out dir")
+    parser.add_argument("--metrics-json", dest="metrics_json",
+                        help="File to append phase timings and counters of the run to as a JSON line, - for stdout")
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        help="Prometheus textfile to write phase timings and counters of the run to")
 
     args = parser.parse_args()
 
+    metrics.reset()
+    exit_code = 1
+    try:
+        exit_code = run(args)
+    finally:
+        write_run_metrics(args, exit_code)
+
+    return exit_code
+
+
+def acquire_manager_lock(working_dir, timeout):
+    """
+    Acquires the config manager lock of the working dir and reports a noticeable wait
+    :return: acquired FileLock
+    """
+    manager_lock = NginxVhostsConfigManager.get_lock(working_dir, timeout)
+    manager_lock.acquire()
+
+    if manager_lock.wait_seconds >= 0.1:
+        print("Waited {:.3f}s for the lock of {}".format(manager_lock.wait_seconds, working_dir))
+
+    return manager_lock
+
+
+def compact_journal_before_reload(args, conf_manager):
+    """
+    Saves the map files with the journal changes on --compact-journal or before --reload-services,
+    must be called under the manager lock
+    """
+    if args.compact_journal or conf_manager.journal and args.reload_services:
+        conf_manager.compact_journal()
+
+
+def publish_configs(args, conf_manager):
+    """
+    Pushes configs changed since the last push to every --publish target, must be called under the manager lock
+    :return: True if all targets were published
+    """
+    if not args.publish_targets or conf_manager.dry_run:
+        return True
+
+    publisher = Publisher(conf_manager.output_dir, conf_manager.PUBLISH_NAMES,
+                          os.path.join(args.out_config_dir, conf_manager.PUBLISH_STATE_DIR_NAME),
+                          [parse_target(target_spec) for target_spec in args.publish_targets])
+
+    published = True
+    for target_name, changed_count, removed_count, error in publisher.publish():
+        if error is not None:
+            print("    Failed to publish to {}: {}".format(target_name, error))
+            published = False
+        else:
+            print("    Published to {}: {} changed, {} removed".format(target_name, changed_count, removed_count))
+
+    return published
+
+
+def get_reload_service_names(args):
+    return [service_name for service_name in args.reload_services.split(',') if service_name]
+
+
+def create_reload_orchestrator(args):
+    """
+    Returns ReloadOrchestrator of --reload-config or the default services
+    """
+    if args.reload_config:
+        services = load_services_config(args.reload_config)
+    else:
+        services = default_services()
+
+    return ReloadOrchestrator(services,
+                              os.path.join(args.out_config_dir, NginxVhostsConfigManager.RELOAD_STATE_NAME),
+                              args.min_reload_interval)
+
+
+def reload_changed_services(args, conf_manager):
+    """
+    Reloads services of --reload-services using configs changed by the manager
+    """
+    service_names = get_reload_service_names(args)
+    if not service_names or not conf_manager.changed_files:
+        return
+
+    reloaded_services = create_reload_orchestrator(args).reload(conf_manager.get_changed_artifacts(), service_names)
+    if reloaded_services:
+        print("Reloaded: {}".format(', '.join(reloaded_services)))
+
+
+def get_action(args):
+    if args.rebuild_all:
+        return 'rebuild-all'
+    elif args.rebuild_changed:
+        return 'rebuild-changed'
+    elif args.daemon:
+        return 'daemon'
+    elif args.rollback:
+        return 'rollback'
+    elif args.batch_file:
+        return 'batch'
+    elif args.delete_users:
+        return 'delete'
+
+    return 'rebuild'
+
+
+def read_batch_operations(batch_file):
+    """
+    Reads user operations, one "rebuild USER" or "delete USER" per line, # starts a comment
+    :param batch_file: open file
+    :return: list of (operation, user name)
+    """
+    operations = []
+    for line_number, line in enumerate(batch_file, 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+
+        if len(fields) != 2 or fields[0] not in ('rebuild', 'delete'):
+            raise Exception("Invalid batch operation at line {}: {}".format(line_number, line.strip()))
+
+        operations.append((fields[0], fields[1]))
+
+    return operations
+
+
+def get_user_operations(args):
+    """
+    Returns list of (operation, user name) given by --rebuild, --delete or --batch
+    """
+    if args.batch_file == '-':
+        return read_batch_operations(sys.stdin)
+    elif args.batch_file:
+        with open(args.batch_file, 'r') as batch_file:
+            return read_batch_operations(batch_file)
+    elif args.delete_users:
+        return [('delete', user_name) for user_name in args.delete_users]
+    elif args.rebuild_users:
+        return [('rebuild', user_name) for user_name in args.rebuild_users]
+
+    return []
+
+
+def write_run_metrics(args, exit_code):
+    """
+    Writes metrics of the run to the files given in the command line
+    """
+    labels = {'action': get_action(args)}
+
+    if args.metrics_json:
+        metrics_line = metrics.to_json(exit_code=exit_code, **labels)
+        if args.metrics_json == '-':
+            print(metrics_line)
+        else:
+            with open(args.metrics_json, 'a') as metrics_file:
+                metrics_file.write(metrics_line + '\n')
+
+    if args.metrics_prom:
+        metrics.add('exit_code', exit_code)
+        replace_file_contents(args.metrics_prom, metrics.to_prometheus(**labels))
+
+
+def run(args):
     # validate global args
     if not os.path.exists(args.out_config_dir):
         raise Exception("Directory must exist: {}".format(args.out_config_dir))
@@ -287,30 +1785,143 @@ def main():
     if not os.path.exists(args.da_users_config_dir):
         raise Exception("Directory must exist: {}".format(args.da_users_config_dir))
 
-    # dispatch
-    conf_manager = NginxVhostsConfigManager(args.out_config_dir, args.da_users_config_dir)
+    operations = get_user_operations(args)
+    dry_run = args.dry_run or args.diff
 
-    print("Updating Nginx vhosts config:")
-    print("    Nginx config dir: {}".format(args.out_config_dir))
-    print("    DirectAdmin users config dir: {}".format(args.da_users_config_dir))
+    if dry_run and (args.connect or args.daemon or args.coalesce_window is not None):
+        raise Exception("--dry-run can't be used with --connect, --daemon or --coalesce-window")
 
-    conf_manager.clean_unresolved_domains()
+    if args.rollback and (dry_run or args.connect or not args.generations):
+        raise Exception("--rollback requires --generations and can't be used with --dry-run or --connect")
 
-    if args.rebuild_all:
-        conf_manager.rebuild_all()
-    else:
-        if args.delete_user:
-            conf_manager.delete_user(args.delete_user)
+    if args.connect and get_reload_service_names(args):
+        raise Exception("--reload-services can't be used with --connect, the daemon reloads the services "
+                        "given to --daemon")
+
+    if args.connect:
+        if args.rebuild_all:
+            command_lines = ['rebuild-all']
+        elif args.rebuild_changed:
+            command_lines = ['rebuild-changed']
+        else:
+            command_lines = ['{} {}'.format(operation, user_name) for operation, user_name in operations]
+
+        changed_files_count = 0
+        for command_line in command_lines:
+            command_changed_files_count = send_command(args.socket_path, command_line)
+            print("Daemon {}: {} files changed".format(command_line, command_changed_files_count))
+            changed_files_count += command_changed_files_count
+
+        return 0 if changed_files_count else args.unchanged_exit_code
+
+    if args.coalesce_window is not None:
+        if not operations:
+            raise Exception("--coalesce-window requires --rebuild, --delete or --batch")
+
+        rebuild_queue = RebuildQueue(os.path.join(args.out_config_dir, NginxVhostsConfigManager.QUEUE_DIR_NAME))
+        for operation, user_name in operations:
+            rebuild_queue.enqueue(operation, user_name)
+
+        # batches applied by this run with a failed operation or target
+        failed_batches = []
+
+        def apply_batch(operations):
+            manager_lock = acquire_manager_lock(args.out_config_dir, args.lock_timeout)
+            try:
+                batch_manager = NginxVhostsConfigManager(args.out_config_dir, args.da_users_config_dir,
+                                                         args.sharded, layout=args.layout,
+                                                         group_ssl=args.group_ssl, journal=args.journal,
+                                                         journal_max_size=args.journal_max_size,
+                                                         generations=args.generations,
+                                                         include_dir=args.include_dir)
+                succeeded = apply_operations(batch_manager, operations)
+                compact_journal_before_reload(args, batch_manager)
+                published = publish_configs(args, batch_manager)
+            finally:
+                manager_lock.release()
+            metrics.add('changed_files', len(batch_manager.changed_files))
+
+            # files of the succeeded operations are saved, later runs don't see them changed
+            reload_changed_services(args, batch_manager)
+
+            if not succeeded or not published:
+                failed_batches.append(operations)
+
+        if not rebuild_queue.run(apply_batch, args.coalesce_window):
+            print("Queued {} operations, the running batch applies them".format(len(operations)))
+
+        return 1 if failed_batches else 0
+
+    # dispatch, the daemon locks the working dir for every operation itself
+    succeeded = True
+    manager_lock = acquire_manager_lock(args.out_config_dir, args.lock_timeout)
+    try:
+        conf_manager = NginxVhostsConfigManager(args.out_config_dir, args.da_users_config_dir, args.sharded,
+                                                dry_run, args.layout, args.group_ssl, args.journal,
+                                                args.journal_max_size, args.generations, args.include_dir)
+
+        print("Updating Nginx vhosts config:")
+        print("    Nginx config dir: {}".format(args.out_config_dir))
+        print("    DirectAdmin users config dir: {}".format(args.da_users_config_dir))
+
+        if args.rollback:
+            print("    Rolled back to generation {}".format(conf_manager.rollback_generation()))
+        elif operations:
+            # user operations are cleaned and saved once at the end
+            succeeded = apply_operations(conf_manager, operations)
         else:
-            conf_manager.delete_user(args.rebuild_user)
-            conf_manager.rebuild_user(args.rebuild_user)
+            conf_manager.clean_unresolved_domains()
+
+            if args.rebuild_all:
+                conf_manager.rebuild_all(args.jobs)
+            elif args.rebuild_changed:
+                conf_manager.rebuild_changed()
+
+        if args.gc_https:
+            conf_manager.gc_https_vhosts()
+
+        compact_journal_before_reload(args, conf_manager)
+        published = publish_configs(args, conf_manager)
+    finally:
+        manager_lock.release()
+
+    if args.daemon:
+        reload_changed_services(args, conf_manager)
+
+        service_names = get_reload_service_names(args)
+        NginxDirectDaemon(conf_manager, args.socket_path, args.poll_interval, args.use_inotify,
+                          lock_timeout=args.lock_timeout,
+                          reload_orchestrator=create_reload_orchestrator(args) if service_names else None,
+                          reload_service_names=service_names).serve_forever()
+        return 0
+
+    if dry_run:
+        if not print_dry_run_diff(conf_manager.get_dry_run_diff(), args.diff):
+            return args.unchanged_exit_code
+        return 0 if succeeded else 1
+
+    metrics.add('changed_files', len(conf_manager.changed_files))
+    for changed_file in conf_manager.changed_files:
+        print("    Changed: {}".format(changed_file))
+
+    # files of the succeeded operations are saved, later runs don't see them changed
+    reload_changed_services(args, conf_manager)
+
+    if not succeeded or not published:
+        return 1
+
+    if not conf_manager.changed_files:
+        print("Nginx config is not changed")
+        return args.unchanged_exit_code
+
+    return 0
 
 
 if __name__ == "__main__":
     try:
-        main()
+        exit_code = main()
     except Exception as ex:
         traceback.print_exc(file=sys.stdout)
         exit(1)
 
-    exit(0)
+    exit(exit_code)
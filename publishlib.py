@@ -0,0 +1,240 @@
+from __future__ import print_function
+
+import errno
+import hashlib
+import json
+import os
+import pipes
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from metricslib import metrics
+from nginxlib import replace_file_contents
+
+
+def build_manifest(root_dir, names, previous_manifest=None):
+    """
+    Returns content hashes of the files, files with the same size, mtime and inode as in the previous
+    manifest are not read again
+    :param root_dir: directory the paths are relative to
+    :param names: files and directories of the root dir, missing ones are skipped
+    :param previous_manifest: manifest returned by the previous call
+    :return: dict of relative path to [sha1, size, mtime, inode]
+    """
+    assert root_dir, "Root dir must be specified"
+
+    previous_manifest = previous_manifest or {}
+    manifest = {}
+    for name in names:
+        source_path = os.path.join(root_dir, name)
+        if os.path.isfile(source_path):
+            file_paths = [name]
+        else:
+            file_paths = [os.path.relpath(os.path.join(dir_path, file_name), root_dir)
+                          for dir_path, dir_names, file_names in os.walk(source_path)
+                          for file_name in file_names if not file_name.endswith('.tmp')]
+
+        for file_path in file_paths:
+            try:
+                file_stat = os.stat(os.path.join(root_dir, file_path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            file_state = [file_stat.st_size, file_stat.st_mtime, file_stat.st_ino]
+            previous_entry = previous_manifest.get(file_path)
+            if previous_entry is not None and previous_entry[1:] == file_state:
+                manifest[file_path] = previous_entry
+                continue
+
+            with open(os.path.join(root_dir, file_path), 'rb') as hashed_file:
+                contents = hashed_file.read()
+            metrics.add('files_read')
+            metrics.add('bytes_read', len(contents))
+
+            manifest[file_path] = [hashlib.sha1(contents).hexdigest()] + file_state
+
+    return manifest
+
+
+def load_manifest(file_name):
+    """
+    Loads manifest saved by save_manifest(), missing or broken manifest is empty
+    """
+    try:
+        with open(file_name, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+    except ValueError:
+        return {}
+
+    # paths are joined with str paths of the root dir
+    return dict((file_path.encode('utf-8'), entry) for file_path, entry in manifest.items())
+
+
+def save_manifest(file_name, manifest):
+    replace_file_contents(file_name, json.dumps(manifest, sort_keys=True))
+
+
+class LocalDirTarget(object):
+    """
+    Copies files to a local directory, e.g. NFS mount of a front-end or a stand-in for tests
+    """
+
+    def __init__(self, target_dir):
+        assert target_dir, "Target dir must be specified"
+
+        self.name = target_dir
+        self.target_dir = target_dir
+
+    def push(self, root_dir, changed_paths, removed_paths):
+        for file_path in changed_paths:
+            target_path = os.path.join(self.target_dir, file_path)
+            if not os.path.isdir(os.path.dirname(target_path)):
+                os.makedirs(os.path.dirname(target_path))
+
+            # front-end reloads never see half-copied files
+            tmp_path = '%s.%d.tmp' % (target_path, os.getpid())
+            shutil.copyfile(os.path.join(root_dir, file_path), tmp_path)
+            os.rename(tmp_path, target_path)
+
+        for file_path in removed_paths:
+            try:
+                os.remove(os.path.join(self.target_dir, file_path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class CommandTarget(object):
+    """
+    Runs a command template, e.g. rsync over ssh. {root} is replaced with the root dir, {files} and {removed}
+    with files listing changed and removed paths relative to the root dir, one per line. A template without
+    {removed} fails to push removed paths, they are left on the target otherwise:
+    sh -c 'rsync -a --files-from={files} {root}/ edge1:/etc/nginx/hosting/ &&
+           ssh edge1 "cd /etc/nginx/hosting && xargs -r rm -f" < {removed}'
+    """
+
+    def __init__(self, command_template):
+        assert command_template, "Command template must be specified"
+
+        self.name = command_template
+        self.command_template = command_template
+
+    def push(self, root_dir, changed_paths, removed_paths):
+        if removed_paths and '{removed}' not in self.command_template:
+            raise Exception("Command template has no {{removed}} to remove {} files".format(len(removed_paths)))
+
+        list_file_names = []
+        try:
+            for paths in (changed_paths, removed_paths):
+                list_fd, list_file_name = tempfile.mkstemp(prefix='nginxdirect-publish-')
+                list_file_names.append(list_file_name)
+                with os.fdopen(list_fd, 'w') as list_file:
+                    list_file.write(''.join(path + '\n' for path in paths))
+
+            command = shlex.split(self.command_template.format(root=pipes.quote(root_dir),
+                                                               files=pipes.quote(list_file_names[0]),
+                                                               removed=pipes.quote(list_file_names[1])))
+            with open(os.devnull, 'w') as devnull:
+                exit_code = subprocess.call(command, stdout=devnull, stderr=devnull)
+        finally:
+            for list_file_name in list_file_names:
+                os.remove(list_file_name)
+
+        if exit_code:
+            raise Exception("Command exited with {}".format(exit_code))
+
+
+def parse_target(target_spec):
+    """
+    Returns CommandTarget for templates with placeholders, LocalDirTarget otherwise
+    """
+    assert target_spec, "Target must be specified"
+
+    if '{' in target_spec:
+        return CommandTarget(target_spec)
+
+    return LocalDirTarget(target_spec)
+
+
+class Publisher(object):
+    """
+    Pushes files changed since the last successful push to every target concurrently. The manifest pushed
+    to a target is kept in the state dir, a failed target gets all its changes on the next publish.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, root_dir, names, state_dir, targets):
+        """
+        :param root_dir: directory with the files to publish
+        :param names: files and directories of the root dir to publish
+        :param state_dir: directory with the manifest and the manifests pushed to the targets
+        :param targets: LocalDirTarget or CommandTarget objects
+        """
+        assert root_dir, "Root dir must be specified"
+        assert state_dir, "State dir must be specified"
+
+        self.root_dir = root_dir
+        self.names = names
+        self.state_dir = state_dir
+        self.targets = targets
+
+    def _get_target_manifest_name(self, target):
+        return os.path.join(self.state_dir, 'target-%s.json' % hashlib.sha1(target.name).hexdigest()[:16])
+
+    def publish(self):
+        """
+        Writes the manifest and pushes the changes to the targets
+        :return: list of (target name, number of changed files, number of removed files, error or None)
+        """
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, 0o700)
+
+        manifest_file_name = os.path.join(self.state_dir, self.MANIFEST_NAME)
+        with metrics.phase('manifest'):
+            manifest = build_manifest(self.root_dir, self.names, load_manifest(manifest_file_name))
+        save_manifest(manifest_file_name, manifest)
+
+        results = [None] * len(self.targets)
+        threads = [threading.Thread(target=self._push, args=(manifest, target, results, position))
+                   for position, target in enumerate(self.targets)]
+        with metrics.phase('publish'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        for target_name, changed_count, removed_count, error in results:
+            metrics.add('publish_files_pushed', changed_count + removed_count)
+            if error is not None:
+                metrics.add('publish_targets_failed')
+
+        return results
+
+    def _push(self, manifest, target, results, position):
+        target_manifest_name = self._get_target_manifest_name(target)
+        target_manifest = load_manifest(target_manifest_name)
+
+        changed_paths = sorted(file_path for file_path, entry in manifest.items()
+                               if file_path not in target_manifest or target_manifest[file_path][0] != entry[0])
+        removed_paths = sorted(file_path for file_path in target_manifest if file_path not in manifest)
+
+        if changed_paths or removed_paths:
+            try:
+                target.push(self.root_dir, changed_paths, removed_paths)
+            except Exception as e:
+                results[position] = (target.name, 0, 0, str(e))
+                return
+
+            save_manifest(target_manifest_name, manifest)
+
+        results[position] = (target.name, len(changed_paths), len(removed_paths), None)
@@ -0,0 +1,106 @@
+from __future__ import print_function
+
+import errno
+import fcntl
+import os
+import time
+
+QUEUE_OPERATIONS = ('rebuild', 'delete')
+
+
+class RebuildQueue(object):
+    """
+    Pending user operations. Hooks enqueue users, a single runner applies pending operations in batches.
+    The last operation enqueued for a user wins.
+    """
+
+    def __init__(self, queue_dir):
+        assert queue_dir, "Queue dir must be specified"
+
+        self.queue_dir = queue_dir
+        self.batch_dir = os.path.join(queue_dir, '.batch')
+        self.lock_file_name = os.path.join(queue_dir, '.lock')
+
+        for path in (self.queue_dir, self.batch_dir):
+            try:
+                os.makedirs(path, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def enqueue(self, operation, user_name):
+        assert operation in QUEUE_OPERATIONS, "Unknown operation: {}".format(operation)
+        assert user_name, "User name must be specified"
+
+        if user_name.startswith('.') or os.sep in user_name:
+            raise ValueError("Invalid user name: {}".format(user_name))
+
+        tmp_file_name = os.path.join(self.queue_dir, '.{}.{}.tmp'.format(user_name, os.getpid()))
+        with open(tmp_file_name, 'w') as operation_file:
+            operation_file.write(operation)
+
+        os.rename(tmp_file_name, os.path.join(self.queue_dir, user_name))
+
+    def is_empty(self):
+        return not self._pending_users(self.queue_dir) and not self._pending_users(self.batch_dir)
+
+    @staticmethod
+    def _pending_users(path):
+        return [file_name for file_name in os.listdir(path) if not file_name.startswith('.')]
+
+    def take(self):
+        """
+        Takes all pending operations out of the queue
+        :return: list of (operation, user name)
+        """
+        # claim operations first: a hook enqueueing the same user meanwhile creates a new entry
+        for user_name in self._pending_users(self.queue_dir):
+            os.rename(os.path.join(self.queue_dir, user_name), os.path.join(self.batch_dir, user_name))
+
+        operations = []
+        for user_name in sorted(self._pending_users(self.batch_dir)):
+            with open(os.path.join(self.batch_dir, user_name), 'r') as operation_file:
+                operation = operation_file.read().strip()
+
+            if operation in QUEUE_OPERATIONS:
+                operations.append((operation, user_name))
+            else:
+                print("Skipping unknown operation {} for user {}".format(operation, user_name))
+
+        return operations
+
+    def done(self, operations):
+        """
+        Removes applied operations taken by take()
+        """
+        for operation, user_name in operations:
+            os.remove(os.path.join(self.batch_dir, user_name))
+
+    def run(self, apply_batch, window=1.0):
+        """
+        Applies pending operations in batches until the queue is empty.
+        Returns at once if another runner is active: it picks up operations enqueued meanwhile.
+        :param apply_batch: callable taking a list of (operation, user name)
+        :param window: seconds to wait for more operations before applying a batch
+        :return: False if another runner is active
+        """
+        while True:
+            with open(self.lock_file_name, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno in (errno.EAGAIN, errno.EACCES):
+                        return False
+                    raise
+
+                time.sleep(window)
+
+                operations = self.take()
+                if operations:
+                    apply_batch(operations)
+                    self.done(operations)
+
+            # operations enqueued while the lock was held are ours
+            if self.is_empty():
+                return True
+
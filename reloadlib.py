@@ -0,0 +1,165 @@
+from __future__ import print_function
+
+import errno
+import json
+import os
+import shlex
+import subprocess
+import time
+
+from metricslib import metrics
+from nginxlib import replace_file_contents
+
+ARTIFACT_MAPS = 'maps'
+ARTIFACT_HTTPS_VHOSTS = 'https_vhosts'
+
+
+def default_services(init_dir='/etc/init.d'):
+    """
+    Returns service commands of init scripts. nginx serves everything generated, Apache SSL vhosts of
+    DirectAdmin change together with the https vhosts of the domain.
+    """
+    return {
+        'nginx': {
+            'configtest': [os.path.join(init_dir, 'nginx'), 'configtest'],
+            'reload': [os.path.join(init_dir, 'nginx'), 'reload'],
+            'artifacts': [ARTIFACT_MAPS, ARTIFACT_HTTPS_VHOSTS],
+        },
+        'httpd': {
+            'configtest': [os.path.join(init_dir, 'httpd'), 'configtest'],
+            'reload': [os.path.join(init_dir, 'httpd'), 'reload'],
+            'artifacts': [ARTIFACT_HTTPS_VHOSTS],
+        },
+    }
+
+
+def load_services_config(file_name, init_dir='/etc/init.d'):
+    """
+    Loads service commands from JSON config, services missing in the file keep the default commands, new
+    services must set both commands:
+    {"nginx": {"configtest": "nginx -t", "reload": "nginx -s reload", "artifacts": ["maps", "https_vhosts"]}}
+    :return: dict of service name to dict with configtest and reload argv and artifacts
+    """
+    assert file_name, "File must be specified"
+
+    services = default_services(init_dir)
+    with open(file_name, 'r') as config_file:
+        services_config = json.load(config_file)
+
+    for service_name, service_config in services_config.items():
+        service = services.setdefault(service_name, {'configtest': None, 'reload': None, 'artifacts': []})
+        for command_name in ('configtest', 'reload'):
+            command = service_config.get(command_name, service[command_name])
+            if isinstance(command, basestring):
+                command = shlex.split(command)
+            if not isinstance(command, list) or not command or \
+                    not all(isinstance(argument, basestring) for argument in command):
+                raise Exception("Service {} of {} must have {} command".format(service_name, file_name, command_name))
+            service[command_name] = command
+
+        service['artifacts'] = service_config.get('artifacts', service['artifacts'])
+
+    return services
+
+
+class ReloadOrchestrator(object):
+    """
+    Reloads services affected by changed artifacts: config tests run concurrently, every service
+    is reloaded at most once per min_reload_interval
+    """
+
+    def __init__(self, services, state_file_name=None, min_reload_interval=0.0):
+        """
+        :param services: dict returned by default_services() or load_services_config()
+        :param state_file_name: file keeping last reload time of every service between runs
+        :param min_reload_interval: seconds between reloads of the same service
+        """
+        assert services, "Services must be specified"
+
+        self.services = services
+        self.state_file_name = state_file_name
+        self.min_reload_interval = min_reload_interval
+
+    def get_affected_services(self, changed_artifacts, service_names=None):
+        """
+        :param changed_artifacts: set of ARTIFACT_* changed by the run
+        :param service_names: services allowed to reload, all services if None
+        :return: sorted names of services depending on the changed artifacts
+        """
+        if service_names is None:
+            service_names = self.services.keys()
+
+        for service_name in service_names:
+            if service_name not in self.services:
+                raise Exception("Unknown service: {}".format(service_name))
+
+        return sorted(service_name for service_name in service_names
+                      if set(self.services[service_name]['artifacts']) & set(changed_artifacts))
+
+    def _run_concurrently(self, command_name, service_names):
+        """
+        Runs the command of every service at once
+        :return: list of services whose command failed
+        """
+        processes = []
+        with open(os.devnull, 'w') as devnull:
+            for service_name in service_names:
+                command = self.services[service_name][command_name]
+                try:
+                    processes.append((service_name, subprocess.Popen(command, stdout=devnull, stderr=devnull)))
+                except OSError as e:
+                    print("Failed to run {} {}: {}".format(service_name, command_name, e))
+                    processes.append((service_name, None))
+
+            return [service_name for service_name, process in processes if process is None or process.wait()]
+
+    def _load_reload_times(self):
+        if not self.state_file_name:
+            return {}
+
+        try:
+            with open(self.state_file_name, 'r') as state_file:
+                return json.load(state_file)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+
+        return {}
+
+    def reload(self, changed_artifacts, service_names=None):
+        """
+        Tests configs of the affected services concurrently and reloads them if all tests passed
+        :param changed_artifacts: set of ARTIFACT_* changed by the run
+        :param service_names: services allowed to reload, all services if None
+        :return: names of reloaded services
+        """
+        affected_services = self.get_affected_services(changed_artifacts, service_names)
+        if not affected_services:
+            return []
+
+        with metrics.phase('configtest'):
+            failed_services = self._run_concurrently('configtest', affected_services)
+        if failed_services:
+            raise Exception("Config test failed: {}".format(', '.join(failed_services)))
+
+        # wait out the reload interval instead of skipping the reload, changes must reach the services
+        reload_times = self._load_reload_times()
+        last_reload_time = max(reload_times.get(service_name, 0) for service_name in affected_services)
+        wait_seconds = last_reload_time + self.min_reload_interval - time.time()
+        if wait_seconds > 0:
+            print("Waiting {:.1f}s before reloading {}".format(wait_seconds, ', '.join(affected_services)))
+            time.sleep(min(wait_seconds, self.min_reload_interval))
+
+        with metrics.phase('reload'):
+            failed_services = self._run_concurrently('reload', affected_services)
+
+        reload_times.update(dict.fromkeys(affected_services, time.time()))
+        if self.state_file_name:
+            replace_file_contents(self.state_file_name, json.dumps(reload_times))
+
+        if failed_services:
+            raise Exception("Reload failed: {}".format(', '.join(failed_services)))
+
+        return affected_services
@@ -0,0 +1,235 @@
+import errno
+import json
+import marshal
+import os
+
+from diradminlib import get_domain_source_files
+from diradminlib import get_user_source_files
+from nginxlib import replace_file_contents
+
+
+def file_state(file_name):
+    """
+    Returns [size, mtime, inode] of the file or None if it does not exist.
+    Files replaced by rename get a new inode even within the mtime resolution.
+    """
+    try:
+        file_stat = os.stat(file_name)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    return [file_stat.st_size, file_stat.st_mtime, file_stat.st_ino]
+
+
+def user_source_state(user_dir):
+    return [file_state(file_name) for file_name in get_user_source_files(user_dir)]
+
+
+def domain_source_state(user_dir, domain_name):
+    return [file_state(file_name) for file_name in get_domain_source_files(user_dir, domain_name)]
+
+
+class SourceStateCache(object):
+    """
+    Size and mtime of DirectAdmin files the maps were built from
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._packed_users = None
+        self._changed_users = set()
+        # states of users deleted since the last save, a user rebuilt with the same state is not a change
+        self._deleted_users = {}
+        self._journal_origins = None
+
+    @property
+    def users(self):
+        if self._packed_users is not None:
+            self._users = marshal.loads(self._packed_users)
+            self._packed_users = None
+
+        return self._users
+
+    @users.setter
+    def users(self, users):
+        self._users = users
+        self._packed_users = None
+
+    @property
+    def is_changed(self):
+        return bool(self._changed_users or self._deleted_users)
+
+    def mark_changed(self, user_names):
+        """
+        Marks users changed, e.g. after a replay of changes missing in the saved state
+        """
+        self._changed_users.update(user_names)
+
+    def _reset_changed(self):
+        self._changed_users = set()
+        self._deleted_users = {}
+
+    def pack(self):
+        """
+        Returns users state packed with marshal
+        """
+        if self._packed_users is not None:
+            return self._packed_users
+
+        return marshal.dumps(self._users)
+
+    def unpack(self, packed_users):
+        """
+        Sets users state packed by pack(), it is unpacked on the first access
+        """
+        self._packed_users = packed_users
+        self._reset_changed()
+
+    def get_user_state(self, user_name):
+        if user_name not in self.users:
+            return None
+
+        return self.users[user_name]['state']
+
+    def get_domain_states(self, user_name):
+        if user_name not in self.users:
+            return {}
+
+        return self.users[user_name]['domains']
+
+    def set_user(self, user_name, user_state, domain_states):
+        self._journal_user(user_name)
+
+        user = {'state': user_state, 'domains': domain_states}
+        if user_name in self.users:
+            previous_user = self.users[user_name]
+        else:
+            previous_user = self._deleted_users.pop(user_name, None)
+
+        self.users[user_name] = user
+        if user != previous_user:
+            self._changed_users.add(user_name)
+
+    def set_domain(self, user_name, domain_name, domain_state):
+        assert user_name in self.users, "User state must be set before the domain state"
+
+        user = self.users[user_name]
+        if user['domains'].get(domain_name) != domain_state:
+            self._journal_user(user_name)
+
+            # the journal origin of the user is kept unchanged
+            domain_states = dict(user['domains'])
+            domain_states[domain_name] = domain_state
+            self.users[user_name] = {'state': user['state'], 'domains': domain_states}
+            self._changed_users.add(user_name)
+
+    def del_user(self, user_name):
+        if user_name in self.users:
+            self._journal_user(user_name)
+            self._deleted_users[user_name] = self.users.pop(user_name)
+
+    def start_journal(self):
+        """
+        Starts recording user changes returned by pop_journal()
+        """
+        self._journal_origins = {}
+
+    def pop_journal(self):
+        """
+        Returns net user changes since start_journal() or the last pop_journal(), users changed back are skipped
+        :return: list of (user name, user state as JSON or None for removed users)
+        """
+        assert self._journal_origins is not None, "Journal must be started"
+
+        records = []
+        for user_name, origin_user in sorted(self._journal_origins.items()):
+            user = self.users.get(user_name)
+            if user != origin_user:
+                records.append((user_name, None if user is None else json.dumps(user, sort_keys=True)))
+
+        self._journal_origins = {}
+
+        return records
+
+    def replay_journal(self, records):
+        """
+        Applies user changes returned by pop_journal()
+        """
+        for user_name, user in records:
+            if user is not None:
+                user = json.loads(user)
+                self.set_user(user_name, user['state'], user['domains'])
+            else:
+                self.del_user(user_name)
+
+    def _journal_user(self, user_name):
+        # the user state before the first change is compared with the state on pop_journal()
+        if self._journal_origins is not None and user_name not in self._journal_origins:
+            self._journal_origins[user_name] = self.users.get(user_name)
+
+    def load(self, file_name):
+        assert file_name, "File must be specified"
+
+        with open(file_name, 'r') as state_file:
+            try:
+                self.users = json.load(state_file)
+            except ValueError:
+                # broken cache is rebuilt from scratch
+                self.users = {}
+
+        self._reset_changed()
+
+    def save(self, file_name):
+        """
+        :return: True if the file was written
+        """
+        assert file_name, "File must be specified"
+
+        written = replace_file_contents(file_name, json.dumps(self.users, sort_keys=True))
+        self._reset_changed()
+
+        return written
+
+    def load_shards(self, state_dir):
+        """
+        Loads users state saved by save_shards()
+        :param state_dir: directory with a file per user
+        """
+        assert state_dir, "State dir must be specified"
+
+        for state_file_name in os.listdir(state_dir):
+            if not state_file_name.endswith('.json'):
+                continue
+
+            with open(os.path.join(state_dir, state_file_name), 'r') as state_file:
+                try:
+                    self.users[state_file_name[:-len('.json')]] = json.load(state_file)
+                except ValueError:
+                    # user with a broken state is rebuilt by --rebuild-changed
+                    continue
+
+        self._reset_changed()
+
+    def save_shards(self, state_dir):
+        """
+        Saves state of the users changed since the last save to a file per user
+        :param state_dir: directory with a file per user
+        :return: True if any file was written or removed
+        """
+        assert state_dir, "State dir must be specified"
+
+        written = False
+        for user_name in sorted(self._changed_users | set(self._deleted_users)):
+            state_file_name = os.path.join(state_dir, '%s.json' % user_name)
+            if user_name in self.users:
+                written = replace_file_contents(state_file_name,
+                                                json.dumps(self.users[user_name], sort_keys=True)) or written
+            elif os.path.exists(state_file_name):
+                os.remove(state_file_name)
+                written = True
+
+        self._reset_changed()
+
+        return written
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..daemonlib import InotifyWatcher
+from ..daemonlib import NginxDirectDaemon
+from ..nginxlib import NginxMap
+from ..nginxvhostctl import NginxVhostsConfigManager
+from ..reloadlib import ARTIFACT_MAPS
+from ..reloadlib import ReloadOrchestrator
+
+
+class TestNginxDirectDaemon(unittest.TestCase):
+    USERS_CONFIG = os.path.join('data', 'users')
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.users_config = os.path.join(self.temp_dir, 'users')
+        self.out_config_dir = os.path.join(self.temp_dir, 'conf')
+
+        shutil.copytree(self.USERS_CONFIG, self.users_config)
+        os.mkdir(self.out_config_dir)
+
+    def tearDown(self):
+        """
+        Clean all after tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_handle_command(self):
+        conf_manager = NginxVhostsConfigManager(self.out_config_dir, self.users_config)
+        daemon = NginxDirectDaemon(conf_manager, os.path.join(self.temp_dir, 'daemon.sock'), use_inotify=False)
+
+        self.assertEqual('ok 5', daemon.handle_command('rebuild stasius'))
+        self.assertEqual('ok 0', daemon.handle_command('rebuild stasius'))
+        self.assertEqual('"stasius"', conf_manager.map_users.items['.goandfly.ru'])
+
+        self.assertTrue(daemon.handle_command('rebuild nosuchuser').startswith('error '))
+        self.assertEqual('error unknown command', daemon.handle_command('drop stasius'))
+
+        # maps changed by another process are reloaded
+        other_manager = NginxVhostsConfigManager(self.out_config_dir, self.users_config)
+        other_manager.rebuild_user('tstphpin')
+
+        self.assertEqual('ok 3', daemon.handle_command('delete stasius'))
+        self.assertEqual(['.dskfjhsdfsdfsdf.com'], list(conf_manager.map_users.items))
+
+    def test_handle_command_reloads_services(self):
+        log_file_name = os.path.join(self.temp_dir, 'commands.log')
+        services = {'nginx': {'configtest': ['sh', '-c', 'echo nginx-test >> ' + log_file_name],
+                              'reload': ['sh', '-c', 'echo nginx-reload >> ' + log_file_name],
+                              'artifacts': [ARTIFACT_MAPS]}}
+        conf_manager = NginxVhostsConfigManager(self.out_config_dir, self.users_config, journal=True)
+        daemon = NginxDirectDaemon(conf_manager, os.path.join(self.temp_dir, 'daemon.sock'), use_inotify=False,
+                                   reload_orchestrator=ReloadOrchestrator(services), reload_service_names=['nginx'])
+
+        self.assertTrue(daemon.handle_command('rebuild stasius').startswith('ok '))
+        self.assertEqual('ok 0', daemon.handle_command('rebuild stasius'))
+
+        with open(log_file_name, 'r') as log_file:
+            self.assertEqual(['nginx-test', 'nginx-reload'], log_file.read().split())
+
+        # nginx reads the map files, the journal is compacted before the reload
+        self.assertFalse(os.path.exists(os.path.join(self.out_config_dir, NginxVhostsConfigManager.JOURNAL_NAME)))
+
+        # users saved by a failed command are reloaded with the next command
+        self.assertTrue(daemon.handle_command('rebuild tstphpin nosuchuser').startswith('error '))
+        self.assertTrue(daemon.handle_command('rebuild stasius').startswith('ok '))
+        with open(log_file_name, 'r') as log_file:
+            self.assertEqual(['nginx-test', 'nginx-reload'] * 2, log_file.read().split())
+        self.assertIn('.dskfjhsdfsdfsdf.com', NginxMap.from_file(
+                'http_host', 'user', os.path.join(self.out_config_dir, 'map_users.conf')).items)
+
+    def test_inotify_watcher(self):
+        watcher = InotifyWatcher(self.users_config)
+        try:
+            self.assertEqual(set(), watcher.read_changed_users())
+
+            with open(os.path.join(self.users_config, 'stasius', 'domains', 'goandfly.ru.pointers'), 'a') as f:
+                f.write('11shop.ru=alias\n')
+            os.mkdir(os.path.join(self.users_config, 'newuser'))
+
+            self.assertEqual(set(['stasius', 'newuser']), watcher.read_changed_users())
+
+            with open(os.path.join(self.users_config, 'newuser', 'domains.list'), 'w') as f:
+                f.write('newuser.com\n')
+
+            self.assertEqual(set(['newuser']), watcher.read_changed_users())
+        finally:
+            watcher.close()
@@ -0,0 +1,30 @@
+import os
+import unittest
+
+from ..diradminlib import DirectAdminUserConfig
+
+
+class TestDirAdminlibModule(unittest.TestCase):
+    USER_DIR = os.path.join('data', 'users', 'stasius')
+
+    def test_lazy_domain_loading(self):
+        da_user_config = DirectAdminUserConfig(self.USER_DIR)
+        self.assertEqual(['goandfly.ru'], da_user_config.get_domain_names())
+
+        domain = da_user_config.get_domain('goandfly.ru')
+        self.assertIsNone(domain.pointers)
+        self.assertIsNone(domain.config)
+
+        self.assertEqual(['00shop.ru'], domain.get_pointers())
+        self.assertIsNone(domain.ips)
+
+    def test_get_config_keys(self):
+        domain = DirectAdminUserConfig(self.USER_DIR).get_domain('goandfly.ru')
+
+        ssl_config = domain.get_config(('SSLCertificateFile', 'NoSuchKey'))
+        self.assertEqual({'SSLCertificateFile': '/usr/local/directadmin/data/users/stasius/domains/goandfly.ru.cert'},
+                         ssl_config)
+        self.assertIsNone(domain.config)
+
+        self.assertEqual('/home/u1693/domains/suspended', domain.get_config()['DocumentRoot'])
+        self.assertEqual(ssl_config, domain.get_config(('SSLCertificateFile', 'NoSuchKey')))
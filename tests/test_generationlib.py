@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..generationlib import GenerationStore
+
+
+class TestGenerationStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Clean all after tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _write(self, file_name, contents):
+        with open(file_name, 'w') as generated_file:
+            generated_file.write(contents)
+
+    def _read(self, file_name):
+        with open(file_name, 'r') as generated_file:
+            return generated_file.read()
+
+    def test_publish_and_rollback(self):
+        store = GenerationStore(self.temp_dir, keep=2)
+        current_dir = os.path.join(self.temp_dir, 'current')
+
+        # the first generation is seeded from the files written in place
+        self._write(os.path.join(self.temp_dir, 'map_users.conf'), 'users1')
+        first_dir = store.create(['map_users.conf', 'https'], self.temp_dir)
+        os.mkdir(os.path.join(first_dir, 'https'))
+        self._write(os.path.join(first_dir, 'https', 'a.conf'), 'a1')
+        store.publish(first_dir)
+        self.assertEqual('00000001', store.get_current())
+        self.assertEqual('users1', self._read(os.path.join(current_dir, 'map_users.conf')))
+
+        # unchanged files are linked, the published generation is not changed by the next one
+        second_dir = store.create(['map_users.conf', 'https'])
+        self.assertEqual(os.stat(os.path.join(first_dir, 'https', 'a.conf')).st_ino,
+                         os.stat(os.path.join(second_dir, 'https', 'a.conf')).st_ino)
+        self._write(os.path.join(second_dir, 'map_users.conf.tmp'), 'users2')
+        os.rename(os.path.join(second_dir, 'map_users.conf.tmp'), os.path.join(second_dir, 'map_users.conf'))
+        self.assertEqual('users1', self._read(os.path.join(current_dir, 'map_users.conf')))
+        store.publish(second_dir)
+        self.assertEqual('users2', self._read(os.path.join(current_dir, 'map_users.conf')))
+
+        # discarded and pruned generations are removed
+        store.discard(store.create(['map_users.conf', 'https']))
+        store.publish(store.create(['map_users.conf', 'https']))
+        self.assertEqual(['00000002', '00000003'], store.get_generations())
+
+        self.assertEqual('00000002', store.rollback())
+        self.assertEqual('users2', self._read(os.path.join(current_dir, 'map_users.conf')))
+
+        # rollback follows the parents, the generation rolled back from is skipped and pruned
+        store.publish(store.create(['map_users.conf', 'https']))
+        self.assertEqual(['00000002', '00000004'], store.get_generations())
+        self.assertEqual('00000002', store.rollback())
+        self.assertRaises(Exception, store.rollback)
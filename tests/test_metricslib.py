@@ -0,0 +1,23 @@
+import json
+import unittest
+
+from ..metricslib import RunMetrics
+
+
+class TestMetricslibModule(unittest.TestCase):
+    def test_run_metrics(self):
+        run_metrics = RunMetrics()
+        with run_metrics.phase('save'):
+            run_metrics.add('files_written')
+            run_metrics.add('bytes_written', 10)
+        with run_metrics.phase('save'):
+            run_metrics.add('files_written')
+
+        run = json.loads(run_metrics.to_json(action='rebuild'))
+        self.assertEqual('rebuild', run['action'])
+        self.assertEqual(2, run['phases']['save']['calls'])
+        self.assertEqual({'files_written': 2, 'bytes_written': 10}, run['counters'])
+
+        prometheus = run_metrics.to_prometheus(action='rebuild')
+        self.assertIn('nginxdirect_phase_calls{action="rebuild",phase="save"} 2\n', prometheus)
+        self.assertIn('nginxdirect_bytes_written{action="rebuild"} 10\n', prometheus)
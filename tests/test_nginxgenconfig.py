@@ -1,9 +1,19 @@
+import json
 import os
 import unittest
 import shutil
+import sys
+from StringIO import StringIO
 
+from ..nginxlib import NginxMap
 from ..nginxvhostctl import NginxVhostsConfigManager
+from ..nginxvhostctl import apply_operations
+from ..nginxvhostctl import main
+from ..nginxvhostctl import read_batch_operations
+from ..nginxvhostctl import render_hash_tuning
 from ..nginxvhostctl import safe_create_path
+from ..nginxvhostctl import ssl_group_file_name
+from ..statelib import file_state
 
 
 class TestNginxGenConfigCommand(unittest.TestCase):
@@ -39,6 +49,463 @@ class TestNginxGenConfigCommand(unittest.TestCase):
         self.assertEqual('"goandfly.ru"', conf_manager.map_domains.items['.00shop.ru'])
         self.assertEqual('"goandfly.ru"', conf_manager.map_domains.items['.goandfly.ru'])
 
+    def test_rebuild_all_users_parallel(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_all()
+        serial_items = (dict(conf_manager.map_users.items), dict(conf_manager.map_domains.items),
+                        dict(conf_manager.map_subdomains.items))
+        shutil.rmtree(self.OUT_CONFIG_DIR)
+        safe_create_path(self.OUT_CONFIG_DIR)
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_all(jobs=2)
+
+        self.assertEqual(serial_items, (conf_manager.map_users.items, conf_manager.map_domains.items,
+                                        conf_manager.map_subdomains.items))
+        self.assertTrue(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'https', 'goandfly.ru.conf')))
+
+    def test_rebuild_changed(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual(5, conf_manager.rebuild_changed())
+        self.assertEqual(8, len(conf_manager.map_users.items))
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual(0, conf_manager.rebuild_changed())
+
+        # pointers file of a single domain changed
+        conf_manager.source_state.get_domain_states('stasius')['goandfly.ru'][1] = None
+        self.assertEqual(1, conf_manager.rebuild_changed())
+        self.assertEqual(8, len(conf_manager.map_users.items))
+        self.assertEqual('"goandfly.ru"', conf_manager.map_domains.items['.00shop.ru'])
+        self.assertEqual('"stasius"', conf_manager.map_users.items['.00shop.ru'])
+        self.assertTrue(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'https', 'goandfly.ru.conf')))
+
+        # user rebuilt from unchanged files leaves the state file alone
+        conf_manager.delete_user('stasius', save=False)
+        conf_manager.rebuild_user('stasius', save=False)
+        self.assertFalse(conf_manager.source_state.is_changed)
+
+        conf_manager.delete_user('stasius', save=False)
+        self.assertTrue(conf_manager.source_state.is_changed)
+
+    def test_load_snapshot(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_all()
+        self.assertTrue(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, conf_manager.SNAPSHOT_NAME)))
+
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertTrue(loaded_manager._load_snapshot(loaded_manager._get_files_state()))
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+        self.assertEqual(conf_manager.map_domains.items, loaded_manager.map_domains.items)
+        self.assertEqual(conf_manager.source_state.users, loaded_manager.source_state.users)
+
+        # snapshot is not used once map files are changed by someone else
+        other_map = NginxMap.from_file('http_host', 'user', os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf'))
+        other_map.del_item('.goandfly.ru')
+        other_map.save(os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf'))
+
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual(7, len(loaded_manager.map_users.items))
+        self.assertFalse(loaded_manager.map_users.has_item('.goandfly.ru'))
+
+        # saved changes make the snapshot stale, the next full load takes it again
+        snapshot_file = os.path.join(self.OUT_CONFIG_DIR, loaded_manager.SNAPSHOT_NAME)
+        loaded_manager.rebuild_user('stasius')
+        self.assertFalse(os.path.exists(snapshot_file))
+
+        NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertTrue(os.path.exists(snapshot_file))
+
+    def test_rebuild_sharded(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('tstphpin')
+
+        # plain map items are moved to the unassigned shard
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True)
+        conf_manager.rebuild_user('stasius')
+
+        users_shards_dir = os.path.join(self.OUT_CONFIG_DIR, 'maps', 'users')
+        self.assertEqual(['_unassigned.conf', 'stasius.conf'], sorted(os.listdir(users_shards_dir)))
+        # nginx resolves the include relative to its prefix
+        with open(os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')) as map_file:
+            self.assertEqual('map $http_host $user {\n\thostnames;\n\t%-45s\t"";\n'
+                             '\tinclude hosting/maps/users/*.conf;\n}\n\n' % 'default', map_file.read())
+
+        # a single user change rewrites its shards only
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True)
+        self.assertEqual('"stasius"', conf_manager.map_users.items['.goandfly.ru'])
+        conf_manager.delete_user('tstphpin', save=False)
+        conf_manager.rebuild_user('tstphpin')
+        self.assertEqual(sorted([os.path.join(self.OUT_CONFIG_DIR, 'maps', shards_name, shard_file_name)
+                                 for shards_name in ('users', 'domains')
+                                 for shard_file_name in ('_unassigned.conf', 'tstphpin.conf')]),
+                         sorted(conf_manager.changed_files))
+
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True)
+        loaded_manager.reload_if_changed(force=True)
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+        self.assertEqual(conf_manager.map_subdomains.items, loaded_manager.map_subdomains.items)
+
+        # switching back to plain maps
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius')
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'maps', 'users')))
+        self.assertEqual(loaded_manager.map_users.items,
+                         NginxMap.from_file('http_host', 'user',
+                                            os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')).items)
+
+    def test_rebuild_sharded_single_user_files(self):
+        users_config = os.path.join(self.OUT_CONFIG_DIR, 'users')
+        for user_name in os.listdir(self.USERS_CONFIG):
+            if user_name != 'tstphpin':
+                shutil.copytree(os.path.join(self.USERS_CONFIG, user_name), os.path.join(users_config, user_name))
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, sharded=True)
+        conf_manager.rebuild_all()
+        shutil.copytree(os.path.join(self.USERS_CONFIG, 'tstphpin'), os.path.join(users_config, 'tstphpin'))
+
+        def get_output_files_state():
+            return dict((os.path.join(dir_path, file_name), file_state(os.path.join(dir_path, file_name)))
+                        for dir_path, dir_names, file_names in os.walk(self.OUT_CONFIG_DIR)
+                        if not dir_path.startswith(users_config) for file_name in file_names)
+
+        # a new user gets its shard, state and https vhost files, files with all users are not written
+        saved_files_state = get_output_files_state()
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, sharded=True)
+        conf_manager.rebuild_user('tstphpin')
+        written_files = [file_name for file_name, state in get_output_files_state().items()
+                         if saved_files_state.get(file_name) != state]
+
+        self.assertEqual(sorted([os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.state.d', 'tstphpin.json'),
+                                 os.path.join(self.OUT_CONFIG_DIR, 'https', 'dskfjhsdfsdfsdf.com.conf'),
+                                 os.path.join(self.OUT_CONFIG_DIR, 'maps', 'domains', 'tstphpin.conf'),
+                                 os.path.join(self.OUT_CONFIG_DIR, 'maps', 'users', 'tstphpin.conf')]),
+                         sorted(file_name for file_name in written_files
+                                if os.path.basename(file_name) != '_hash_tuning.conf'))
+
+        # switching back to plain maps moves the state to a single file
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config)
+        conf_manager.rebuild_user('tstphpin')
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.state.d')))
+        with open(os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.state')) as state:
+            self.assertEqual(sorted(os.listdir(users_config)), sorted(json.load(state)))
+
+    def test_rebuild_combined(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius')
+
+        # separate maps are replaced by the combined one
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, layout='combined')
+        conf_manager._add_subdomain('goandfly.ru', 'blog', 'stasius')
+        conf_manager.rebuild_user('tstphpin')
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')))
+
+        map_vhosts = NginxMap.from_file('http_host', 'vhost', os.path.join(self.OUT_CONFIG_DIR, 'map_vhosts.conf'))
+        self.assertEqual('"stasius|goandfly.ru|"', map_vhosts.items['.00shop.ru'])
+        self.assertEqual('"tstphpin|dskfjhsdfsdfsdf.com|"', map_vhosts.items['.dskfjhsdfsdfsdf.com'])
+        self.assertEqual('"stasius|goandfly.ru|blog"', map_vhosts.items['.blog.goandfly.ru'])
+
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, layout='combined')
+        loaded_manager.reload_if_changed(force=True)
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+        self.assertEqual(conf_manager.map_domains.items, loaded_manager.map_domains.items)
+        self.assertEqual(conf_manager.map_subdomains.items, loaded_manager.map_subdomains.items)
+
+        # switching back to separate maps
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius')
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'map_vhosts.conf')))
+        self.assertEqual(loaded_manager.map_users.items,
+                         NginxMap.from_file('http_host', 'user',
+                                            os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')).items)
+
+        with self.assertRaises(Exception):
+            NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True, layout='combined')
+        with self.assertRaises(Exception):
+            NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, layout='combined', group_ssl=True)
+
+    def test_rebuild_group_ssl(self):
+        # both users get the same existing certificate
+        users_config = os.path.join(self.OUT_CONFIG_DIR, 'users')
+        sslcrt = os.path.abspath(os.path.join(self.OUT_CONFIG_DIR, 'shared.cert'))
+        sslkey = os.path.abspath(os.path.join(self.OUT_CONFIG_DIR, 'shared.key'))
+        for cert_file_name in (sslcrt, sslkey):
+            with open(cert_file_name, 'w') as cert_file:
+                cert_file.write('-----')
+
+        for user_name, domain_name in (('stasius', 'goandfly.ru'), ('tstphpin', 'dskfjhsdfsdfsdf.com')):
+            shutil.copytree(os.path.join(self.USERS_CONFIG, user_name), os.path.join(users_config, user_name))
+            domain_config_file_name = os.path.join(users_config, user_name, 'domains', domain_name + '.conf')
+            with open(domain_config_file_name) as domain_config_file:
+                domain_config = [line for line in domain_config_file if not line.startswith('SSLCertificate')]
+            with open(domain_config_file_name, 'w') as domain_config_file:
+                domain_config_file.writelines(domain_config + ['SSLCertificateFile={}\n'.format(sslcrt),
+                                                               'SSLCertificateKeyFile={}\n'.format(sslkey)])
+
+        https_dir = os.path.join(self.OUT_CONFIG_DIR, 'https')
+        group_vhost_file = os.path.join(https_dir, ssl_group_file_name(sslcrt, sslkey))
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, group_ssl=True)
+        conf_manager.rebuild_user('stasius')
+        conf_manager.rebuild_user('tstphpin')
+        self.assertEqual([os.path.basename(group_vhost_file)], os.listdir(https_dir))
+        with open(group_vhost_file) as vhost_file:
+            self.assertIn('server_name dskfjhsdfsdfsdf.com goandfly.ru 00shop.ru;', vhost_file.read())
+
+        # unchanged group is not rendered, renewed certificate is reported for the reload
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, group_ssl=True)
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual([], conf_manager.changed_files)
+
+        os.utime(sslcrt, (os.path.getatime(sslcrt), os.path.getmtime(sslcrt) + 10))
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual([group_vhost_file], conf_manager.changed_files)
+
+        conf_manager.delete_user('tstphpin')
+        with open(group_vhost_file) as vhost_file:
+            self.assertIn('server_name goandfly.ru 00shop.ru;', vhost_file.read())
+
+        # switching back to a vhost per domain
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config)
+        conf_manager.rebuild_all()
+        self.assertEqual(['dskfjhsdfsdfsdf.com.conf', 'goandfly.ru.conf'], sorted(os.listdir(https_dir)))
+
+    def test_rebuild_journal(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius')
+        map_users_file = os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')
+        journal_file = os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.journal')
+        state_file = os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.state')
+        snapshot_file = os.path.join(self.OUT_CONFIG_DIR, '.nginxdirect.snapshot')
+
+        # map and state files are not saved until the journal is compacted
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, journal=True)
+        saved_state = file_state(state_file)
+        conf_manager.rebuild_user('stasius')
+        self.assertFalse(os.path.exists(journal_file))
+        conf_manager.rebuild_user('tstphpin')
+        conf_manager.delete_user('stasius')
+        self.assertNotIn(map_users_file, conf_manager.changed_files)
+        with open(journal_file) as journal:
+            self.assertEqual(8, len(journal.readlines()))
+        self.assertEqual(saved_state, file_state(state_file))
+        self.assertTrue(os.path.exists(snapshot_file))
+
+        # changes are replayed by managers in any mode, on top of the snapshot too
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, journal=True)
+        self.assertEqual(['.dskfjhsdfsdfsdf.com'], sorted(loaded_manager.map_users.items))
+        self.assertEqual(['tstphpin'], sorted(loaded_manager.source_state.users))
+        os.remove(snapshot_file)
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+        self.assertEqual(conf_manager.map_domains.items, loaded_manager.map_domains.items)
+        self.assertEqual(['tstphpin'], sorted(loaded_manager.source_state.users))
+
+        conf_manager.compact_journal()
+        self.assertIn(map_users_file, conf_manager.changed_files)
+        self.assertFalse(os.path.exists(journal_file))
+        self.assertEqual(conf_manager.map_users.items, NginxMap.from_file('http_host', 'user', map_users_file).items)
+        with open(state_file) as state:
+            self.assertEqual(['tstphpin'], sorted(json.load(state)))
+
+        # the maps are saved once the journal grows too large
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, journal=True,
+                                                journal_max_size=1)
+        conf_manager.rebuild_user('stasius')
+        self.assertIn(map_users_file, conf_manager.changed_files)
+        self.assertFalse(os.path.exists(journal_file))
+
+    def test_rebuild_generations(self):
+        current_dir = os.path.join(self.OUT_CONFIG_DIR, 'current')
+        users_config = os.path.join(self.OUT_CONFIG_DIR, 'users')
+        shutil.copytree(self.USERS_CONFIG, users_config)
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, generations=2)
+        conf_manager.rebuild_user('stasius')
+        first_generation = os.readlink(current_dir)
+        self.assertTrue(os.path.exists(os.path.join(current_dir, 'map_users.conf')))
+        self.assertTrue(os.path.exists(os.path.join(current_dir, 'https', 'goandfly.ru.conf')))
+        self.assertEqual(set(['maps', 'https_vhosts']), conf_manager.get_changed_artifacts())
+
+        # unchanged run publishes nothing
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, generations=2)
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual([], conf_manager.changed_files)
+        self.assertEqual(first_generation, os.readlink(current_dir))
+
+        # changed DirectAdmin files state alone is saved to the published generation
+        domains_list = os.path.join(users_config, 'stasius', 'domains.list')
+        os.utime(domains_list, (os.path.getatime(domains_list), os.path.getmtime(domains_list) + 10))
+        self.assertEqual(1, conf_manager.rebuild_changed(only_users=['stasius']))
+        self.assertEqual([], conf_manager.changed_files)
+        self.assertEqual(first_generation, os.readlink(current_dir))
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, generations=2)
+        self.assertEqual(os.path.getmtime(domains_list), loaded_manager.source_state.get_user_state('stasius')[0][1])
+
+        conf_manager.rebuild_user('tstphpin')
+        self.assertNotEqual(first_generation, os.readlink(current_dir))
+        self.assertIn('.dskfjhsdfsdfsdf.com', NginxMap.from_file(
+                'http_host', 'user', os.path.join(current_dir, 'map_users.conf')).items)
+
+        # rollback switches the maps and the source state back
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, generations=2)
+        conf_manager.rollback_generation()
+        self.assertEqual(first_generation, os.readlink(current_dir))
+        self.assertNotIn('.dskfjhsdfsdfsdf.com', conf_manager.map_users.items)
+        self.assertIsNone(conf_manager.source_state.get_user_state('tstphpin'))
+
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, users_config, generations=2)
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+
+    def test_rebuild_sharded_generations(self):
+        current_dir = os.path.join(self.OUT_CONFIG_DIR, 'current')
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True, generations=2)
+        conf_manager.rebuild_user('stasius')
+        first_generation = os.readlink(current_dir)
+        with open(os.path.join(current_dir, 'map_users.conf')) as map_file:
+            self.assertIn('\tinclude hosting/current/maps/users/*.conf;\n', map_file.read())
+
+        # headers of the next generation are the same, unchanged run publishes nothing
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, sharded=True, generations=2)
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual([], conf_manager.changed_files)
+        self.assertEqual(first_generation, os.readlink(current_dir))
+
+        conf_manager.rebuild_user('tstphpin')
+        self.assertNotIn('map_users.conf', [os.path.basename(changed_file)
+                                            for changed_file in conf_manager.changed_files])
+        self.assertNotEqual(first_generation, os.readlink(current_dir))
+
+    def test_render_hash_tuning(self):
+        map_object = NginxMap('http_host', 'user')
+        for number in range(100):
+            map_object.add_item('.testhost%03d.ru' % number, '"user1"')
+
+        contents = render_hash_tuning([map_object])
+        self.assertEqual('# Generated by nginxvhostctl.py for 100 map keys up to 15 chars\n'
+                         'map_hash_max_size 2048;\nmap_hash_bucket_size 64;\n', contents)
+
+        # the sizes are kept for up to 10% more keys
+        previous_contents = contents.replace('2048', '4096')
+        for number in range(100, 110):
+            map_object.add_item('.testhost%03d.ru' % number, '"user1"')
+        self.assertEqual(previous_contents, render_hash_tuning([map_object], previous_contents))
+
+        map_object.add_item('.testhost110.ru', '"user1"')
+        self.assertEqual(contents.replace('100 map keys', '111 map keys'),
+                         render_hash_tuning([map_object], previous_contents))
+
+        # a longer key may not fit the buckets
+        map_object.del_item('.testhost110.ru')
+        map_object.add_item('.%s.ru' % ('a' * 60), '"user1"')
+        self.assertNotEqual(previous_contents, render_hash_tuning([map_object], previous_contents))
+
+    def test_apply_batch_operations(self):
+        operations = read_batch_operations(StringIO("rebuild stasius\n# comment\n\nrebuild nosuchuser\n"
+                                                    "rebuild tstphpin\ndelete tstphpin # moved\n"))
+        self.assertEqual([('rebuild', 'stasius'), ('rebuild', 'nosuchuser'), ('rebuild', 'tstphpin'),
+                          ('delete', 'tstphpin')], operations)
+        self.assertRaises(Exception, read_batch_operations, StringIO("drop stasius\n"))
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertFalse(apply_operations(conf_manager, operations))
+
+        self.assertEqual(['.00shop.ru', '.goandfly.ru'], sorted(conf_manager.map_users.items))
+        loaded_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual(conf_manager.map_users.items, loaded_manager.map_users.items)
+
+    def _run_main(self, *arguments):
+        reload_log = os.path.join(self.OUT_CONFIG_DIR, 'reload.log')
+        reload_config = os.path.join(self.OUT_CONFIG_DIR, 'services.json')
+        with open(reload_config, 'w') as config_file:
+            json.dump({'nginx': {'configtest': 'true', 'reload': "sh -c 'echo reload >> %s'" % reload_log}},
+                      config_file)
+
+        argv = sys.argv
+        try:
+            sys.argv = ['nginxvhostctl.py', '-o', self.OUT_CONFIG_DIR, '-s', self.USERS_CONFIG,
+                        '--reload-services', 'nginx', '--reload-config', reload_config,
+                        '--min-reload-interval', '0'] + list(arguments)
+            exit_code = main()
+        finally:
+            sys.argv = argv
+
+        reloads = 0
+        if os.path.exists(reload_log):
+            with open(reload_log) as log_file:
+                reloads = len(log_file.read().split())
+            os.remove(reload_log)
+
+        return exit_code, reloads
+
+    def test_coalesced_batch_exit_code(self):
+        self.assertEqual((0, 1), self._run_main('--coalesce-window', '0', '-r', 'stasius'))
+        self.assertEqual((1, 0), self._run_main('--coalesce-window', '0', '-r', 'nosuchuser'))
+
+        # the saved user is reloaded though another one failed
+        self.assertEqual((1, 1), self._run_main('--coalesce-window', '0', '-r', 'tstphpin', 'nosuchuser'))
+        self.assertIn('.dskfjhsdfsdfsdf.com', NginxMap.from_file(
+                'http_host', 'user', os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf')).items)
+
+    def test_failed_operation_exit_code(self):
+        # the saved user is reloaded though another one failed
+        self.assertEqual((1, 1), self._run_main('-r', 'stasius', 'nosuchuser'))
+        self.assertEqual((0, 0), self._run_main('-r', 'stasius'))
+
+    def test_clean_unresolved_domains(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius', save=False)
+        conf_manager._add_subdomain('goandfly.ru', 'www', 'stasius')
+        conf_manager._add_subdomain('00shop.ru', 'www', 'stasius')
+        conf_manager._save()
+
+        conf_manager.changed_files = []
+        self.assertEqual(0, conf_manager.clean_unresolved_domains())
+        self.assertEqual([], conf_manager.changed_files)
+
+        conf_manager.map_users.del_item('.goandfly.ru')
+        self.assertEqual(1, conf_manager.clean_unresolved_domains())
+
+        self.assertEqual(['.00shop.ru'], list(conf_manager.map_domains.items))
+        self.assertEqual(['.www.00shop.ru'], list(conf_manager.map_subdomains.items))
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'https', 'goandfly.ru.conf')))
+
+    def test_gc_https_vhosts(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        self.assertEqual([], conf_manager.gc_https_vhosts())
+
+        conf_manager.rebuild_all()
+        https_dir = os.path.join(self.OUT_CONFIG_DIR, 'https')
+        for file_name in ('renamed.com.conf', 'goandfly.ru.conf.123.tmp'):
+            with open(os.path.join(https_dir, file_name), 'w') as https_vhost_file:
+                https_vhost_file.write('server {}\n')
+
+        self.assertEqual(sorted([os.path.join(https_dir, 'renamed.com.conf'),
+                                 os.path.join(https_dir, 'goandfly.ru.conf.123.tmp')]),
+                         sorted(conf_manager.gc_https_vhosts()))
+        self.assertEqual(['dskfjhsdfsdfsdf.com.conf', 'goandfly.ru.conf'], sorted(os.listdir(https_dir)))
+
+    def test_dry_run_diff(self):
+        NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG).rebuild_user('tstphpin')
+        out_files = sorted(os.listdir(self.OUT_CONFIG_DIR))
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG, dry_run=True)
+        conf_manager.delete_user('tstphpin')
+        conf_manager.rebuild_user('stasius')
+
+        diff = conf_manager.get_dry_run_diff()
+        self.assertEqual((os.path.join(self.OUT_CONFIG_DIR, 'map_users.conf'), ['.00shop.ru', '.goandfly.ru'],
+                          ['.dskfjhsdfsdfsdf.com'], []), diff['maps'][0][:4])
+        self.assertEqual([(os.path.join(self.OUT_CONFIG_DIR, 'https', 'dskfjhsdfsdfsdf.com.conf'), 'delete', 0),
+                          (os.path.join(self.OUT_CONFIG_DIR, 'https', 'goandfly.ru.conf'), 'create', 2551)],
+                         diff['vhosts'])
+
+        self.assertEqual([], conf_manager.changed_files)
+        self.assertEqual(out_files, sorted(os.listdir(self.OUT_CONFIG_DIR)))
+        self.assertEqual(['.dskfjhsdfsdfsdf.com'], list(NginxVhostsConfigManager(self.OUT_CONFIG_DIR,
+                                                                                 self.USERS_CONFIG).map_users.items))
+
     def test_rebuild_single_user(self):
         conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
 
@@ -54,3 +521,18 @@ class TestNginxGenConfigCommand(unittest.TestCase):
         self.assertEqual('"tstphpin"', conf_manager.map_users.items['.dskfjhsdfsdfsdf.com'])
 
         self.assertTrue(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'https', 'dskfjhsdfsdfsdf.com.conf')))
+
+    def test_rebuild_single_user_unchanged(self):
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual(5, len(conf_manager.changed_files))
+        self.assertIn(os.path.join(self.OUT_CONFIG_DIR, '_hash_tuning.conf'), conf_manager.changed_files)
+
+        conf_manager = NginxVhostsConfigManager(self.OUT_CONFIG_DIR, self.USERS_CONFIG)
+        conf_manager.delete_user('stasius', save=False)
+        conf_manager.rebuild_user('stasius')
+        self.assertEqual([], conf_manager.changed_files)
+
+        conf_manager.delete_user('stasius')
+        self.assertEqual(3, len(conf_manager.changed_files))
+        self.assertFalse(os.path.exists(os.path.join(self.OUT_CONFIG_DIR, 'https', 'goandfly.ru.conf')))
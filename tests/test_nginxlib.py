@@ -1,7 +1,15 @@
 import os
 import unittest
 
+from ..nginxlib import FileLock
 from ..nginxlib import NginxMap
+from ..nginxlib import NginxTemplate
+from ..nginxlib import append_map_journal
+from ..nginxlib import compute_map_hash_sizes
+from ..nginxlib import find_hash_size
+from ..nginxlib import get_map_hashes
+from ..nginxlib import load_map_sections
+from ..nginxlib import read_map_journal
 
 
 class TestNginxlibModule(unittest.TestCase):
@@ -17,6 +25,101 @@ class TestNginxlibModule(unittest.TestCase):
 
         self.assertEqual('.testhost2.ru', map_object.find_keys_by_value('"user2"').next())
 
+    def test_find_keys_by_value_after_changes(self):
+        map_object = self._create_test_map()
+
+        self.assertEqual(['.testhost2.ru'], list(map_object.find_keys_by_value('"user2"')))
+
+        map_object.update_item('.testhost2.ru', '"user1"')
+        map_object.add_item('.testhost6.ru', '"user1"')
+        map_object.del_item('.testhost1.ru')
+
+        self.assertEqual([], list(map_object.find_keys_by_value('"user2"')))
+        self.assertEqual(['.testhost2.ru', '.testhost6.ru'], sorted(map_object.find_keys_by_value('"user1"')))
+
+    def test_find_keys_by_parent(self):
+        map_object = NginxMap('http_host', 'subdomain')
+        map_object.add_item('.sub1.testhost1.ru', '"sub1"')
+        map_object.add_item('.sub2.testhost1.ru', '"sub2"')
+        map_object.add_item('.sub1.testhost2.ru', '"sub1"')
+
+        self.assertEqual(['.sub1.testhost1.ru', '.sub2.testhost1.ru'],
+                         sorted(map_object.find_keys_by_parent('.testhost1.ru')))
+        self.assertEqual([], list(map_object.find_keys_by_parent('.sub1.testhost1.ru')))
+        self.assertEqual([], list(map_object.find_keys_by_parent('.host1.ru')))
+
+        map_object.del_item('.sub1.testhost1.ru')
+        self.assertEqual(['.sub2.testhost1.ru'], list(map_object.find_keys_by_parent('.testhost1.ru')))
+
+    def test_save_unchanged(self):
+        map_object = self._create_test_map()
+
+        self.assertTrue(map_object.save('test_map.test'))
+        self.assertFalse(map_object.save('test_map.test'))
+
+        map_object.update_item('.testhost1.ru', '"user1ed"')
+        self.assertTrue(map_object.save('test_map.test'))
+        self.assertEqual(map_object.render(), open('test_map.test').read())
+
+    def test_load_map_sections(self):
+        users_map = self._create_test_map()
+        domains_map = NginxMap('http_host', 'domain')
+        domains_map.add_item('.testhost1.ru', '"testhost1.ru"')
+        domains_map.add_item('.alias1.ru', '"testhost1.ru"')
+
+        with open('test_map.test', 'w') as map_file:
+            map_file.write(users_map.render() + domains_map.render())
+
+        loaded_users = NginxMap('http_host', 'user')
+        loaded_domains = NginxMap('http_host', 'domain')
+        missing_map = NginxMap('http_host', 'subdomain')
+
+        self.assertEqual([loaded_users, loaded_domains],
+                         load_map_sections('test_map.test', [missing_map, loaded_domains, loaded_users]))
+        self.assertEqual(users_map.items, loaded_users.items)
+        self.assertEqual(domains_map.items, loaded_domains.items)
+        self.assertEqual(['.alias1.ru', '.testhost1.ru'], sorted(loaded_domains.find_keys_by_value('"testhost1.ru"')))
+        self.assertEqual({}, missing_map.items)
+
+    def test_compute_map_hash_sizes(self):
+        self.assertEqual((2048, 64), compute_map_hash_sizes([self._create_test_map()]))
+
+        for hosts_count in (1000, 10000):
+            map_object = NginxMap('http_host', 'user')
+            for number in range(hosts_count):
+                map_object.add_item('.testhost%d.ru' % number, '"user1"')
+                map_object.add_item('.sub.testhost%d.ru' % number, '"user1"')
+            map_object.add_item('.%s.ru' % ('a' * 60), '"user1"')
+            map_object.add_item('www.testhost1.*', '"user1"')
+            map_object.add_item('testhost1.com', '"user1"')
+
+            max_size, bucket_size = compute_map_hash_sizes([self._create_test_map(), map_object])
+            for hash_elements in get_map_hashes(map_object):
+                self.assertIsNotNone(find_hash_size(hash_elements, max_size, bucket_size))
+
+    def test_find_hash_size(self):
+        map_object = NginxMap('http_host', 'user')
+        for number in range(1000):
+            map_object.add_item('testhost%d.ru' % number, '"user1"')
+        hash_elements, = get_map_hashes(map_object)
+
+        # buckets of 64 bytes hold two names
+        self.assertIsNone(find_hash_size(hash_elements, 400, 64))
+        self.assertIsNotNone(find_hash_size(hash_elements, 2048, 64))
+        self.assertIsNone(find_hash_size(hash_elements, 2048, 16))
+
+    def test_template_render(self):
+        with open('test_map.test', 'w') as template_file:
+            template_file.write('server_name {domain};\nset $user "{user}";\nset $domain "{domain}"; {unknown}\n')
+
+        template = NginxTemplate.from_file('test_map.test', ('user', 'domain'))
+        values = {'user': 'stasius', 'domain': 'goandfly.ru'}
+
+        self.assertEqual('server_name goandfly.ru;\nset $user "stasius";\nset $domain "goandfly.ru"; {unknown}\n',
+                         template.render(values))
+        self.assertEqual(template.digest(values), template.digest(dict(values)))
+        self.assertNotEqual(template.digest(values), template.digest({'user': 'stasius', 'domain': 'goandfly.com'}))
+
     def test_file_locking(self):
         map_object = self._create_test_map()
 
@@ -26,6 +129,14 @@ class TestNginxlibModule(unittest.TestCase):
         # waiting for exception
         self.assertRaises(IOError, map_object.save, 'test_map.test')
 
+    def test_file_lock_timeout(self):
+        with FileLock('test_map.test', 10):
+            self.assertRaises(IOError, FileLock('test_map.test', 0.2).acquire)
+
+        other_lock = FileLock('test_map.test', 0.2)
+        self.assertTrue(other_lock.acquire() < 0.2)
+        other_lock.release()
+
     def test_load_from_file(self):
         map_object = self._create_test_map()
 
@@ -74,6 +185,40 @@ class TestNginxlibModule(unittest.TestCase):
         self.assertEqual('"user4"', loaded_map.items['.testhost4.ru'])
         self.assertEqual('"user5"', loaded_map.items['.testhost5.ru'])
 
+    def test_map_journal(self):
+        map_object = self._create_test_map()
+        map_object.start_journal()
+
+        # changes made back are not recorded
+        map_object.update_item('.testhost1.ru', '"user1ed"')
+        map_object.del_item('.testhost2.ru')
+        map_object.add_item('.testhost6.ru', '"user6"', 'user6')
+        map_object.del_item('.testhost3.ru')
+        map_object.add_item('.testhost3.ru', '"user3"')
+        records = map_object.pop_journal()
+        self.assertEqual([('.testhost1.ru', '"user1ed"', '_unassigned', '_unassigned'),
+                          ('.testhost2.ru', None, '_unassigned', '_unassigned'),
+                          ('.testhost6.ru', '"user6"', 'user6', '_unassigned')], records)
+        self.assertEqual([], map_object.pop_journal())
+
+        # the last record cut by a crash is skipped
+        append_map_journal('test_map.test', [('user',) + record for record in records])
+        with open('test_map.test', 'a') as journal_file:
+            journal_file.write('user\t.testhost4.ru')
+        journal_records = read_map_journal('test_map.test')
+        self.assertEqual(records, [record[1:] for record in journal_records])
+
+        replayed_map = self._create_test_map()
+        replayed_map.replay_journal(records)
+        replayed_map.replay_journal(records)
+        self.assertEqual(map_object.items, replayed_map.items)
+        self.assertEqual(map_object.item_shards, replayed_map.item_shards)
+
+        # item loaded without a shard and added back to its shard is not changed
+        map_object.del_item('.testhost5.ru')
+        map_object.add_item('.testhost5.ru', '"user5"', 'user5')
+        self.assertEqual([], map_object.pop_journal())
+
     def _create_test_map(self):
         map_object = NginxMap('http_host', 'user')
 
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..nginxvhostctl import NginxVhostsConfigManager
+from ..publishlib import CommandTarget
+from ..publishlib import LocalDirTarget
+from ..publishlib import Publisher
+from ..publishlib import build_manifest
+
+
+class TestPublisher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root_dir = os.path.join(self.temp_dir, 'hosting')
+        os.makedirs(os.path.join(self.root_dir, 'https'))
+
+        self._write('map_users.conf', 'users')
+        self._write('https/a.conf', 'a')
+        self._write('https/b.conf', 'b')
+
+    def tearDown(self):
+        """
+        Clean all after tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _write(self, file_path, contents):
+        with open(os.path.join(self.root_dir, file_path), 'w') as generated_file:
+            generated_file.write(contents)
+
+    def _create_publisher(self, targets):
+        return Publisher(self.root_dir, ['map_users.conf', 'https'], os.path.join(self.temp_dir, 'state'), targets)
+
+    def test_build_manifest(self):
+        manifest = build_manifest(self.root_dir, ['map_users.conf', 'https', 'missing.conf'])
+        self.assertEqual(['https/a.conf', 'https/b.conf', 'map_users.conf'], sorted(manifest))
+
+        # hashes of files with the same state are taken from the previous manifest
+        previous_manifest = dict(manifest)
+        previous_manifest['https/a.conf'] = ['cached'] + manifest['https/a.conf'][1:]
+        self.assertEqual('cached', build_manifest(self.root_dir, ['https'], previous_manifest)['https/a.conf'][0])
+
+    def test_publish_changed_files(self):
+        edge_dir = os.path.join(self.temp_dir, 'edge')
+        log_file_name = os.path.join(self.temp_dir, 'pushed.log')
+        targets = [LocalDirTarget(edge_dir),
+                   CommandTarget("sh -c 'cat {files} {removed} >> %s' {root}" % log_file_name)]
+
+        results = self._create_publisher(targets).publish()
+        self.assertEqual([(edge_dir, 3, 0, None), (targets[1].name, 3, 0, None)], results)
+        with open(os.path.join(edge_dir, 'https', 'a.conf')) as edge_file:
+            self.assertEqual('a', edge_file.read())
+
+        # unchanged run transfers nothing
+        self.assertEqual([(edge_dir, 0, 0, None), (targets[1].name, 0, 0, None)],
+                         self._create_publisher(targets).publish())
+
+        self._write('https/a.conf', 'a2')
+        os.remove(os.path.join(self.root_dir, 'https', 'b.conf'))
+        self._create_publisher(targets).publish()
+        with open(os.path.join(edge_dir, 'https', 'a.conf')) as edge_file:
+            self.assertEqual('a2', edge_file.read())
+        self.assertFalse(os.path.exists(os.path.join(edge_dir, 'https', 'b.conf')))
+        with open(log_file_name) as log_file:
+            self.assertEqual(['https/a.conf', 'https/b.conf', 'map_users.conf', 'https/a.conf', 'https/b.conf'],
+                             log_file.read().split())
+
+    def test_removed_files_need_placeholder(self):
+        target = CommandTarget('true {files}')
+
+        self.assertEqual([('true {files}', 3, 0, None)], self._create_publisher([target]).publish())
+
+        os.remove(os.path.join(self.root_dir, 'https', 'b.conf'))
+        self.assertEqual([('true {files}', 0, 0, 'Command template has no {removed} to remove 1 files')],
+                         self._create_publisher([target]).publish())
+
+        # the removal is pushed again by a fixed target
+        target.command_template = 'true {files} {removed}'
+        self.assertEqual([('true {files}', 0, 1, None)], self._create_publisher([target]).publish())
+
+    def test_publish_sharded_maps(self):
+        out_config_dir = os.path.join(self.temp_dir, 'conf')
+        os.mkdir(out_config_dir)
+        conf_manager = NginxVhostsConfigManager(out_config_dir, os.path.join('data', 'users'), sharded=True,
+                                                generations=2)
+        conf_manager.rebuild_user('stasius')
+
+        edge_dir = os.path.join(self.temp_dir, 'edge')
+        Publisher(conf_manager.output_dir, conf_manager.PUBLISH_NAMES, os.path.join(self.temp_dir, 'state'),
+                  [LocalDirTarget(edge_dir)]).publish()
+
+        # the include is resolved by nginx of the front-end, not by the path of the generation
+        with open(os.path.join(edge_dir, 'map_users.conf')) as edge_file:
+            self.assertIn('\tinclude hosting/current/maps/users/*.conf;\n', edge_file.read())
+        self.assertTrue(os.path.exists(os.path.join(edge_dir, 'maps', 'users', 'stasius.conf')))
+
+    def test_failed_target_is_retried(self):
+        edge_dir = os.path.join(self.temp_dir, 'edge')
+        failed_target = CommandTarget('false {files}')
+
+        results = self._create_publisher([failed_target, LocalDirTarget(edge_dir)]).publish()
+        self.assertEqual(('false {files}', 0, 0, 'Command exited with 1'), results[0])
+        self.assertEqual((edge_dir, 3, 0, None), results[1])
+
+        results = self._create_publisher([LocalDirTarget(edge_dir), CommandTarget('true {files}')]).publish()
+        self.assertEqual([(edge_dir, 0, 0, None), ('true {files}', 3, 0, None)], results)
@@ -0,0 +1,54 @@
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+from ..queuelib import RebuildQueue
+
+
+class TestRebuildQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Clean all after tests
+        """
+        shutil.rmtree(self.queue_dir, ignore_errors=True)
+
+    def test_coalesce_operations(self):
+        rebuild_queue = RebuildQueue(self.queue_dir)
+        rebuild_queue.enqueue('rebuild', 'user1')
+        rebuild_queue.enqueue('rebuild', 'user2')
+        rebuild_queue.enqueue('rebuild', 'user1')
+        rebuild_queue.enqueue('delete', 'user2')
+
+        batches = []
+        self.assertTrue(rebuild_queue.run(batches.append, 0))
+
+        self.assertEqual([[('rebuild', 'user1'), ('delete', 'user2')]], batches)
+        self.assertTrue(rebuild_queue.is_empty())
+
+    def test_run_with_active_runner(self):
+        rebuild_queue = RebuildQueue(self.queue_dir)
+        rebuild_queue.enqueue('rebuild', 'user1')
+
+        with open(rebuild_queue.lock_file_name, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            batches = []
+            self.assertFalse(rebuild_queue.run(batches.append, 0))
+            self.assertEqual([], batches)
+            self.assertFalse(rebuild_queue.is_empty())
+
+    def test_failed_batch_is_retried(self):
+        rebuild_queue = RebuildQueue(self.queue_dir)
+        rebuild_queue.enqueue('rebuild', 'user1')
+
+        def failing_batch(operations):
+            raise IOError("disk full")
+
+        self.assertRaises(IOError, rebuild_queue.run, failing_batch, 0)
+
+        rebuild_queue.enqueue('rebuild', 'user2')
+        self.assertEqual([('rebuild', 'user1'), ('rebuild', 'user2')], rebuild_queue.take())
@@ -0,0 +1,69 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..reloadlib import ARTIFACT_HTTPS_VHOSTS
+from ..reloadlib import ARTIFACT_MAPS
+from ..reloadlib import ReloadOrchestrator
+from ..reloadlib import load_services_config
+
+
+class TestReloadOrchestrator(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file_name = os.path.join(self.temp_dir, 'commands.log')
+
+    def tearDown(self):
+        """
+        Clean all after tests
+        """
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _stub_command(self, line, exit_code=0):
+        return "sh -c 'echo {} >> {}; exit {}'".format(line, self.log_file_name, exit_code)
+
+    def _load_services(self, nginx_configtest_exit_code=0):
+        config_file_name = os.path.join(self.temp_dir, 'services.json')
+        with open(config_file_name, 'w') as config_file:
+            json.dump({
+                'nginx': {'configtest': self._stub_command('nginx-test', nginx_configtest_exit_code),
+                          'reload': self._stub_command('nginx-reload')},
+                'httpd': {'configtest': self._stub_command('httpd-test'),
+                          'reload': self._stub_command('httpd-reload')},
+            }, config_file)
+
+        return load_services_config(config_file_name, init_dir=self.temp_dir)
+
+    def _read_log(self):
+        if not os.path.exists(self.log_file_name):
+            return []
+
+        with open(self.log_file_name, 'r') as log_file:
+            return sorted(log_file.read().split())
+
+    def test_reload_affected_services(self):
+        orchestrator = ReloadOrchestrator(self._load_services(), os.path.join(self.temp_dir, 'reload.state'))
+
+        self.assertEqual(['nginx'], orchestrator.reload(set([ARTIFACT_MAPS]), ['httpd', 'nginx']))
+        self.assertEqual(['nginx-reload', 'nginx-test'], self._read_log())
+
+        self.assertEqual(['httpd', 'nginx'], orchestrator.reload(set([ARTIFACT_MAPS, ARTIFACT_HTTPS_VHOSTS])))
+        self.assertEqual([], orchestrator.reload(set()))
+        self.assertRaises(Exception, orchestrator.reload, set([ARTIFACT_MAPS]), ['postfix'])
+
+    def test_load_services_config_without_commands(self):
+        config_file_name = os.path.join(self.temp_dir, 'services.json')
+        for services_config in ({'nginx': {'reload': None}}, {'edge1': {'reload': 'ssh edge1 nginx -s reload'}},
+                                {'nginx': {'configtest': ''}}):
+            with open(config_file_name, 'w') as config_file:
+                json.dump(services_config, config_file)
+
+            self.assertRaises(Exception, load_services_config, config_file_name, init_dir=self.temp_dir)
+
+    def test_failed_configtest(self):
+        orchestrator = ReloadOrchestrator(self._load_services(nginx_configtest_exit_code=1))
+
+        self.assertRaises(Exception, orchestrator.reload, set([ARTIFACT_HTTPS_VHOSTS]))
+        self.assertEqual(['httpd-test', 'nginx-test'], self._read_log())